@@ -0,0 +1,80 @@
+from flask import request, jsonify, abort, g
+from server import app
+from backend.profiling import sampleStacks, RequestProfiler, startMemoryTracing, stopMemoryTracing, memorySnapshot
+import hmac
+import os
+
+'''
+Admin diagnostics for a running app: CPU profiles and memory snapshots taken
+on demand, without a restart or a debugger
+
+Every endpoint needs the token in RESTAURANT_ADMIN_TOKEN, sent as the
+X-Admin-Token header; without that variable set the endpoints do not exist.
+With several worker processes each capture covers the worker that serves it.
+'''
+
+ADMIN_TOKEN = os.environ.get("RESTAURANT_ADMIN_TOKEN")
+# longest capture one request may ask for, in seconds
+MAX_CAPTURE = 60
+
+profiler = RequestProfiler()
+
+def authorised():
+    if not ADMIN_TOKEN:
+        abort(404)
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        abort(403)
+
+def intArg(name, default, most):
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        abort(400)
+    return max(1, min(value, most))
+
+def profileRequests(app):
+    @app.before_request
+    def beginProfile():
+        # only does anything while a cProfile capture is running
+        if profiler.capturing and request.endpoint != "adminProfile":
+            g.profile = profiler.begin()
+
+    @app.teardown_request
+    def endProfile(exception=None):
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profiler.end(profile)
+
+if ADMIN_TOKEN:
+    profileRequests(app)
+
+# ?seconds=N&mode=sample|cprofile&top=K
+# sample: the stacks of every thread, sampled every 5ms, busy threads only
+# cprofile: a deterministic profile of each request handled in the next N seconds
+@app.route('/admin/profile')
+def adminProfile():
+    authorised()
+    seconds = intArg("seconds", 10, MAX_CAPTURE)
+    top = intArg("top", 25, 200)
+    mode = request.args.get("mode", "sample")
+    if mode == "sample":
+        return jsonify(sampleStacks(seconds, top=top))
+    if mode == "cprofile":
+        result = profiler.capture(seconds, top)
+        if result is None:
+            return jsonify(error="A profile is already being captured"), 409
+        return jsonify(result)
+    return jsonify(error="Mode must be sample or cprofile"), 400
+
+# GET: memory held per backend module since tracing started, and the live
+# Order, Main, SideDrink and Ingredient objects; POST starts tracing and
+# DELETE stops it, as tracing slows allocation down
+@app.route('/admin/memory', methods=["GET", "POST", "DELETE"])
+def adminMemory():
+    authorised()
+    if request.method == "POST":
+        startMemoryTracing(intArg("frames", 1, 25))
+    elif request.method == "DELETE":
+        stopMemoryTracing()
+    return jsonify(memorySnapshot(intArg("top", 10, 100)))
@@ -0,0 +1,201 @@
+from flask import request, jsonify
+from server import app, system, writer
+from routes import expiry, ORDER_TIMEOUT
+from backend.errors import SystemError, InventoryError, OrderError, BasketError
+from backend.basket import Basket, isWhole
+
+'''
+JSON API for kiosks and kitchen display screens
+
+Same backend calls as the HTML routes, but each request returns a small JSON
+body instead of rendering a page. Errors come back as {"error": msg} with a
+4xx status.
+'''
+
+def error(msg, status=400):
+    return jsonify(error=msg), status
+
+def orderStatus(order):
+    if not order.paid:
+        return "pending"
+    if not order.prepared:
+        return "active"
+    return "finished"
+
+def orderJSON(order):
+    return {"id": order.ID, "status": orderStatus(order), "total": round(order.calculateTotalPrice(), 2),
+            "mains": [{"ingredients": main.ingredients, "price": main.calculateCost()} for main in order.mainOrders],
+            "sides": [{"name": side.name, "quantity": side.quantity, "size": side.servingSize,
+                       "price": side.calculateCost()} for side in order.sidesAndDrinks]}
+
+def body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise OrderError("Expected a JSON object")
+    return data
+
+def lookup(orderID):
+    try:
+        return system.getOrderFromID(orderID), None
+    except SystemError as se:
+        return None, error(se.msg, 404)
+
+'''
+Orders
+'''
+@app.route('/api/orders', methods=["POST"])
+def apiCreate():
+    order = system.createOrder()
+    writer.markDirty()   # persistence
+    expiry.schedule(order.ID, ORDER_TIMEOUT)
+    return jsonify(id=order.ID), 201
+
+@app.route('/api/orders/<int:orderID>')
+def apiReview(orderID):
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    return jsonify(orderJSON(order))
+
+@app.route('/api/orders/<int:orderID>/status')
+def apiStatus(orderID):
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    return jsonify(id=order.ID, status=orderStatus(order))
+
+@app.route('/api/orders/<int:orderID>', methods=["DELETE"])
+def apiCancel(orderID):
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    try:
+        system.cancelOrder(orderID)
+    except SystemError as se:
+        return error(se.msg, 409)
+    expiry.cancel(orderID)
+    writer.markDirty()   # persistence
+    return jsonify(id=orderID, status="cancelled")
+
+# body is {"recipe": name} for a standard item, or {"type": "burger" | "wrap", "ingredients": {name: quantity}}
+@app.route('/api/orders/<int:orderID>/mains', methods=["POST"])
+def apiAddMain(orderID):
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    try:
+        data = body()
+        if "recipe" in data:
+            order.addRecipe(system.inventory, str(data["recipe"]))
+        else:
+            ingredients = data.get("ingredients")
+            if not isinstance(ingredients, dict) or not all(isWhole(q) for q in ingredients.values()):
+                raise OrderError("Ingredients must map names to whole quantities")
+            if data.get("type") == "burger":
+                order.addBurgerMain(system.inventory, ingredients)
+            elif data.get("type") == "wrap":
+                order.addWrapMain(system.inventory, ingredients)
+            else:
+                raise OrderError("Main type must be burger or wrap")
+    except (InventoryError, OrderError) as e:
+        return error(e.msg)
+    writer.markDirty()   # persistence
+    return jsonify(orderJSON(order)), 201
+
+def addSideOrDrink(orderID, add):
+    # body is {"name": name, "quantity": n, "size": servingSize}
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    try:
+        data = body()
+        quantity = data.get("quantity", 1)
+        if not isWhole(quantity) or quantity < 1:
+            raise OrderError("Quantity must be a whole number of at least 1")
+        getattr(order, add)(system.inventory, str(data.get("name", "")), quantity, str(data.get("size", "regular")))
+    except (InventoryError, OrderError) as e:
+        return error(e.msg)
+    writer.markDirty()   # persistence
+    return jsonify(orderJSON(order)), 201
+
+@app.route('/api/orders/<int:orderID>/sides', methods=["POST"])
+def apiAddSide(orderID):
+    return addSideOrDrink(orderID, "addSide")
+
+@app.route('/api/orders/<int:orderID>/drinks', methods=["POST"])
+def apiAddDrink(orderID):
+    return addSideOrDrink(orderID, "addDrink")
+
+@app.route('/api/orders/<int:orderID>/checkout', methods=["POST"])
+def apiCheckout(orderID):
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    try:
+        system.checkout(orderID)
+    except OrderError as oe:
+        return error(oe.msg)
+    except SystemError as se:
+        return error(se.msg, 409)
+    expiry.cancel(orderID)
+    writer.markDirty()   # persistence
+    return jsonify(id=orderID, status=orderStatus(order), total=round(order.calculateTotalPrice(), 2))
+
+# A whole basket in one request: {"mains": [...], "sides": [...], "drinks": [...]}
+# with each line as for the endpoints above. Every line is checked and all of
+# the stock taken together, then the order is checked out. Failures are listed
+# as {"section", "index", "msg"} and nothing is ordered.
+@app.route('/api/baskets', methods=["POST"])
+def apiSubmitBasket():
+    try:
+        data = body()
+        for section in ["mains", "sides", "drinks"]:
+            if not isinstance(data.get(section, []), list):
+                raise OrderError(section.capitalize() + " must be a list")
+        order = system.submitBasket(Basket(data.get("mains"), data.get("sides"), data.get("drinks")))
+    except BasketError as be:
+        return jsonify(error=be.msg, failures=be.failures), 400
+    except OrderError as oe:
+        return error(oe.msg)
+    writer.markDirty()   # persistence
+    return jsonify(id=order.ID, status=orderStatus(order), total=round(order.calculateTotalPrice(), 2)), 201
+
+'''
+Kitchen
+'''
+@app.route('/api/kitchen/orders')
+def apiActiveOrders():
+    return jsonify(orders=[orderJSON(order) for order in system.activeOrders])
+
+@app.route('/api/kitchen/orders/<int:orderID>/prepared', methods=["POST"])
+def apiPrepared(orderID):
+    order, failed = lookup(orderID)
+    if failed:
+        return failed
+    try:
+        system.orderPrepared(orderID)
+    except SystemError as se:
+        return error(se.msg, 409)
+    writer.markDirty()   # persistence
+    return jsonify(id=orderID, status="finished")
+
+'''
+Inventory
+'''
+@app.route('/api/inventory')
+def apiInventory():
+    return jsonify(ingredients=[{"name": ingredient.name, "quantity": ingredient.quantity, "unit": ingredient.unit,
+                                 "type": ingredient.iType.name.lower()} for ingredient in system.inventory.ingredients])
+
+# body is {name: change in stock}; negative changes take stock away
+@app.route('/api/inventory', methods=["PATCH"])
+def apiUpdateStock():
+    try:
+        changes = request.get_json(silent=True)
+        if not isinstance(changes, dict) or not all(isWhole(q) for q in changes.values()):
+            raise InventoryError("Expected ingredient names mapped to whole quantities")
+        system.inventory.updateInventory(changes)
+    except InventoryError as ie:
+        return error(ie.msg)
+    writer.markDirty()   # persistence
+    return jsonify(updated=sorted(changes))
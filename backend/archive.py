@@ -0,0 +1,107 @@
+from backend.snapshot import encodeOrder, decodeOrder
+import os
+import struct
+import threading
+import zlib
+
+# order ID and compressed length in front of each record
+RECORD = struct.Struct("<II")
+
+class ArchivePolicy:
+    # Finished orders are archived once more than maxFinished are held, or once
+    # they were prepared more than maxAge seconds ago. Either limit may be None.
+    def __init__(self, maxFinished=None, maxAge=None):
+        self._maxFinished = maxFinished
+        self._maxAge = maxAge
+
+    def select(self, count, orders, now):
+        # orders yields (ID, order) oldest first, count of them in all; the
+        # oldest are taken until one is within both limits
+        excess = count - self._maxFinished if self._maxFinished is not None else 0
+        selected = []
+        for i, (ID, order) in enumerate(orders):
+            if i >= excess:
+                if self._maxAge is None:
+                    break
+                # orders saved before prepared times were kept count as old
+                if order.preparedAt is not None and order.preparedAt >= now - self._maxAge:
+                    break
+            selected.append(order)
+        return selected
+
+class OrderArchive:
+    # Append-only file of finished orders moved out of memory, one compressed
+    # snapshot record each. Only the offsets are held in memory; an order is
+    # read back and decoded when it is looked up.
+    def __init__(self, path):
+        self._path = path
+        # order ID -> (offset, length) of its compressed payload
+        self._index = {}
+        self._lock = threading.Lock()
+        self._size = self._scan()
+        self._file = open(path, 'a+b')
+
+    def _scan(self):
+        try:
+            size = os.path.getsize(self._path)
+        except OSError:
+            return 0
+        offset = 0
+        with open(self._path, 'rb') as file:
+            while offset + RECORD.size <= size:
+                file.seek(offset)
+                ID, length = RECORD.unpack(file.read(RECORD.size))
+                if offset + RECORD.size + length > size:
+                    break
+                self._index[ID] = (offset + RECORD.size, length)
+                offset += RECORD.size + length
+        if offset < size:
+            # a crash mid-append leaves a torn last record; the orders in it were never removed
+            with open(self._path, 'r+b') as file:
+                file.truncate(offset)
+        return offset
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def count(self):
+        return len(self._index)
+
+    @property
+    def size(self):
+        return self._size
+
+    def __contains__(self, ID):
+        return ID in self._index
+
+    def append(self, orders):
+        # durable before returning, so the orders can then be dropped from memory
+        records = []
+        for order in orders:
+            payload = zlib.compress(encodeOrder(order))
+            records.append((order.ID, RECORD.pack(order.ID, len(payload)) + payload))
+        with self._lock:
+            offset = self._size
+            self._file.write(b"".join(record for ID, record in records))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            for ID, record in records:
+                self._index[ID] = (offset + RECORD.size, len(record) - RECORD.size)
+                offset += len(record)
+            self._size = offset
+
+    def get(self, ID, inventory):
+        # the archived order, or None
+        with self._lock:
+            position = self._index.get(ID)
+            if position is None:
+                return None
+            self._file.seek(position[0])
+            data = self._file.read(position[1])
+        return decodeOrder(inventory, ID, zlib.decompress(data))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
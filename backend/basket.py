@@ -0,0 +1,88 @@
+from backend.errors import InventoryError, OrderError, BasketError
+from backend.main import Main
+from backend.side import SideDrink
+from backend.recipes import recipes
+
+def isWhole(value):
+    # JSON true and false arrive as bools, which are ints to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+class Basket:
+    # A whole order built on the client: mains are {"recipe": name} or
+    # {"type": "burger" | "wrap", "ingredients": {name: quantity}}, sides and
+    # drinks are {"name": name, "quantity": n, "size": servingSize}.
+    def __init__(self, mains=None, sides=None, drinks=None):
+        self._mains = list(mains or [])
+        self._sides = list(sides or [])
+        self._drinks = list(drinks or [])
+
+    def resolve(self, inventory, book=recipes):
+        # Check every line and the stock for all of them together, without taking
+        # any. Returns the lines to add as (event, fields, line) and the units of
+        # stock they need; raises BasketError listing every problem found.
+        failures = []
+        lines = []
+        units = {}
+
+        def fail(section, index, msg):
+            failures.append({"section": section, "index": index, "msg": msg})
+
+        def need(resolved):
+            for name, (ingredient, q) in resolved.items():
+                held = units.get(name, (ingredient, 0))[1]
+                units[name] = (ingredient, held + q)
+
+        for i, main in enumerate(self._mains):
+            try:
+                if not isinstance(main, dict):
+                    raise OrderError("Main must be a recipe or a burger or wrap")
+                if "recipe" in main:
+                    recipe = book.get(str(main["recipe"]), inventory)
+                    recipe.raiseErrors()
+                    kind, ingredients, price, resolved = recipe.main, dict(recipe.ingredients), recipe.price, recipe.units
+                else:
+                    kind = main.get("type")
+                    ingredients = main.get("ingredients")
+                    if kind not in ["burger", "wrap"]:
+                        raise OrderError("Main type must be burger or wrap")
+                    if not isinstance(ingredients, dict) or not all(isWhole(q) for q in ingredients.values()):
+                        raise OrderError("Ingredients must map names to whole quantities")
+                    check = inventory.classifyMain(ingredients)
+                    check.raiseFirst(check.burgerErrors() if kind == "burger" else check.wrapErrors())
+                    price = check.price
+                    resolved = inventory._resolve(ingredients)
+            except (InventoryError, OrderError) as e:
+                fail("mains", i, e.msg)
+                continue
+            need(resolved)
+            lines.append(("main", {"main": kind, "ingredients": ingredients, "price": price},
+                          Main(ingredients, price)))
+
+        for section, event, items in [("sides", "side", self._sides), ("drinks", "drink", self._drinks)]:
+            for i, item in enumerate(items):
+                try:
+                    if not isinstance(item, dict):
+                        raise OrderError("Expected a name, quantity and size")
+                    name = str(item.get("name", ""))
+                    quantity = item.get("quantity", 1)
+                    size = str(item.get("size", "regular"))
+                    if not isWhole(quantity) or quantity < 1:
+                        raise OrderError("Quantity must be a whole number of at least 1")
+                    resolved = inventory._resolve([(name, quantity, size)])
+                except (InventoryError, OrderError) as e:
+                    fail(section, i, e.msg)
+                    continue
+                need(resolved)
+                ingredient = resolved[name.lower()][0]
+                price = ingredient.price * quantity * ingredient.servingSizes[size]
+                lines.append((event, {"name": name, "quantity": quantity, "size": size, "price": price},
+                              SideDrink(name, quantity, size, price)))
+
+        if not self._mains and not self._sides and not self._drinks:
+            fail("basket", None, "Must order before checkout")
+        for name, (ingredient, q) in units.items():
+            if q > ingredient.quantity:
+                fail("stock", None, "Insufficient stock for " + name)
+        if failures:
+            raise BasketError(failures)
+        return lines, units
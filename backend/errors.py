@@ -19,4 +19,14 @@ class SystemError(Exception):
 
     @property
     def msg(self):
-        return self._msg
\ No newline at end of file
+        return self._msg
+
+class BasketError(OrderError):
+    # every problem found with a basket, as {"section", "index", "msg"} dicts
+    def __init__(self, failures):
+        OrderError.__init__(self, failures[0]["msg"])
+        self._failures = failures
+
+    @property
+    def failures(self):
+        return self._failures
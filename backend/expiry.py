@@ -0,0 +1,102 @@
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    # A single worker thread servicing a min-heap of order deadlines, in place
+    # of one sleeping Timer thread per order. Cancelled deadlines are dropped
+    # lazily when they reach the top of the heap.
+    def __init__(self, callback):
+        self._callback = callback
+        # (deadline, orderID) entries, possibly stale
+        self._heap = []
+        # orderID -> deadline of its live heap entry
+        self._deadlines = {}
+        self._expired = 0
+        self._cancelled = 0
+        self._running = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    @property
+    def pending(self):
+        return len(self._deadlines)
+
+    def stats(self):
+        with self._cond:
+            nextDeadline = None
+            if self._deadlines:
+                nextDeadline = max(0, min(self._deadlines.values()) - time.monotonic())
+            return {"pending": len(self._deadlines), "heap": len(self._heap),
+                    "expired": self._expired, "cancelled": self._cancelled,
+                    "nextExpiry": nextDeadline}
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="order-expiry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def schedule(self, orderID, delay):
+        deadline = time.monotonic() + delay
+        with self._cond:
+            self._deadlines[orderID] = deadline
+            heapq.heappush(self._heap, (deadline, orderID))
+            # only wake the worker if this is now the earliest deadline
+            if self._heap[0][1] == orderID:
+                self._cond.notify()
+
+    def cancel(self, orderID):
+        # returns True if the order still had a pending deadline
+        with self._cond:
+            if self._deadlines.pop(orderID, None) is None:
+                return False
+            self._cancelled += 1
+            # rebuild once stale entries outnumber the live ones
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._heap = [(d, ID) for ID, d in self._deadlines.items()]
+                heapq.heapify(self._heap)
+            return True
+
+    def _popDue(self):
+        # called with the lock held; returns a due orderID, or None after waiting
+        while self._heap:
+            deadline, orderID = self._heap[0]
+            if self._deadlines.get(orderID) != deadline:
+                heapq.heappop(self._heap)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                self._cond.wait(remaining)
+                return None
+            heapq.heappop(self._heap)
+            del self._deadlines[orderID]
+            self._expired += 1
+            return orderID
+        self._cond.wait()
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                orderID = self._popDue()
+            if orderID is not None:
+                try:
+                    self._callback(orderID)
+                except Exception:
+                    logger.exception("Order %s expiry failed", orderID)
@@ -1,5 +1,11 @@
 from enum import Enum
+from contextlib import contextmanager
 from backend.errors import InventoryError, OrderError
+from backend.tracing import traced
+import threading
+
+# number of locks striped across ingredient stock
+STOCK_STRIPES = 16
 
 class IngredientType(Enum):
     BURGERBUN = 1
@@ -10,6 +16,9 @@ class IngredientType(Enum):
     DRINK = 6
 
 class Ingredient:
+    # set when the ingredient changes, until storage has written it out
+    _dirty = False
+
     def __init__(self, name, price, quantity, iType, servingSizes, unit="unit"):
         self._name = name.lower()
         self._price = price
@@ -17,6 +26,7 @@ class Ingredient:
         self._iType = iType
         self._servingSizes = servingSizes
         self._unit = unit
+        self._dirty = True
 
     @property
     def name(self):
@@ -42,6 +52,23 @@ class Ingredient:
     def unit(self):
         return self._unit
 
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def markClean(self):
+        self._dirty = False
+
+    @property
+    def servableSizes(self):
+        # serving sizes the stock can still fill
+        return [size for size, q in self._servingSizes.items() if self._quantity >= q]
+
+    def _menuState(self):
+        return self._quantity > 0, self.servableSizes
+
+    # Both return True when the change put the ingredient on or off the menu, or
+    # changed which serving sizes it can fill.
     def decreaseStock(self, size, quantity):
         if size == "regular":
             q = quantity
@@ -49,24 +76,313 @@ class Ingredient:
             q = quantity * self._servingSizes[size]
         if(q > self._quantity):
             raise InventoryError("Insufficient stock for " + self._name.lower())
-        self._quantity -= q    
+        before = self._menuState()
+        self._quantity -= q
+        self._dirty = True
+        return self._menuState() != before
 
     def addStock(self, quantity, size="regular"):
         if size == "regular":
             q = quantity
         else:
             q = quantity * self._servingSizes[size]
+        before = self._menuState()
         self._quantity += q
+        self._dirty = True
+        return self._menuState() != before
+
+class RuleViolation:
+    # one failed main rule; rule names the check, msg is shown to the customer
+    def __init__(self, rule, msg):
+        self._rule = rule
+        self._msg = msg
+
+    @property
+    def rule(self):
+        return self._rule
+
+    @property
+    def msg(self):
+        return self._msg
+
+    def raiseError(self):
+        if self._rule == "missing":
+            raise InventoryError(self._msg)
+        raise OrderError(self._msg)
+
+class MainCheck:
+    # The ingredients of a burger or wrap classified once into per-type tallies.
+    # Every main rule is evaluated from the tallies, so forms and orders can share
+    # one classification instead of each looking the ingredients up again.
+    def __init__(self, inventory, ingredients):
+        self._ingredients = ingredients
+        self._tallies = {}
+        # first missing or negative ingredient, in the order the customer listed them
+        self._itemError = None
+        self._missing = None
+        # price of the main at the current ingredient prices
+        self._price = 0
+        for name, quantity in ingredients.items():
+            try:
+                ingredient = inventory.getIngredient(name)
+            except InventoryError as ie:
+                if self._itemError is None:
+                    self._itemError = RuleViolation("missing", ie.msg)
+                    self._missing = self._itemError
+                continue
+            if quantity < 0 and self._itemError is None:
+                self._itemError = RuleViolation("negative", "Cannot enter negative quantity")
+            self._tallies[ingredient.iType] = self._tallies.get(ingredient.iType, 0) + quantity
+            if quantity > 0:
+                self._price += ingredient.price * quantity
+
+    @property
+    def ingredients(self):
+        return self._ingredients
+
+    @property
+    def price(self):
+        return self._price
+
+    def count(self, iType):
+        return self._tallies.get(iType, 0)
+
+    def itemErrors(self, missingOnly=False):
+        error = self._missing if missingOnly else self._itemError
+        return [error] if error is not None else []
+
+    def onlyOneErrors(self):
+        if self.count(IngredientType.BURGERBUN) > 0 and self.count(IngredientType.WRAP) > 0:
+            return [RuleViolation("onlyOne", "Cannot choose both burger and wrap")]
+        return []
+
+    def bunErrors(self):
+        buns = self.count(IngredientType.BURGERBUN)
+        patties = self.count(IngredientType.PATTY)
+        if patties <= 0:
+            maximumBuns = 2
+        else:
+            maximumBuns = patties + 1
+        if buns < 2 or buns > maximumBuns:
+            return [RuleViolation("bun", "Number of buns must be between 2 and " + str(maximumBuns))]
+        return []
+
+    def oneWrapErrors(self):
+        if self.count(IngredientType.WRAP) != 1:
+            return [RuleViolation("oneWrap", "Must select one wrap bread")]
+        return []
+
+    def burgerErrors(self):
+        return self.itemErrors() + self.onlyOneErrors() + self.bunErrors()
+
+    def wrapErrors(self):
+        return self.itemErrors() + self.onlyOneErrors() + self.oneWrapErrors()
+
+    def raiseFirst(self, errors):
+        if errors:
+            errors[0].raiseError()
+
+class Menu:
+    # What customers can order at one inventory version: the ingredients in
+    # stock by type, each with the serving sizes it can still fill
+    def __init__(self, version, ingredients):
+        self._version = version
+        self._items = {}
+        for ingredient in ingredients:
+            if ingredient.quantity > 0:
+                self._items.setdefault(ingredient.iType, []).append((ingredient, ingredient.servableSizes))
+
+    @property
+    def version(self):
+        return self._version
+
+    def items(self, iType):
+        # [(ingredient, servable sizes)] in catalog order
+        return self._items.get(iType, [])
+
+    def has(self, iType):
+        return any(sizes for ingredient, sizes in self.items(iType))
+
+class StockView:
+    # One request's view of the stock. Each ingredient is looked up and its
+    # quantity read once, the first time the request asks for it; forms validate
+    # against the view and orders add burgers, wraps, sides and drinks through it
+    # in place of the inventory, so a request never looks an ingredient up twice.
+    # Stock is still taken by the inventory's reservations, which check the live
+    # quantities under the stock locks, so stock sold by another request after
+    # validation is never oversold.
+    def __init__(self, inventory):
+        self._inventory = inventory
+        # lowered name -> Ingredient, or the InventoryError looking it up raised
+        self._ingredients = {}
+        # lowered name -> quantity when the request first asked for it
+        self._quantities = {}
+
+    def getIngredient(self, name):
+        key = name.lower()
+        found = self._ingredients.get(key)
+        if found is None:
+            try:
+                found = self._inventory.getIngredient(name)
+            except InventoryError as ie:
+                found = ie
+            else:
+                self._quantities[key] = found.quantity
+            self._ingredients[key] = found
+        if isinstance(found, InventoryError):
+            raise found
+        return found
+
+    def quantity(self, name):
+        self.getIngredient(name)
+        return self._quantities[name.lower()]
+
+    def checkSufficientStock(self, name, quantity, servingSize='regular'):
+        ingredient = self.getIngredient(name)
+        return self.quantity(name) >= quantity*ingredient.servingSizes[servingSize]
+
+    @traced("inventory.classifyMain")
+    def classifyMain(self, ingredients):
+        return MainCheck(self, ingredients)
+
+    def _resolve(self, items):
+        return resolveUnits(items, self.getIngredient)
+
+    def reserve(self, items, token=None):
+        return self.reserveResolved(self._resolve(items), token)
+
+    def reserveResolved(self, units, token=None):
+        return self._inventory.reserveResolved(units, token)
+
+def resolveUnits(items, getIngredient):
+    # single pass over the items: look each ingredient up once, check its serving
+    # size and total the units wanted per ingredient
+    if isinstance(items, dict):
+        items = [(name, quantity, "regular") for name, quantity in items.items()]
+    units = {}
+    for name, quantity, size in items:
+        ingredient = getIngredient(name)
+        if size not in ingredient.servingSizes:
+            raise InventoryError("Incorrect serving size for " + name.lower())
+        if quantity < 0:
+            raise InventoryError("Cannot take negative quantity of " + name.lower())
+        if size == "regular":
+            q = quantity
+        else:
+            q = quantity * ingredient.servingSizes[size]
+        held = units.get(ingredient.name, (ingredient, 0))[1]
+        units[ingredient.name] = (ingredient, held + q)
+    return units
 
 class Inventory:
+    # called as listener(event, ...) after staff changes to the catalog; set by RestaurantSystem
+    _listener = None
+
     def __init__(self):
-        self._ingredients = []
+        # catalog of ingredients keyed by normalised name, kept in insertion order
+        self._catalog = {}
+        # secondary indexes: IngredientType -> {name: ingredient}, unit -> {name: ingredient}
+        self._byType = {}
+        self._byUnit = {}
+        # bumped whenever the catalog changes, so compiled recipes know when to recompile
+        self._catalogVersion = 0
+        # bumped on catalog changes and whenever stock puts an ingredient on or off the
+        # menu, so the menu is only worked out again when it can have changed
+        self._version = 0
+        self._menu = None
+        # stock held for unpaid orders: token -> {ingredient name: units}
+        self._reservations = {}
+        self._nextToken = 1
+        self._initLocks()
+
+    def _initLocks(self):
+        # stock changes hold the stripe of every ingredient they touch, taken in
+        # index order so concurrent multi-ingredient updates cannot deadlock
+        self._stripes = [threading.Lock() for i in range(STOCK_STRIPES)]
+        self._catalogLock = threading.Lock()
+        self._reservationLock = threading.Lock()
+        self._versionLock = threading.Lock()
+
+    @contextmanager
+    def _lockStock(self, names):
+        stripes = sorted(set(hash(name.lower()) % STOCK_STRIPES for name in names))
+        for i in stripes:
+            self._stripes[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(stripes):
+                self._stripes[i].release()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ['_listener', '_stripes', '_catalogLock', '_reservationLock', '_versionLock', '_menu']:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        # system.dat files written before the catalog stored a plain list
+        legacy = state.pop('_ingredients', None)
+        self.__dict__.update(state)
+        if '_catalogVersion' not in state:
+            self._catalogVersion = 0
+        if '_version' not in state:
+            self._version = 0
+        self._menu = None
+        self._initLocks()
+        if legacy is not None:
+            self._catalog = {}
+            self._byType = {}
+            self._byUnit = {}
+            for ingredient in legacy:
+                self._index(ingredient)
+        if '_reservations' not in state:
+            self._reservations = {}
+            self._nextToken = 1
+
+    def _index(self, ingredient):
+        self._catalog[ingredient.name] = ingredient
+        self._byType.setdefault(ingredient.iType, {})[ingredient.name] = ingredient
+        self._byUnit.setdefault(ingredient.unit, {})[ingredient.name] = ingredient
+        self._catalogVersion += 1
+        self._menuChanged()
+
+    @property
+    def catalogVersion(self):
+        return self._catalogVersion
+
+    @property
+    def version(self):
+        return self._version
+
+    def _menuChanged(self):
+        with self._versionLock:
+            self._version += 1
+
+    def menu(self):
+        # the Menu for the current version, worked out once per version
+        menu = self._menu
+        version = self._version
+        if menu is None or menu.version != version:
+            # read the version first: a change while building bumps it again
+            menu = Menu(version, self.ingredients)
+            self._menu = menu
+        return menu
 
     def getIngredient(self, name):
-        for ingredient in self._ingredients:
-            if ingredient.name.lower() == name.lower():
-                return ingredient
-        raise InventoryError(name.capitalize() + " does not exist")
+        try:
+            return self._catalog[name.lower()]
+        except KeyError:
+            raise InventoryError(name.capitalize() + " does not exist")
+
+    def hasIngredient(self, name):
+        return name.lower() in self._catalog
+
+    def getIngredientsByType(self, iType):
+        return list(self._byType.get(iType, {}).values())
+
+    def getIngredientsByUnit(self, unit):
+        return list(self._byUnit.get(unit, {}).values())
 
     def addIngredient(self, name, price, quantity, iType, servingSizes, unit="unit"):
         allowedUnits = ["g", "ml", "unit"]
@@ -95,25 +411,103 @@ class Inventory:
         if iType in regularTypes and unit != "unit":
             raise InventoryError(iType.name.capitalize() + " must be stored as unit")
 
-        for ingredient in self._ingredients:
-            if ingredient.name.lower() == name.lower():
+        with self._catalogLock:
+            if self.hasIngredient(name):
                 raise InventoryError(name.lower() + " already exists")
-        ingredient = Ingredient(name, price, quantity, iType, servingSizes, unit)
-        self._ingredients.append(ingredient)
+            ingredient = Ingredient(name, price, quantity, iType, servingSizes, unit)
+            self._index(ingredient)
+            self._notify("ingredient", name=name, price=price, quantity=quantity, iType=iType.value,
+                         servingSizes=servingSizes, unit=unit)
+
+    def _notify(self, event, **data):
+        if self._listener is not None:
+            self._listener(event, **data)
+
+    def _resolve(self, items):
+        return resolveUnits(items, self.getIngredient)
+
+    def view(self):
+        # a StockView for one request
+        return StockView(self)
+
+    def reserve(self, items, token=None):
+        # Take stock for every item or for none of them and hold it under a token.
+        # items is {name: quantity} for regular servings, or (name, quantity, servingSize)
+        # tuples. Passing an existing token adds the items to that reservation.
+        return self.reserveResolved(self._resolve(items), token)
+
+    @traced("inventory.reserve")
+    def reserveResolved(self, units, token=None):
+        # reserve for items already resolved into {name: (ingredient, units)}
+        if token is not None and token not in self._reservations:
+            raise InventoryError("Unknown stock reservation")
+        with self._lockStock(units):
+            for name, (ingredient, q) in units.items():
+                if q > ingredient.quantity:
+                    raise InventoryError("Insufficient stock for " + name)
+            changed = False
+            for ingredient, q in units.values():
+                changed = ingredient.decreaseStock("regular", q) or changed
+            if changed:
+                self._menuChanged()
+            with self._reservationLock:
+                if token is None:
+                    token = self._nextToken
+                    self._nextToken += 1
+                    self._reservations[token] = {}
+                held = self._reservations[token]
+                for name, (ingredient, q) in units.items():
+                    held[name] = held.get(name, 0) + q
+        return token
+
+    def restoreReservation(self, units):
+        # hold stock that already left the catalog, for orders rebuilt from storage
+        with self._reservationLock:
+            token = self._nextToken
+            self._nextToken += 1
+            self._reservations[token] = {name: q for name, (ingredient, q) in units.items()}
+        return token
+
+    def commit(self, token):
+        # the reserved stock has been sold; it simply stops being returnable
+        with self._reservationLock:
+            if self._reservations.pop(token, None) is None:
+                raise InventoryError("Unknown stock reservation")
+
+    def release(self, token):
+        # give all of the reserved stock back in one step
+        with self._reservationLock:
+            held = self._reservations.pop(token, None)
+        if held is None:
+            raise InventoryError("Unknown stock reservation")
+        with self._lockStock(held):
+            changed = False
+            for name, q in held.items():
+                changed = self._catalog[name].addStock(q) or changed
+            if changed:
+                self._menuChanged()
+
+    def getReserved(self, name):
+        # units of an ingredient currently held for unpaid orders
+        key = name.lower()
+        with self._reservationLock:
+            return sum(held.get(key, 0) for held in self._reservations.values())
 
     def updateStockSide(self, name, quantity, servingSize="regular"):
-        ingredient = self.getIngredient(name)
-        if servingSize not in ingredient.servingSizes:
-            raise InventoryError("Incorrect serving size for " + name.lower())
-        return ingredient.decreaseStock(servingSize, quantity)
+        self.commit(self.reserve([(name, quantity, servingSize)]))
 
     def updateStockMain(self, ingredients):
-        for name, quantity in ingredients.items():
-            if self.checkSufficientStock(name, quantity) == False:
-                raise InventoryError("Insufficient stock for " + name.lower())
-        for name, quantity in ingredients.items():
-            ingredient = self.getIngredient(name)
-            ingredient.decreaseStock("regular", quantity)
+        self.commit(self.reserve(ingredients))
+
+    def restock(self, items):
+        # return stock taken by an order; items are (name, quantity, servingSize)
+        resolved = [(self.getIngredient(name), quantity, size) for name, quantity, size in items]
+        with self._lockStock([ingredient.name for ingredient, quantity, size in resolved]):
+            changed = False
+            for ingredient, quantity, size in resolved:
+                changed = ingredient.addStock(quantity, size) or changed
+            if changed:
+                self._menuChanged()
 
     def checkSufficientStock(self, name, quantity, servingSize='regular'):
         ingredient = self.getIngredient(name)
@@ -123,70 +517,55 @@ class Inventory:
 
     @property
     def ingredients(self):
-        return self._ingredients
+        return list(self._catalog.values())
+
+    @traced("inventory.classifyMain")
+    def classifyMain(self, ingredients):
+        return MainCheck(self, ingredients)
 
     def isBurgerValid(self, ingredients):
         # check burger order is valid
-        self.checkNegativeQuantity(ingredients)
-        self.checkOnlyBurgerOrWrap(ingredients)
-        self.checkBunNumber(ingredients)
+        check = self.classifyMain(ingredients)
+        check.raiseFirst(check.burgerErrors())
 
     def isWrapValid(self, ingredients):
         # check wrap order is valid
-        self.checkNegativeQuantity(ingredients)
-        self.checkOnlyBurgerOrWrap(ingredients)
-        self.checkOnlyOneWrap(ingredients)
+        check = self.classifyMain(ingredients)
+        check.raiseFirst(check.wrapErrors())
 
     def checkOnlyBurgerOrWrap(self, ingredients):
-        buns = 0
-        wraps = 0
-        for name, quantity in ingredients.items():
-            ingredient = self.getIngredient(name)
-            if ingredient.iType == IngredientType.BURGERBUN:
-                buns += quantity
-            elif ingredient.iType == IngredientType.WRAP:
-                wraps += quantity
-            
-            if buns > 0 and wraps > 0:
-                raise OrderError("Cannot choose both burger and wrap")
+        check = self.classifyMain(ingredients)
+        check.raiseFirst(check.itemErrors(missingOnly=True) + check.onlyOneErrors())
 
     def checkOnlyOneWrap(self, ingredients):
-        wraps = 0
-        for name, quantity in ingredients.items():
-            ingredient = self.getIngredient(name)
-            if ingredient.iType == IngredientType.WRAP:
-                wraps += quantity
-        if wraps != 1:
-            raise OrderError("Must select one wrap bread")
+        check = self.classifyMain(ingredients)
+        check.raiseFirst(check.itemErrors(missingOnly=True) + check.oneWrapErrors())
 
     def checkBunNumber(self, ingredients):
-        buns = 0
-        patties = 0
-        for name, quantity in ingredients.items():
-            ingredient = self.getIngredient(name)
-            if ingredient.iType == IngredientType.BURGERBUN:
-                buns += quantity
-            elif ingredient.iType == IngredientType.PATTY:
-                patties += quantity
-        if patties <= 0:
-            maximumBuns = 2
-        else:
-            maximumBuns = patties + 1
-        if buns < 2 or buns > maximumBuns:
-            print(buns, maximumBuns)
-            msg = "Number of buns must be between 2 and " + str(maximumBuns)
-            raise OrderError(msg)
+        check = self.classifyMain(ingredients)
+        check.raiseFirst(check.itemErrors(missingOnly=True) + check.bunErrors())
 
     def checkNegativeQuantity(self, ingredients):
-        for name, quantity in ingredients.items():
-            ingredient = self.getIngredient(name)
-            if quantity < 0:
-                raise OrderError("Cannot enter negative quantity")
+        check = self.classifyMain(ingredients)
+        check.raiseFirst(check.itemErrors())
 
     def updateInventory(self, ingredients):
-        for name, quantity in ingredients.items():
-            ingredient = self.getIngredient(name)
-            if quantity > 0:
-                ingredient.addStock(quantity)
-            elif quantity < 0:
-                ingredient.decreaseStock("regular", abs(quantity))
+        resolved = {name: self.getIngredient(name) for name in ingredients}
+        with self._lockStock(ingredients):
+            # validate every removal first so a failed update leaves stock untouched
+            for name, quantity in ingredients.items():
+                ingredient = resolved[name]
+                if quantity < 0 and abs(quantity) > ingredient.quantity:
+                    raise InventoryError("Insufficient stock for " + ingredient.name)
+            # journalled before applying, so an order that relies on this restock
+            # is always replayed after it
+            self._notify("stock", ingredients=ingredients)
+            changed = False
+            for name, quantity in ingredients.items():
+                ingredient = resolved[name]
+                if quantity > 0:
+                    changed = ingredient.addStock(quantity) or changed
+                elif quantity < 0:
+                    changed = ingredient.decreaseStock("regular", abs(quantity)) or changed
+            if changed:
+                self._menuChanged()
@@ -0,0 +1,76 @@
+import json
+import os
+
+class Journal:
+    # Append-only log of domain events, one JSON object per line.
+    # Each event carries a sequence number so replay can skip events
+    # that are already contained in the snapshot.
+    def __init__(self, path, sync=True):
+        self._path = path
+        self._sync = sync
+        self._file = None
+        self._length = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def length(self):
+        # number of events written since the journal was last truncated
+        return self._length
+
+    def replay(self):
+        events = []
+        valid = 0
+        torn = False
+        try:
+            with open(self._path, 'rb') as file:
+                for line in file:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError
+                        events.append(json.loads(line))
+                    except ValueError:
+                        # a crash mid-append leaves a torn last line, which was never acknowledged
+                        torn = True
+                        break
+                    valid += len(line)
+        except IOError:
+            pass
+        if torn:
+            # cut the torn line off so later appends start on a clean line
+            with open(self._path, 'r+b') as file:
+                file.truncate(valid)
+        self._length = len(events)
+        return events
+
+    def append(self, events):
+        if not events:
+            return
+        if self._file is None:
+            self._file = open(self._path, 'a')
+        lines = [json.dumps(event, separators=(',', ':')) for event in events]
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        if self._sync:
+            os.fsync(self._file.fileno())
+        self._length += len(events)
+
+    def rotate(self, path):
+        # move the current journal aside so new events start a fresh file
+        self.close()
+        if os.path.exists(self._path):
+            os.replace(self._path, path)
+        self._length = 0
+
+    def truncate(self):
+        self.close()
+        with open(self._path, 'w'):
+            pass
+        self._length = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,20 +1,26 @@
 from backend.inventory import Inventory, Ingredient
 
 class Main:
-    def __init__(self, ingredients):
+    # price captured when the main was added; None for mains saved before that
+    _price = None
+
+    def __init__(self, ingredients, price=None):
         self._ingredients = ingredients
+        self._price = price
 
     @property
     def ingredients(self):
         return self._ingredients
 
-    def calculateCost(self, inventory):
-        cost = 0
-        for name, quantity in self._ingredients.items():
-            if quantity > 0:
-                ingredient = inventory.getIngredient(name)
-                cost += ingredient.price * quantity
-        return cost
+    def calculateCost(self, inventory=None):
+        if self._price is None:
+            cost = 0
+            for name, quantity in self._ingredients.items():
+                if quantity > 0:
+                    ingredient = inventory.getIngredient(name)
+                    cost += ingredient.price * quantity
+            self._price = cost
+        return self._price
 
     def __str__(self):
         parts = []
@@ -0,0 +1,225 @@
+from bisect import bisect_left
+from functools import wraps
+import threading
+import time
+
+# In-process instrumentation, cheap enough to leave on: recording a value is a
+# bisect and a few additions under a per-metric lock. Everything is read back
+# in the Prometheus text format by Registry.render.
+
+# upper bounds in seconds; 1ms to 10s covers everything from a cached page to a
+# snapshot save
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+def _labelText(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    # a count per label values that only goes up
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def help(self):
+        return self._help
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self._name, _labelText(self._labels, labels), value) for labels, value in values]
+
+class Gauge:
+    # a value read when metrics are collected: read() returns a number, or with
+    # labels a {label values: number} dict. Counts kept elsewhere are read the
+    # same way, as kind "counter".
+    def __init__(self, name, help, read, labels=(), kind="gauge"):
+        self.kind = kind
+        self._name = name
+        self._help = help
+        self._read = read
+        self._labels = tuple(labels)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def help(self):
+        return self._help
+
+    def samples(self):
+        values = self._read()
+        if not self._labels:
+            return [(self._name, "", values)]
+        return [(self._name, _labelText(self._labels, labels), value) for labels, value in values.items()]
+
+class Histogram:
+    # counts of observed values per bucket for each label values; the
+    # quantiles are estimated from the buckets, as Prometheus does
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+        self._bounds = tuple(buckets)
+        # label values -> [per bucket counts (last is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def help(self):
+        return self._help
+
+    def observe(self, value, *labels):
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self._bounds) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, function, *labels):
+        # wraps function so every call is observed
+        @wraps(function)
+        def timed(*args, **kwargs):
+            began = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - began, *labels)
+        return timed
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series is not None else 0
+
+    def quantile(self, q, *labels):
+        # linear interpolation within the bucket holding the q-th observation;
+        # None before anything is observed
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None or series[2] == 0:
+                return None
+            buckets, total = list(series[0]), series[2]
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(buckets):
+            if n and seen + n >= rank:
+                if i == len(self._bounds):
+                    # beyond the largest bucket: the best answer is its bound
+                    return self._bounds[-1]
+                lower = self._bounds[i - 1] if i > 0 else 0.0
+                return lower + (self._bounds[i] - lower) * (rank - seen) / n
+            seen += n
+        return self._bounds[-1]
+
+    def samples(self):
+        with self._lock:
+            series = [(labels, list(buckets), total, count) for labels, (buckets, total, count) in self._series.items()]
+        samples = []
+        for labels, buckets, total, count in series:
+            cumulative = 0
+            for bound, n in zip(self._bounds + (float("inf"),), buckets):
+                cumulative += n
+                samples.append((self._name + "_bucket", _labelText(self._labels + ("le",), labels + (_number(bound),)),
+                                cumulative))
+            samples.append((self._name + "_sum", _labelText(self._labels, labels), total))
+            samples.append((self._name + "_count", _labelText(self._labels, labels), count))
+        return samples
+
+    def quantileSamples(self):
+        # p50/p95/p99 per label values, for dashboards that do not compute them
+        samples = []
+        for labels in list(self._series):
+            for q in QUANTILES:
+                value = self.quantile(q, *labels)
+                if value is not None:
+                    samples.append((_labelText(self._labels + ("quantile",), labels + (str(q),)), value))
+        return samples
+
+class Registry:
+    # every metric of the process, rendered in registration order
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError("Metric " + metric.name + " is already registered")
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, read, labels=()):
+        return self._add(Gauge(name, help, read, labels))
+
+    def counterFunction(self, name, help, read, labels=()):
+        # a counter whose value is read from read() when collected
+        return self._add(Gauge(name, help, read, labels, "counter"))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, _number(value)))
+            if metric.kind == "histogram":
+                quantiles = metric.quantileSamples()
+                if quantiles:
+                    name = metric.name + "_quantile"
+                    lines.append("# HELP {} Estimated p50, p95 and p99 of {}".format(name, metric.name))
+                    lines.append("# TYPE {} gauge".format(name))
+                    for labels, value in quantiles:
+                        lines.append("{}{} {}".format(name, labels, _number(value)))
+        return "\n".join(lines) + "\n"
+
+# the registry /metrics reports
+registry = Registry()
@@ -2,14 +2,67 @@ from backend.inventory import Inventory, Ingredient, IngredientType
 from backend.errors import OrderError
 from backend.main import Main
 from backend.side import SideDrink
+from backend.recipes import recipes
+from backend.tracing import traced
+import threading
+import time
 
 class Order:
+    # called as listener(event, order=ID, ...) after each change; set by RestaurantSystem
+    _listener = None
+    # orders saved before stock reservations took stock from the inventory directly
+    _legacyStock = False
+    # time the order was prepared; None until then, and for orders saved before it was kept
+    _preparedAt = None
+    # set when the order changes, until storage has written it out
+    _dirty = False
+    # set once the order is cancelled; stale references to it can no longer change it
+    _cancelled = False
+
     def __init__(self, ID):
         self._ID = ID
         self._prepared = False
         self._paid = False
         self._mains = []
         self._sidesAndDrinks = []
+        # running total of the prices captured as each line was added
+        self._total = 0
+        # inventory reservation token holding the stock for this unpaid order
+        self._reservation = None
+        # serialises changes to this order (adding items, checkout, cancel)
+        self._lock = threading.RLock()
+        self._dirty = True
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_listener', None)
+        state.pop('_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_reservation' not in state:
+            self._reservation = None
+            self._legacyStock = True
+        if '_total' not in state:
+            # totalled from the inventory on first use
+            self._total = None
+        self._lock = threading.RLock()
+
+    @property
+    def lock(self):
+        return self._lock
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def markClean(self):
+        self._dirty = False
+
+    def _notify(self, event, **data):
+        if self._listener is not None:
+            self._listener(event, order=self._ID, **data)
 
     @property
     def ID(self):
@@ -26,8 +79,15 @@ class Order:
     def prepared(self):
         return self._prepared
 
-    def updatePrepared(self):
-        self._prepared = True
+    @property
+    def preparedAt(self):
+        return self._preparedAt
+
+    def updatePrepared(self, at=None):
+        with self._lock:
+            self._prepared = True
+            self._preparedAt = time.time() if at is None else at
+            self._dirty = True
 
     @property
     def mainOrders(self):
@@ -38,79 +98,169 @@ class Order:
         return self._sidesAndDrinks
 
     def cancel(self, inventory):
+        with self._lock:
+            self._cancelled = True
+            if self._reservation is not None:
+                inventory.release(self._reservation)
+                self._reservation = None
+            elif self._legacyStock:
+                inventory.restock(self.stockItems())
+        return "Order cancelled" 
+
+    def stockItems(self):
+        # (name, quantity, servingSize) for all the stock the lines of this order took
+        items = []
         for main in self._mains:
             for name, quantity in main.ingredients.items():
-                ingredient = inventory.getIngredient(name)
-                ingredient.addStock(quantity)
+                items.append((name, quantity, "regular"))
         for side in self._sidesAndDrinks:
-            ingredient = inventory.getIngredient(side.name)
-            ingredient.addStock(side.quantity, side.servingSize)
-        return "Order cancelled" 
-    
-    def addBurgerMain(self, inventory, ingredients):
+            items.append((side.name, side.quantity, side.servingSize))
+        return items
+
+    @classmethod
+    def restore(cls, inventory, ID, paid, prepared, mains, sidesAndDrinks, total, preparedAt=None):
+        # rebuild an order from storage; an unpaid one still holds the stock its lines took
+        order = cls(ID)
+        order._paid = paid
+        order._prepared = prepared
+        order._preparedAt = preparedAt
+        order._mains = mains
+        order._sidesAndDrinks = sidesAndDrinks
+        order._total = total
+        order._dirty = False
+        if not paid:
+            order._reservation = inventory.restoreReservation(inventory._resolve(order.stockItems()))
+        return order
+
+    def commitStock(self, inventory):
+        # called once the order is paid: the reserved stock is now sold
+        with self._lock:
+            if self._reservation is not None:
+                inventory.commit(self._reservation)
+                self._reservation = None
+
+    def _checkOpen(self):
+        # called with the order lock held, before anything is reserved or journalled
+        if self._cancelled:
+            raise OrderError("Order has been cancelled, please start new order.")
         if self.paid == True:
             raise OrderError("Order is already complete, please start new order.")
-        # check burger order is valid
-        inventory.isBurgerValid(ingredients)
-        inventory.updateStockMain(ingredients)
-        self._mains.append(Main(ingredients))
+
+    def addBurgerMain(self, inventory, ingredients, check=None):
+        # check is the MainCheck a form already classified these ingredients into
+        with self._lock:
+            self._checkOpen()
+            # check burger order is valid
+            if check is None:
+                check = inventory.classifyMain(ingredients)
+            check.raiseFirst(check.burgerErrors())
+            self._reservation = inventory.reserve(ingredients, self._reservation)
+            self._addLine(self._mains, Main(ingredients, check.price))
+            self._notify("main", main="burger", ingredients=ingredients, price=check.price)
         return "Main added to order"
 
     def addStandardBurger(self, inventory):
-        ingredients = {"sesame bun":2,"beef":1,"tomato":1, "cheddar cheese":1}
-        msg = self.addBurgerMain(inventory, ingredients)
-        return msg
+        return self.addRecipe(inventory, "standard burger")
 
-    def addWrapMain(self, inventory, ingredients):
-        if self.paid == True:
-            raise OrderError("Order is already complete, please start new order.")
-        # check wrap order is valid
-        inventory.isWrapValid(ingredients)
-        inventory.updateStockMain(ingredients)
-        self._mains.append(Main(ingredients))
+    def addWrapMain(self, inventory, ingredients, check=None):
+        # check is the MainCheck a form already classified these ingredients into
+        with self._lock:
+            self._checkOpen()
+            # check wrap order is valid
+            if check is None:
+                check = inventory.classifyMain(ingredients)
+            check.raiseFirst(check.wrapErrors())
+            self._reservation = inventory.reserve(ingredients, self._reservation)
+            self._addLine(self._mains, Main(ingredients, check.price))
+            self._notify("main", main="wrap", ingredients=ingredients, price=check.price)
         return "Main added to order"
 
     def addStandardWrap(self, inventory):
-        ingredients = {"flatbread":1, "chicken":1, "lettuce":1, "cheddar cheese":1}
-        msg = self.addWrapMain(inventory, ingredients)
-        return msg
+        return self.addRecipe(inventory, "standard wrap")
+
+    def addRecipe(self, inventory, name, book=recipes):
+        # standard items are validated when the recipe is compiled, so all that
+        # is left to do here is reserve the stock
+        recipe = book.get(name, inventory)
+        with self._lock:
+            self._checkOpen()
+            recipe.raiseErrors()
+            self._reservation = inventory.reserveResolved(recipe.units, self._reservation)
+            self._addLine(self._mains, Main(dict(recipe.ingredients), recipe.price))
+            self._notify("main", main=recipe.main, ingredients=recipe.ingredients, price=recipe.price)
+        return "Main added to order"
 
     def addSide(self, inventory, name, quantity, size):
-        if self.paid == True:
-            raise OrderError("Order is already complete, please start new order.")
-        if quantity < 0:
-                raise OrderError("Cannot enter negative quantity")
-        inventory.updateStockSide(name, quantity, size)
-        self._sidesAndDrinks.append(SideDrink(name, quantity, size))  
+        with self._lock:
+            self._checkOpen()
+            if quantity < 0:
+                    raise OrderError("Cannot enter negative quantity")
+            units = inventory._resolve([(name, quantity, size)])
+            self._reservation = inventory.reserveResolved(units, self._reservation)
+            ingredient = units[name.lower()][0]
+            price = ingredient.price * quantity * ingredient.servingSizes[size]
+            self._addLine(self._sidesAndDrinks, SideDrink(name, quantity, size, price))
+            self._notify("side", name=name, quantity=quantity, size=size, price=price)
         return "Sides added to order"
 
     def addDrink(self, inventory, name, quantity, size):
-        if self.paid == True:
-            raise OrderError("Order is already complete, please start new order.")
-        if quantity < 0:
-                raise OrderError("Cannot enter negative quantity")
-        inventory.updateStockSide(name, quantity, size)
-        self._sidesAndDrinks.append(SideDrink(name, quantity, size))  
+        with self._lock:
+            self._checkOpen()
+            if quantity < 0:
+                    raise OrderError("Cannot enter negative quantity")
+            units = inventory._resolve([(name, quantity, size)])
+            self._reservation = inventory.reserveResolved(units, self._reservation)
+            ingredient = units[name.lower()][0]
+            price = ingredient.price * quantity * ingredient.servingSizes[size]
+            self._addLine(self._sidesAndDrinks, SideDrink(name, quantity, size, price))
+            self._notify("drink", name=name, quantity=quantity, size=size, price=price)
         return "Drinks added to order"
 
-    def calculateTotalPrice(self, inventory):
-        cost = 0
-        for main in self._mains:
-            cost += main.calculateCost(inventory)
-        for side in self._sidesAndDrinks:
-            cost += side.calculateCost(inventory)
-        return cost        
+    def addLines(self, lines, token):
+        # lines of a new order already checked and priced by a Basket, as
+        # (event, fields, line), with their stock held under the reservation token
+        with self._lock:
+            if self._cancelled or self.paid == True or self._reservation is not None:
+                raise OrderError("Basket lines can only be added to a new order")
+            self._reservation = token
+            for event, fields, line in lines:
+                self._addLine(self._mains if event == "main" else self._sidesAndDrinks, line)
+                self._notify(event, **fields)
+
+    def _addLine(self, lines, line):
+        # called with the order lock held
+        lines.append(line)
+        self._dirty = True
+        if self._total is not None:
+            self._total += line.calculateCost()
+
+    @traced("order.calculateTotalPrice")
+    def calculateTotalPrice(self, inventory=None):
+        # inventory is only needed for orders saved before line prices were captured
+        if self._total is None:
+            with self._lock:
+                cost = 0
+                for main in self._mains:
+                    cost += main.calculateCost(inventory)
+                for side in self._sidesAndDrinks:
+                    cost += side.calculateCost(inventory)
+                self._total = cost
+        return self._total
 
     def submitAndPay(self, payStatus):
         #customer will be lead to external payment system
         #payment system will return boolean value to indicate successful
         #or unsuccessful payment
-        if len(self.mainOrders) == 0 and len(self.sidesAndDrinks) == 0:
-            raise OrderError("Must order before checkout")
-        if payStatus == True:
-            self._paid = True
-        else:
-            raise OrderError("Payment unsuccessful")
+        with self._lock:
+            if self._cancelled:
+                raise OrderError("Order has been cancelled, please start new order.")
+            if len(self.mainOrders) == 0 and len(self.sidesAndDrinks) == 0:
+                raise OrderError("Must order before checkout")
+            if payStatus == True:
+                self._paid = True
+                self._dirty = True
+            else:
+                raise OrderError("Payment unsuccessful")
 
     def displayOrder(self, inventory):
         parts = []
@@ -0,0 +1,177 @@
+from backend.order import Order
+from backend.main import Main
+from backend.side import SideDrink
+from backend.inventory import Ingredient
+from collections import Counter
+import cProfile
+import gc
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# On-demand diagnosis of a running process: where its threads spend their
+# time, and what its memory is held in. Nothing here costs anything until a
+# capture is asked for.
+
+# stack frames that mean a thread is idle, waiting for work, rather than busy
+IDLE_FILES = ("threading.py", "selectors.py", "socketserver.py", "socket.py", "queue.py")
+IDLE_FUNCTIONS = {"wait", "select", "accept", "poll", "get", "readinto", "serve_forever", "_wait_for_tstate_lock"}
+
+# the backend objects memory snapshots count
+TRACKED_TYPES = (Order, Main, SideDrink, Ingredient)
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _where(frame):
+    code = frame.f_code
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+def _function(where, **counts):
+    filename, line, name = where
+    entry = {"function": name, "file": filename, "line": line}
+    entry.update(counts)
+    return entry
+
+def _idle(frame):
+    return frame.f_code.co_name in IDLE_FUNCTIONS and frame.f_code.co_filename.endswith(IDLE_FILES)
+
+def sampleStacks(seconds, interval=0.005, top=20):
+    # Samples the stack of every other thread each interval for seconds. A
+    # function's "self" samples are those it was running in; "total" counts
+    # the samples it was anywhere on the stack.
+    me = threading.get_ident()
+    own = Counter()
+    total = Counter()
+    samples = idle = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if _idle(frame):
+                idle += 1
+                continue
+            samples += 1
+            own[_where(frame)] += 1
+            seen = set()
+            while frame is not None:
+                where = _where(frame)
+                if where not in seen:
+                    seen.add(where)
+                    total[where] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+    functions = [_function(where, self=n, total=total[where], share=round(n / samples, 4))
+                 for where, n in own.most_common(top)]
+    return {"mode": "sample", "seconds": seconds, "samples": samples, "idleSamples": idle, "functions": functions}
+
+class RequestProfiler:
+    # cProfile of every request handled while a capture is running, merged into
+    # one set of stats. The app calls begin() and end() around each request.
+    def __init__(self):
+        # set while a capture is running
+        self._running = threading.Event()
+        self._stats = None
+        self._requests = 0
+        self._skipped = 0
+        self._lock = threading.Lock()
+        # one capture at a time
+        self._captureLock = threading.Lock()
+
+    @property
+    def capturing(self):
+        return self._running.is_set()
+
+    def waitForCapture(self, timeout=None):
+        # until a capture is running; False if none started within timeout
+        return self._running.wait(timeout)
+
+    def begin(self):
+        # a running profile for this request, or None outside a capture
+        if not self.capturing:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler holds this interpreter or thread
+            with self._lock:
+                self._skipped += 1
+            return None
+        return profile
+
+    def end(self, profile):
+        profile.disable()
+        with self._lock:
+            self._requests += 1
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def capture(self, seconds, top=20):
+        # profile the requests of the next seconds; None if a capture is already running
+        if not self._captureLock.acquire(blocking=False):
+            return None
+        try:
+            with self._lock:
+                self._stats = None
+                self._requests = self._skipped = 0
+            self._running.set()
+            try:
+                time.sleep(seconds)
+            finally:
+                self._running.clear()
+            with self._lock:
+                stats, requests, skipped = self._stats, self._requests, self._skipped
+        finally:
+            self._captureLock.release()
+        functions = []
+        if stats is not None:
+            # (file, line, name) -> (primitive calls, calls, own time, cumulative time, callers)
+            rows = sorted(stats.stats.items(), key=lambda row: row[1][2], reverse=True)[:top]
+            functions = [_function(where, calls=calls, ownSeconds=round(own, 6), cumulativeSeconds=round(cumulative, 6))
+                         for where, (primitive, calls, own, cumulative, callers) in rows]
+        return {"mode": "cprofile", "seconds": seconds, "requests": requests, "skipped": skipped,
+                "functions": functions}
+
+def startMemoryTracing(frames=1):
+    # snapshots only see what is allocated after tracing starts
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def stopMemoryTracing():
+    tracemalloc.stop()
+
+def memorySnapshot(top=10, types=TRACKED_TYPES):
+    # Memory held by allocations in each backend module, from tracemalloc, and
+    # the live backend objects by type: how many there are and their size
+    # including their attribute dicts.
+    result = {"tracing": tracemalloc.is_tracing()}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        result["tracedBytes"] = current
+        result["peakBytes"] = peak
+        modules = {}
+        outside = 0
+        for stat in tracemalloc.take_snapshot().statistics("filename"):
+            filename = stat.traceback[0].filename
+            if os.path.dirname(os.path.abspath(filename)) == BACKEND_DIR:
+                module = "backend." + os.path.splitext(os.path.basename(filename))[0]
+                modules[module] = {"bytes": stat.size, "blocks": stat.count}
+            else:
+                outside += stat.size
+        result["modules"] = dict(sorted(modules.items(), key=lambda item: item[1]["bytes"], reverse=True)[:top])
+        result["otherBytes"] = outside
+    counts = {cls.__name__: {"objects": 0, "bytes": 0} for cls in types}
+    for obj in gc.get_objects():
+        entry = counts.get(type(obj).__name__) if isinstance(obj, types) else None
+        if entry is None:
+            continue
+        attrs = getattr(obj, "__dict__", None)
+        entry["objects"] += 1
+        entry["bytes"] += sys.getsizeof(obj) + (sys.getsizeof(attrs) if attrs is not None else 0)
+    result["types"] = counts
+    return result
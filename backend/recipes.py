@@ -0,0 +1,114 @@
+from backend.errors import InventoryError, OrderError
+import json
+import os
+import threading
+
+RECIPE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'recipes.json')
+
+class Recipe:
+    # A standard menu item compiled against one version of the inventory catalog:
+    # its ingredients already looked up and totalled, its main rules already
+    # checked and its price already summed. Adding one to an order is then just
+    # a stock reservation.
+    def __init__(self, name, main, ingredients, inventory):
+        self._name = name
+        self._main = main
+        self._ingredients = ingredients
+        self._catalogVersion = inventory.catalogVersion
+        check = inventory.classifyMain(ingredients)
+        if main == "burger":
+            self._errors = check.burgerErrors()
+        else:
+            self._errors = check.wrapErrors()
+        self._price = check.price
+        self._units = None
+        if not self._errors:
+            try:
+                self._units = inventory._resolve(ingredients)
+            except InventoryError as ie:
+                self._errors = [ie]
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def main(self):
+        return self._main
+
+    @property
+    def ingredients(self):
+        return self._ingredients
+
+    @property
+    def units(self):
+        return self._units
+
+    @property
+    def price(self):
+        return self._price
+
+    @property
+    def catalogVersion(self):
+        return self._catalogVersion
+
+    def raiseErrors(self):
+        if not self._errors:
+            return
+        error = self._errors[0]
+        if isinstance(error, Exception):
+            raise error
+        error.raiseError()
+
+class RecipeBook:
+    # Standard menu items by name, loaded from recipes.json. Recipes are compiled
+    # lazily and recompiled only when the inventory catalog changes.
+    def __init__(self, recipes):
+        # name -> (main, {ingredient name: quantity})
+        self._recipes = {}
+        for name, recipe in recipes.items():
+            if recipe["main"] not in ["burger", "wrap"]:
+                raise OrderError("Recipe " + name + " must be a burger or wrap")
+            self._recipes[name.lower()] = (recipe["main"], dict(recipe["ingredients"]))
+        self._inventory = None
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=RECIPE_FILE):
+        with open(path) as file:
+            return cls(json.load(file))
+
+    @property
+    def names(self):
+        return list(self._recipes)
+
+    def hasRecipe(self, name):
+        return name.lower() in self._recipes
+
+    def compile(self, inventory):
+        # compile every recipe against this inventory, dropping any earlier compilation
+        with self._lock:
+            self._inventory = inventory
+            self._compiled = {}
+            for name, (main, ingredients) in self._recipes.items():
+                self._compiled[name] = Recipe(name, main, ingredients, inventory)
+            return dict(self._compiled)
+
+    def get(self, name, inventory):
+        try:
+            main, ingredients = self._recipes[name.lower()]
+        except KeyError:
+            raise OrderError(name.capitalize() + " is not on the menu")
+        with self._lock:
+            recipe = self._compiled.get(name.lower()) if self._inventory is inventory else None
+            if recipe is None or recipe.catalogVersion != inventory.catalogVersion:
+                if self._inventory is not inventory:
+                    self._inventory = inventory
+                    self._compiled = {}
+                recipe = Recipe(name.lower(), main, ingredients, inventory)
+                self._compiled[name.lower()] = recipe
+            return recipe
+
+# the standard menu, shared by every order
+recipes = RecipeBook.load()
@@ -0,0 +1,133 @@
+from backend.system import RestaurantSystem
+from backend.inventory import Inventory, StockView
+from backend.order import Order
+from multiprocessing.managers import BaseManager
+
+# Several web worker processes can share one RestaurantSystem by running it in a
+# coordinator process. Workers talk to it through RemoteSystem, which mirrors the
+# RestaurantSystem, Order and Inventory APIs the routes use. The coordinator runs
+# each call against the live objects, so order IDs come from its single counter
+# and stock changes go through its locks.
+
+class OrderRef:
+    # an Order returned by a call; the worker gets a RemoteOrder for it
+    def __init__(self, ID):
+        self.ID = ID
+
+class InventoryRef:
+    # stands in for the coordinator's inventory in call arguments
+    pass
+
+class Coordinator:
+    # runs in the coordinator process, one call per request from a worker
+    def __init__(self, system):
+        self._system = system
+
+    def _target(self, target):
+        if target[0] == "system":
+            return self._system
+        if target[0] == "inventory":
+            return self._system.inventory
+        return self._system.getOrderFromID(target[1])
+
+    def _export(self, value):
+        # a single order stays live on the coordinator; order lists go back as copies
+        if isinstance(value, Order):
+            return OrderRef(value.ID)
+        return value
+
+    def get(self, target, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._export(getattr(self._target(target), name))
+
+    def call(self, target, name, args, kwargs):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        args = [self._system.inventory if isinstance(arg, InventoryRef) else arg for arg in args]
+        return self._export(getattr(self._target(target), name)(*args, **kwargs))
+
+class CoordinatorManager(BaseManager):
+    pass
+
+def _properties(cls):
+    return set(name for name in dir(cls) if isinstance(getattr(cls, name), property))
+
+class _Remote:
+    # Worker side stand-in for an object in the coordinator. Properties of the
+    # mirrored class are read remotely, anything else becomes a remote call.
+    def __init__(self, coordinator, target, properties):
+        self._coordinator = coordinator
+        self._remoteTarget = target
+        self._properties = properties
+
+    def _import(self, value):
+        if isinstance(value, OrderRef):
+            return RemoteOrder(self._coordinator, value.ID)
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._properties:
+            return self._import(self._coordinator.get(self._remoteTarget, name))
+        def call(*args, **kwargs):
+            return self._import(self._coordinator.call(self._remoteTarget, name, args, kwargs))
+        return call
+
+class RemoteInventory(_Remote):
+    _inventoryProperties = _properties(Inventory)
+
+    def __init__(self, coordinator):
+        _Remote.__init__(self, coordinator, ("inventory",), self._inventoryProperties)
+
+    def __reduce__(self):
+        return (InventoryRef, ())
+
+    def view(self):
+        # kept in the worker, so repeated lookups in a request cost one round trip
+        return RemoteStockView(self)
+
+class RemoteStockView(StockView):
+    # ingredients in the view are worker side copies, so an order the view is
+    # passed to takes its stock straight from the coordinator's inventory
+    def __reduce__(self):
+        return (InventoryRef, ())
+
+class RemoteOrder(_Remote):
+    _orderProperties = _properties(Order)
+
+    def __init__(self, coordinator, ID):
+        _Remote.__init__(self, coordinator, ("order", ID), self._orderProperties)
+        self._ID = ID
+
+    @property
+    def ID(self):
+        return self._ID
+
+class RemoteSystem(_Remote):
+    _systemProperties = _properties(RestaurantSystem)
+
+    def __init__(self, coordinator):
+        _Remote.__init__(self, coordinator, ("system",), self._systemProperties)
+        self._inventory = RemoteInventory(coordinator)
+
+    @property
+    def inventory(self):
+        return self._inventory
+
+def serve(system, address, authkey, ready=None):
+    # blocks serving worker connections, each on its own thread; ready is called
+    # with the bound address once workers can connect
+    coordinator = Coordinator(system)
+    CoordinatorManager.register("Coordinator", callable=lambda: coordinator, exposed=("get", "call"))
+    server = CoordinatorManager(address=address, authkey=authkey).get_server()
+    if ready is not None:
+        ready(server.address)
+    server.serve_forever()
+
+def connect(address, authkey):
+    CoordinatorManager.register("Coordinator", exposed=("get", "call"))
+    manager = CoordinatorManager(address=address, authkey=authkey)
+    manager.connect()
+    return RemoteSystem(manager.Coordinator())
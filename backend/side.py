@@ -1,10 +1,14 @@
 from backend.inventory import Inventory
 
 class SideDrink:
-    def __init__(self, name, quantity, size="Regular"):
+    # price captured when the line was added; None for lines saved before that
+    _price = None
+
+    def __init__(self, name, quantity, size="Regular", price=None):
         self._name = name
         self._quantity = quantity
         self._size = size
+        self._price = price
 
     @property
     def name(self):
@@ -18,13 +22,14 @@ class SideDrink:
     def quantity(self):
         return self._quantity
 
-    def calculateCost(self, inventory):
-        if self.quantity > 0:
-            ingredient = inventory.getIngredient(self.name)
-            cost = ingredient.price * self.quantity * ingredient.servingSizes[self.servingSize]
-            return cost
-        else:
-            return 0
+    def calculateCost(self, inventory=None):
+        if self._price is None:
+            if self.quantity > 0:
+                ingredient = inventory.getIngredient(self.name)
+                self._price = ingredient.price * self.quantity * ingredient.servingSizes[self.servingSize]
+            else:
+                self._price = 0
+        return self._price
             
     def __str__(self):
         if self.quantity > 0:
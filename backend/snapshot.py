@@ -0,0 +1,535 @@
+from backend.inventory import Inventory, IngredientType
+from backend.order import Order
+from backend.main import Main
+from backend.side import SideDrink
+from collections.abc import MutableMapping
+import json
+import mmap
+import struct
+import threading
+import zlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Binary snapshot of a RestaurantSystem, read through a memory map:
+#
+#   header | head section | finished index | finished IDs sorted | block table |
+#   finished blocks
+#
+# The head section holds the ingredient table, the live order index and the
+# names, serving sizes and order payloads they point into, compressed as one
+# and decoded in full at load. Finished orders are compressed in blocks of
+# FINISHED_BLOCK and stay in the map until looked up, when only their block is
+# inflated. Version 1 files, which kept everything uncompressed, still load.
+MAGIC = b"RSNAPSHT"
+VERSION = 2
+PREFIX = struct.Struct("<8sH")
+# magic, version, schema, codec, orderIDCounter, seq, ingredient/live/finished/block
+# counts, head section stored and raw length
+HEADER = struct.Struct("<8sHHBQQIIIIQQ")
+# version 1: magic, version, flags, orderIDCounter, seq, ingredient/live/finished counts
+HEADER_V1 = struct.Struct("<8sHHQQIII")
+# name offset/length, price, quantity, type, unit, flags, serving sizes offset/length
+INGREDIENT = struct.Struct("<IHdqBBBIH")
+# ID, state, payload offset/length
+ORDER = struct.Struct("<IBQI")
+# ID, block, payload offset/length within the inflated block
+FINISHED = struct.Struct("<IIII")
+# ID, position in the finished index
+FINISHED_ID = struct.Struct("<II")
+# offset from the first block, stored length, raw length
+BLOCK = struct.Struct("<QII")
+# finished orders compressed together
+FINISHED_BLOCK = 256
+# inflated blocks kept for repeated lookups
+BLOCK_CACHE = 16
+
+# A delta segment holds just the records that changed since the segment before
+# it, in the same record layouts, uncompressed:
+#
+#   header | ingredient table | order index | removed IDs | blob
+DELTA_MAGIC = b"RSDELTA1"
+# magic, schema, flags, orderIDCounter, seq, ingredient/order/removed counts
+DELTA_HEADER = struct.Struct("<8sHHQQIII")
+REMOVED_ID = struct.Struct("<I")
+
+UNITS = ["g", "ml", "unit"]
+STATES = ["pending", "active", "finished"]
+# ingredient flags
+PRICE_IS_INT = 1
+
+# section codecs
+RAW = 0
+ZLIB = 1
+LZMA = 2
+
+def _compress(codec, data):
+    if codec == ZLIB:
+        return zlib.compress(data)
+    if codec == LZMA:
+        return lzma.compress(data)
+    return data
+
+def _decompress(codec, data):
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == LZMA:
+        if lzma is None:
+            raise ValueError("snapshot is lzma compressed but lzma is not available")
+        return lzma.decompress(data)
+    return bytes(data)
+
+# Version of the records themselves: the order payloads and ingredient fields.
+# Loading a snapshot or segment written under an older schema upgrades each
+# record through the registered migrations, one version at a time.
+SCHEMA_VERSION = 2
+
+class Migrations:
+    def __init__(self):
+        # schema version -> step(kind, record) returning the record at the next version
+        self._steps = {}
+
+    def register(self, version):
+        def decorator(step):
+            self._steps[version] = step
+            return step
+        return decorator
+
+    def upgrade(self, kind, record, version):
+        # kind is "order" for a payload dict or "ingredient" for a dict of its fields
+        while version < SCHEMA_VERSION:
+            step = self._steps.get(version)
+            if step is None:
+                raise ValueError("no migration from snapshot schema " + str(version))
+            record = step(kind, record)
+            version += 1
+        return record
+
+migrations = Migrations()
+
+@migrations.register(1)
+def _preparedTimes(kind, record):
+    # orders written before prepared times were kept
+    if kind == "order":
+        record.setdefault("preparedAt", None)
+    return record
+
+def isSnapshot(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+def encodeOrder(order):
+    payload = {"prepared": order.prepared, "paid": order.paid, "preparedAt": order.preparedAt,
+               "total": order.calculateTotalPrice(),
+               "mains": [[main.ingredients, main.calculateCost()] for main in order.mainOrders],
+               "sides": [[side.name, side.quantity, side.servingSize, side.calculateCost()]
+                         for side in order.sidesAndDrinks]}
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+def decodeOrder(inventory, ID, data, schema=SCHEMA_VERSION):
+    payload = json.loads(bytes(data))
+    if schema < SCHEMA_VERSION:
+        payload = migrations.upgrade("order", payload, schema)
+    mains = [Main(ingredients, price) for ingredients, price in payload["mains"]]
+    sides = [SideDrink(name, quantity, size, price) for name, quantity, size, price in payload["sides"]]
+    return Order.restore(inventory, ID, payload["paid"], payload["prepared"], mains, sides, payload["total"],
+                         payload["preparedAt"])
+
+class _Blob:
+    def __init__(self):
+        self._parts = []
+        self._size = 0
+
+    def add(self, data):
+        offset = self._size
+        self._parts.append(data)
+        self._size += len(data)
+        return offset, len(data)
+
+    @property
+    def count(self):
+        return len(self._parts)
+
+    def getvalue(self):
+        return b"".join(self._parts)
+
+def _packIngredient(ingredient, blob):
+    nameOffset, nameLength = blob.add(ingredient.name.encode())
+    sizesOffset, sizesLength = blob.add(json.dumps(ingredient.servingSizes, separators=(',', ':')).encode())
+    flags = PRICE_IS_INT if isinstance(ingredient.price, int) else 0
+    return INGREDIENT.pack(nameOffset, nameLength, ingredient.price, int(ingredient.quantity),
+                           ingredient.iType.value, UNITS.index(ingredient.unit), flags, sizesOffset, sizesLength)
+
+INGREDIENT_FIELDS = ["name", "price", "quantity", "iType", "servingSizes", "unit"]
+
+def _unpackIngredient(data, at, blob, schema=SCHEMA_VERSION):
+    # (name, price, quantity, iType, servingSizes, unit); blob(offset, length) reads the blob
+    (nameOffset, nameLength, price, quantity, iType, unit, flags,
+     sizesOffset, sizesLength) = INGREDIENT.unpack_from(data, at)
+    if flags & PRICE_IS_INT:
+        price = int(price)
+    fields = (blob(nameOffset, nameLength).decode(), price, quantity, IngredientType(iType),
+              json.loads(blob(sizesOffset, sizesLength)), UNITS[unit])
+    if schema < SCHEMA_VERSION:
+        record = migrations.upgrade("ingredient", dict(zip(INGREDIENT_FIELDS, fields)), schema)
+        fields = tuple(record[field] for field in INGREDIENT_FIELDS)
+    return fields
+
+def writeSnapshot(system, file, codec=ZLIB):
+    # system orders are read through the state mappings so encoded history is copied as is
+    blob = _Blob()
+    ingredients = [_packIngredient(ingredient, blob) for ingredient in system.inventory.ingredients]
+    live = []
+    for state, orders in [(0, system._pendingOrders), (1, system._activeOrders)]:
+        for order in list(orders.values()):
+            offset, length = blob.add(encodeOrder(order))
+            live.append(ORDER.pack(order.ID, state, offset, length))
+    head = _compress(codec, b"".join(ingredients) + b"".join(live) + blob.getvalue())
+    finished = []
+    finishedIDs = []
+    blocks = []
+    block = _Blob()
+    history = system._finishedOrders
+    for ID in list(history):
+        data = history.encoded(ID) if isinstance(history, OrderHistory) else None
+        if data is None:
+            data = encodeOrder(history[ID])
+        offset, length = block.add(data)
+        finishedIDs.append((ID, len(finished)))
+        finished.append(FINISHED.pack(ID, len(blocks), offset, length))
+        if block.count == FINISHED_BLOCK:
+            blocks.append(block.getvalue())
+            block = _Blob()
+    if block.count:
+        blocks.append(block.getvalue())
+    finishedIDs.sort()
+    blocks = [(_compress(codec, raw), len(raw)) for raw in blocks]
+    file.write(HEADER.pack(MAGIC, VERSION, SCHEMA_VERSION, codec, system.orderIDCounter, system._seq,
+                           len(ingredients), len(live), len(finished), len(blocks), len(head),
+                           len(ingredients) * INGREDIENT.size + len(live) * ORDER.size + len(blob.getvalue())))
+    file.write(head)
+    file.write(b"".join(finished))
+    file.write(b"".join(FINISHED_ID.pack(ID, position) for ID, position in finishedIDs))
+    offset = 0
+    table = []
+    for data, rawLength in blocks:
+        table.append(BLOCK.pack(offset, len(data), rawLength))
+        offset += len(data)
+    file.write(b"".join(table))
+    file.write(b"".join(data for data, rawLength in blocks))
+
+class SnapshotReader:
+    # the tables of a snapshot file, decoded from the memory map on demand
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version = PREFIX.unpack_from(self._map, 0)
+        if self.version == 1:
+            self._openV1()
+        elif self.version == VERSION:
+            self._open()
+        else:
+            raise ValueError("unsupported snapshot version " + str(self.version))
+        self._ingredientsAt = 0
+        self._liveAt = self.ingredientCount * INGREDIENT.size
+        self._headBlobAt = self._liveAt + self.liveCount * ORDER.size
+        # block number -> inflated block, cleared when full
+        self._blocks = {}
+
+    def _open(self):
+        (magic, version, self.schema, self._codec, self.orderIDCounter, self.seq, self.ingredientCount,
+         self.liveCount, self.finishedCount, self._blockCount, headLength, rawLength) = HEADER.unpack_from(self._map, 0)
+        self._head = _decompress(self._codec, self._map[HEADER.size:HEADER.size + headLength])
+        self._finishedAt = HEADER.size + headLength
+        self._finishedIDsAt = self._finishedAt + self.finishedCount * FINISHED.size
+        self._blockTableAt = self._finishedIDsAt + self.finishedCount * FINISHED_ID.size
+        self._blocksAt = self._blockTableAt + self._blockCount * BLOCK.size
+
+    def _openV1(self):
+        # one uncompressed file: header, ingredients, live index, finished index, IDs, blob
+        (magic, version, flags, self.orderIDCounter, self.seq, self.ingredientCount,
+         self.liveCount, self.finishedCount) = HEADER_V1.unpack_from(self._map, 0)
+        self.schema = 1
+        # the head is read in place, its offsets relative to the end of the header
+        self._head = memoryview(self._map)[HEADER_V1.size:]
+        self._finishedAt = HEADER_V1.size + (self.ingredientCount * INGREDIENT.size + self.liveCount * ORDER.size)
+        self._finishedIDsAt = self._finishedAt + self.finishedCount * ORDER.size
+        self._blobAt = self._finishedIDsAt + self.finishedCount * FINISHED_ID.size
+
+    def _headBlob(self, offset, length):
+        if self.version == 1:
+            start = self._blobAt + offset
+            return self._map[start:start + length]
+        start = self._headBlobAt + offset
+        return self._head[start:start + length]
+
+    def ingredients(self):
+        for i in range(self.ingredientCount):
+            yield _unpackIngredient(self._head, self._ingredientsAt + i * INGREDIENT.size, self._headBlob, self.schema)
+
+    def liveOrders(self):
+        for i in range(self.liveCount):
+            ID, state, offset, length = ORDER.unpack_from(self._head, self._liveAt + i * ORDER.size)
+            yield ID, STATES[state], self._headBlob(offset, length)
+
+    def finishedID(self, position):
+        size = ORDER.size if self.version == 1 else FINISHED.size
+        return struct.unpack_from("<I", self._map, self._finishedAt + position * size)[0]
+
+    def findFinished(self, ID):
+        # binary search of the sorted ID table; returns the position in the finished index or -1
+        lo, hi = 0, self.finishedCount
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midID, position = FINISHED_ID.unpack_from(self._map, self._finishedIDsAt + mid * FINISHED_ID.size)
+            if midID == ID:
+                return position
+            if midID < ID:
+                lo = mid + 1
+            else:
+                hi = mid
+        return -1
+
+    def _block(self, number):
+        block = self._blocks.get(number)
+        if block is None:
+            offset, storedLength, rawLength = BLOCK.unpack_from(self._map, self._blockTableAt + number * BLOCK.size)
+            start = self._blocksAt + offset
+            block = _decompress(self._codec, self._map[start:start + storedLength])
+            if len(self._blocks) >= BLOCK_CACHE:
+                self._blocks.clear()
+            self._blocks[number] = block
+        return block
+
+    def finished(self, position):
+        if self.version == 1:
+            ID, state, offset, length = ORDER.unpack_from(self._map, self._finishedAt + position * ORDER.size)
+            return self._headBlob(offset, length)
+        ID, number, offset, length = FINISHED.unpack_from(self._map, self._finishedAt + position * FINISHED.size)
+        return self._block(number)[offset:offset + length]
+
+class OrderHistory(MutableMapping):
+    # Finished orders keyed by ID, in the order they finished. Those from the
+    # snapshot stay encoded in the mapped file until they are looked up; orders
+    # finished since the snapshot are held as usual.
+    def __init__(self, reader, inventory):
+        self._reader = reader
+        self._inventory = inventory
+        self._decoded = {}
+        self._removed = set()
+        self._added = {}
+        self._lock = threading.Lock()
+        # set to the system's event listener for decoded orders
+        self.listener = None
+
+    def _position(self, ID):
+        if ID in self._removed:
+            return -1
+        return self._reader.findFinished(ID)
+
+    @property
+    def resident(self):
+        return len(self._decoded) + len(self._added)
+
+    def encoded(self, ID):
+        # the snapshot payload of an order that has not been decoded, else None;
+        # payloads under an older schema are always decoded, so they are upgraded
+        if ID in self._decoded or ID in self._added or self._reader.schema < SCHEMA_VERSION:
+            return None
+        position = self._position(ID)
+        return self._reader.finished(position) if position >= 0 else None
+
+    def __getitem__(self, ID):
+        if ID in self._added:
+            return self._added[ID]
+        with self._lock:
+            order = self._decoded.get(ID)
+            if order is None:
+                position = self._position(ID)
+                if position < 0:
+                    raise KeyError(ID)
+                order = decodeOrder(self._inventory, ID, self._reader.finished(position), self._reader.schema)
+                order._listener = self.listener
+                self._decoded[ID] = order
+        return order
+
+    def __contains__(self, ID):
+        return ID in self._added or self._position(ID) >= 0
+
+    def __setitem__(self, ID, order):
+        if self._position(ID) >= 0:
+            self._decoded[ID] = order
+        else:
+            self._added[ID] = order
+
+    def __delitem__(self, ID):
+        if ID in self._added:
+            del self._added[ID]
+        elif self._position(ID) >= 0:
+            self._removed.add(ID)
+            self._decoded.pop(ID, None)
+        else:
+            raise KeyError(ID)
+
+    def __iter__(self):
+        for position in range(self._reader.finishedCount):
+            ID = self._reader.finishedID(position)
+            if ID not in self._removed:
+                yield ID
+        for ID in list(self._added):
+            yield ID
+
+    def __len__(self):
+        return self._reader.finishedCount - len(self._removed) + len(self._added)
+
+    def __reduce__(self):
+        # pickled as a plain dict, decoding the whole history
+        return (dict, (list(self.items()),))
+
+class OrderRegistry(MutableMapping):
+    # every order by ID: those created or decoded since loading, falling back
+    # to the finished history for the rest
+    def __init__(self, orders, history):
+        self._orders = orders
+        self._history = history
+
+    def __getitem__(self, ID):
+        try:
+            return self._orders[ID]
+        except KeyError:
+            return self._history[ID]
+
+    def __contains__(self, ID):
+        return ID in self._orders or ID in self._history
+
+    def __setitem__(self, ID, order):
+        self._orders[ID] = order
+
+    def __delitem__(self, ID):
+        if ID in self._orders:
+            del self._orders[ID]
+        else:
+            del self._history[ID]
+
+    def __iter__(self):
+        for ID in self._orders:
+            yield ID
+        for ID in self._history:
+            if ID not in self._orders:
+                yield ID
+
+    def __len__(self):
+        # orders finished since loading are in both
+        return len(self._orders) + len(self._history) - sum(1 for ID in self._orders if ID in self._history)
+
+    def __reduce__(self):
+        return (dict, (list(self.items()),))
+
+def loadSnapshot(path, factory):
+    reader = SnapshotReader(path)
+    inventory = Inventory()
+    for name, price, quantity, iType, servingSizes, unit in reader.ingredients():
+        inventory.addIngredient(name, price, quantity, iType, servingSizes, unit)
+    pending = {}
+    active = {}
+    for ID, state, data in reader.liveOrders():
+        order = decodeOrder(inventory, ID, data, reader.schema)
+        (pending if state == "pending" else active)[ID] = order
+    history = OrderHistory(reader, inventory)
+    orders = dict(pending)
+    orders.update(active)
+    system = factory.__new__(factory)
+    system.__dict__.update({'_inventory': inventory, '_orderIDCounter': reader.orderIDCounter,
+                            '_orders': OrderRegistry(orders, history), '_pendingOrders': pending,
+                            '_activeOrders': active, '_finishedOrders': history, '_seq': reader.seq})
+    system._initTransient()
+    for order in orders.values():
+        order._listener = system._record
+    history.listener = system._record
+    return system
+
+def writeDelta(system, changes, file):
+    # changes is what system.takeChanges() returned
+    ingredients, orders, removed = changes
+    blob = _Blob()
+    records = [_packIngredient(ingredient, blob) for ingredient in ingredients]
+    for order, state in orders:
+        offset, length = blob.add(encodeOrder(order))
+        records.append(ORDER.pack(order.ID, STATES.index(state), offset, length))
+    records.extend(REMOVED_ID.pack(ID) for ID in removed)
+    file.write(DELTA_HEADER.pack(DELTA_MAGIC, SCHEMA_VERSION, 0, system.orderIDCounter, system._seq,
+                                 len(ingredients), len(orders), len(removed)))
+    file.write(b"".join(records))
+    file.write(blob.getvalue())
+
+class DeltaReader:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._data = file.read()
+        (magic, self.schema, flags, self.orderIDCounter, self.seq, self.ingredientCount,
+         self.orderCount, self.removedCount) = DELTA_HEADER.unpack_from(self._data, 0)
+        if magic != DELTA_MAGIC:
+            raise ValueError("not a delta segment: " + path)
+        self._ordersAt = DELTA_HEADER.size + self.ingredientCount * INGREDIENT.size
+        self._removedAt = self._ordersAt + self.orderCount * ORDER.size
+        self._blobAt = self._removedAt + self.removedCount * REMOVED_ID.size
+
+    def _blob(self, offset, length):
+        start = self._blobAt + offset
+        return self._data[start:start + length]
+
+    def ingredients(self):
+        for i in range(self.ingredientCount):
+            yield _unpackIngredient(self._data, DELTA_HEADER.size + i * INGREDIENT.size, self._blob, self.schema)
+
+    def orders(self):
+        for i in range(self.orderCount):
+            ID, state, offset, length = ORDER.unpack_from(self._data, self._ordersAt + i * ORDER.size)
+            yield ID, STATES[state], self._blob(offset, length)
+
+    def removed(self):
+        for i in range(self.removedCount):
+            yield REMOVED_ID.unpack_from(self._data, self._removedAt + i * REMOVED_ID.size)[0]
+
+def _forget(system, ID):
+    # drop an order from every index; an unpaid one stops holding its reservation
+    for orders in [system._pendingOrders, system._activeOrders, system._finishedOrders]:
+        order = orders.pop(ID, None)
+        if order is not None and order._reservation is not None:
+            system.inventory.commit(order._reservation)
+    system._orders.pop(ID, None)
+
+def applyDelta(system, path):
+    # bring a loaded system up to date with one delta segment; returns False if
+    # the system already contains it
+    reader = DeltaReader(path)
+    if reader.seq <= system._seq:
+        return False
+    inventory = system.inventory
+    system._replaying = True
+    try:
+        for name, price, quantity, iType, servingSizes, unit in reader.ingredients():
+            if inventory.hasIngredient(name):
+                inventory.getIngredient(name)._quantity = quantity
+            else:
+                inventory.addIngredient(name, price, quantity, iType, servingSizes, unit)
+    finally:
+        system._replaying = False
+    inventory._menuChanged()
+    for ID, state, data in reader.orders():
+        _forget(system, ID)
+        order = decodeOrder(inventory, ID, data, reader.schema)
+        order._listener = system._record
+        system._orders[ID] = order
+        {"pending": system._pendingOrders, "active": system._activeOrders,
+         "finished": system._finishedOrders}[state][ID] = order
+    for ID in reader.removed():
+        _forget(system, ID)
+    system._orderIDCounter = reader.orderIDCounter
+    system._seq = reader.seq
+    return True
@@ -0,0 +1,391 @@
+from backend.inventory import Inventory, IngredientType
+from backend.order import Order
+from backend.main import Main
+from backend.side import SideDrink
+from backend.errors import SystemError
+from backend.journal import Journal
+from backend.snapshot import isSnapshot, writeSnapshot, loadSnapshot, writeDelta, applyDelta
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+# number of journal events after which JournalStorage folds them into a delta segment
+SNAPSHOT_INTERVAL = 1000
+# number of delta segments after which they are merged into the base snapshot in the background
+MERGE_SEGMENTS = 8
+
+logger = logging.getLogger(__name__)
+
+class Storage(ABC):
+    # Where a RestaurantSystem keeps its state between runs. The system records a
+    # domain event for every change and saveData hands each batch to append().
+    # load() rebuilds the system at startup; write() stores a complete copy of a
+    # system, replacing whatever was stored before.
+    @abstractmethod
+    def load(self, factory):
+        pass
+
+    @abstractmethod
+    def write(self, system):
+        pass
+
+    @abstractmethod
+    def append(self, events):
+        pass
+
+    def close(self):
+        pass
+
+class JournalStorage(Storage):
+    # A base snapshot of the whole system, delta segments holding the records
+    # changed since, and a journal of the events after the last segment. Every
+    # SNAPSHOT_INTERVAL events the journal is folded into a segment of just the
+    # records those events touched; once MERGE_SEGMENTS have piled up they are
+    # merged into a fresh base snapshot on a background thread.
+    def __init__(self, path, journalPath):
+        self._path = path
+        self._journalPath = journalPath
+        self._journal = Journal(journalPath)
+        self._factory = None
+        # guards segment numbering and swapping in a new base snapshot
+        self._segmentLock = threading.Lock()
+        # number of the last segment written; never reused, so a merge can tell
+        # its segments from any written after a write() cleared them
+        self._segmentNumber = 0
+        self._merger = None
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @property
+    def segments(self):
+        # paths of the delta segments, oldest first
+        directory = os.path.dirname(os.path.abspath(self._path))
+        prefix = os.path.basename(self._path) + '.delta.'
+        numbers = sorted(int(name[len(prefix):]) for name in os.listdir(directory)
+                         if name.startswith(prefix) and name[len(prefix):].isdigit())
+        return ["{}.delta.{}".format(self._path, number) for number in numbers]
+
+    def _writeFile(self, path, write):
+        # write next to the old file and swap it in, so a crash never leaves a partial file
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmpPath, path)
+
+    def _writeSnapshot(self, system, segments):
+        # the segments are contained in the new snapshot, so they go once it is in place
+        self._writeFile(self._path, lambda file: writeSnapshot(system, file))
+        for path in segments:
+            os.remove(path)
+
+    def _loadSnapshot(self, segments):
+        if isSnapshot(self._path):
+            system = loadSnapshot(self._path, self._factory)
+        else:
+            # snapshots written before the binary format are whole-system pickles
+            try:
+                with open(self._path, 'rb') as file:
+                    system = pickle.load(file)
+            except IOError:
+                system = self._factory()
+        # segments a merge had already folded into the snapshot are skipped
+        for path in segments:
+            applyDelta(system, path)
+        return system
+
+    def load(self, factory):
+        # the last snapshot and its segments with the journal tail replayed on top
+        self._factory = factory
+        segments = self.segments
+        system = self._loadSnapshot(segments)
+        # a journal rotated by a compaction that did not finish comes first
+        oldPath = self._journalPath + '.old'
+        system._replay(Journal(oldPath).replay())
+        system._replay(self._journal.replay())
+        if os.path.exists(oldPath):
+            # nothing else is running yet, so the live system can be snapshotted directly
+            self._writeSnapshot(system, segments)
+            self._journal.truncate()
+            os.remove(oldPath)
+        return system
+
+    def write(self, system):
+        self._factory = type(system)
+        with self._segmentLock:
+            self._writeSnapshot(system, self.segments)
+        self._journal.truncate()
+
+    def append(self, events):
+        self._journal.append(events)
+        if self._journal.length >= SNAPSHOT_INTERVAL:
+            try:
+                self._compact()
+            except Exception:
+                # the events are already in the journal, so they are saved either way;
+                # the next compaction picks up whatever this one left behind
+                logger.exception("Journal compaction failed")
+
+    def _compact(self):
+        # Fold the journal into a delta segment without touching the live system,
+        # which request threads keep mutating: new events go to a fresh journal
+        # while the old one is replayed onto a private copy of the stored state.
+        # Only the records the replay dirtied are written, so the segment is the
+        # size of the change rather than of the whole system.
+        oldPath = self._journalPath + '.old'
+        if os.path.exists(oldPath):
+            # a compaction that failed left its journal behind; add this one to the
+            # end of it rather than replacing it. Events left in both by a crash
+            # here are replayed once, as replay skips sequence numbers it has seen.
+            old = Journal(oldPath)
+            old.replay()
+            old.append(self._journal.replay())
+            old.close()
+            self._journal.truncate()
+        else:
+            self._journal.rotate(oldPath)
+        with self._segmentLock:
+            segments = self.segments
+            base = self._loadSnapshot(segments)
+            base.trackChanges()
+            base._replay(Journal(oldPath).replay())
+            if segments:
+                self._segmentNumber = max(self._segmentNumber, int(segments[-1].rsplit('.', 1)[1]))
+            self._segmentNumber += 1
+            changes = base.takeChanges()
+            self._writeFile("{}.delta.{}".format(self._path, self._segmentNumber),
+                            lambda file: writeDelta(base, changes, file))
+        os.remove(oldPath)
+        if len(segments) + 1 >= MERGE_SEGMENTS and (self._merger is None or not self._merger.is_alive()):
+            self._merger = threading.Thread(target=self.merge, daemon=True)
+            self._merger.start()
+
+    def merge(self):
+        # fold the delta segments into a new base snapshot; compactions carry on
+        # writing segments meanwhile, only the swap itself holds them up
+        with self._segmentLock:
+            segments = self.segments
+        if not segments:
+            return
+        try:
+            base = self._loadSnapshot(segments)
+        except IOError:
+            # write() replaced the snapshot and its segments under us
+            return
+        with self._segmentLock:
+            if self.segments[:len(segments)] == segments:
+                self._writeSnapshot(base, segments)
+
+    def close(self):
+        if self._merger is not None:
+            self._merger.join()
+        self._journal.close()
+
+class SQLiteStorage(Storage):
+    # Ingredients and stock levels, orders and order lines as SQLite rows. Each
+    # batch of events is applied in one transaction of keyed row updates, so the
+    # database always holds the state as of the last saved event. The database
+    # runs in WAL mode so readers are never blocked by the writer.
+    #
+    # Like JournalStorage this only persists the system: load() reads the rows
+    # into the in-memory RestaurantSystem, which serves every lookup, state change
+    # and stock check, and the database is written behind it by saveData. Only
+    # one process may use a database; several web workers share one system
+    # through coordinator.py instead.
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS ingredients (name TEXT PRIMARY KEY, price REAL NOT NULL, "
+            "quantity NUMERIC NOT NULL, iType INTEGER NOT NULL, servingSizes TEXT NOT NULL, unit TEXT NOT NULL)",
+        # position orders each state's orders by when they entered it
+        "CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, state TEXT NOT NULL, "
+            "total REAL NOT NULL, position INTEGER NOT NULL, preparedAt REAL)",
+        "CREATE INDEX IF NOT EXISTS orders_by_state ON orders (state, position)",
+        # kind is main or side; mains keep their ingredients as JSON
+        "CREATE TABLE IF NOT EXISTS order_lines (order_id INTEGER NOT NULL, line INTEGER NOT NULL, "
+            "kind TEXT NOT NULL, name TEXT, quantity NUMERIC, size TEXT, ingredients TEXT, price REAL NOT NULL, "
+            "PRIMARY KEY (order_id, line))",
+    ]
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        for statement in self.SCHEMA:
+            self._db.execute(statement)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(orders)")]
+        if "preparedAt" not in columns:
+            # databases created before prepared times were kept
+            self._db.execute("ALTER TABLE orders ADD COLUMN preparedAt REAL")
+        self._position = self._db.execute("SELECT coalesce(max(position), 0) FROM orders").fetchone()[0]
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def empty(self):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM meta WHERE key = 'seq'").fetchone() is None
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _nextPosition(self):
+        self._position += 1
+        return self._position
+
+    def _setMeta(self, db, key, value):
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def load(self, factory):
+        if self.empty:
+            return factory()
+        system = factory.__new__(factory)
+        with self._lock:
+            meta = dict(self._db.execute("SELECT key, value FROM meta"))
+            inventory = Inventory()
+            rows = self._db.execute("SELECT name, price, quantity, iType, servingSizes, unit FROM ingredients ORDER BY rowid")
+            for name, price, quantity, iType, servingSizes, unit in rows:
+                inventory.addIngredient(name, price, quantity, IngredientType(iType), json.loads(servingSizes), unit)
+            orders = {}
+            states = {"pending": {}, "active": {}, "finished": {}}
+            lines = {}
+            rows = self._db.execute("SELECT order_id, kind, name, quantity, size, ingredients, price FROM order_lines "
+                                    "ORDER BY order_id, line")
+            for ID, kind, name, quantity, size, ingredients, price in rows:
+                mains, sides = lines.setdefault(ID, ([], []))
+                if kind == "main":
+                    mains.append(Main(json.loads(ingredients), price))
+                else:
+                    sides.append(SideDrink(name, quantity, size, price))
+            rows = self._db.execute("SELECT id, state, total, preparedAt FROM orders ORDER BY position")
+            for ID, state, total, preparedAt in rows:
+                mains, sides = lines.get(ID, ([], []))
+                order = Order.restore(inventory, ID, state != "pending", state == "finished", mains, sides, total,
+                                      preparedAt)
+                orders[ID] = order
+                states[state][ID] = order
+        system.__setstate__({'_inventory': inventory, '_orderIDCounter': meta.get('orderIDCounter', 1),
+                             '_orders': orders, '_pendingOrders': states["pending"],
+                             '_activeOrders': states["active"], '_finishedOrders': states["finished"],
+                             '_seq': meta['seq']})
+        return system
+
+    def write(self, system):
+        with self._transaction() as db:
+            for table in ["meta", "ingredients", "orders", "order_lines"]:
+                db.execute("DELETE FROM " + table)
+            for ingredient in system.inventory.ingredients:
+                db.execute("INSERT INTO ingredients (name, price, quantity, iType, servingSizes, unit) "
+                           "VALUES (?, ?, ?, ?, ?, ?)", (ingredient.name, ingredient.price, ingredient.quantity,
+                           ingredient.iType.value, json.dumps(ingredient.servingSizes), ingredient.unit))
+            for state, orders in [("pending", system.pendingOrders), ("active", system.activeOrders),
+                                  ("finished", system.finishedOrders)]:
+                for order in orders:
+                    db.execute("INSERT INTO orders (id, state, total, position, preparedAt) VALUES (?, ?, ?, ?, ?)",
+                               (order.ID, state, order.calculateTotalPrice(system.inventory), self._nextPosition(),
+                                order.preparedAt))
+                    line = 0
+                    for main in order.mainOrders:
+                        line += 1
+                        db.execute("INSERT INTO order_lines (order_id, line, kind, ingredients, price) "
+                                   "VALUES (?, ?, 'main', ?, ?)", (order.ID, line, json.dumps(main.ingredients),
+                                   main.calculateCost(system.inventory)))
+                    for side in order.sidesAndDrinks:
+                        line += 1
+                        db.execute("INSERT INTO order_lines (order_id, line, kind, name, quantity, size, price) "
+                                   "VALUES (?, ?, 'side', ?, ?, ?, ?)", (order.ID, line, side.name, side.quantity,
+                                   side.servingSize, side.calculateCost(system.inventory)))
+            self._setMeta(db, 'orderIDCounter', system.orderIDCounter)
+            self._setMeta(db, 'seq', system._seq)
+
+    def append(self, events):
+        if not events:
+            return
+        with self._transaction() as db:
+            for event in events:
+                self._apply(db, event)
+            self._setMeta(db, 'seq', events[-1]['seq'])
+
+    def _units(self, db, name, quantity, size):
+        if size == "regular":
+            return quantity
+        servingSizes = db.execute("SELECT servingSizes FROM ingredients WHERE name = ?", (name.lower(),)).fetchone()[0]
+        return quantity * json.loads(servingSizes)[size]
+
+    def _addLine(self, db, event, kind, **columns):
+        db.execute("INSERT INTO order_lines (order_id, line, kind, name, quantity, size, ingredients, price) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (event['order'], event['seq'], kind, columns.get('name'),
+                   columns.get('quantity'), columns.get('size'), columns.get('ingredients'), event['price']))
+        db.execute("UPDATE orders SET total = total + ? WHERE id = ?", (event['price'], event['order']))
+
+    def _changeStock(self, db, name, delta):
+        db.execute("UPDATE ingredients SET quantity = quantity + ? WHERE name = ?", (delta, name.lower()))
+
+    def _apply(self, db, event):
+        kind = event['event']
+        if kind == "create":
+            db.execute("INSERT INTO orders (id, state, total, position) VALUES (?, 'pending', 0, ?)",
+                       (event['order'], self._nextPosition()))
+            self._setMeta(db, 'orderIDCounter', event['order'] + 1)
+        elif kind == "main":
+            for name, quantity in event['ingredients'].items():
+                self._changeStock(db, name, -quantity)
+            self._addLine(db, event, "main", ingredients=json.dumps(event['ingredients']))
+        elif kind in ["side", "drink"]:
+            self._changeStock(db, event['name'], -self._units(db, event['name'], event['quantity'], event['size']))
+            self._addLine(db, event, "side", name=event['name'], quantity=event['quantity'], size=event['size'])
+        elif kind == "checkout":
+            db.execute("UPDATE orders SET state = 'active', position = ? WHERE id = ?",
+                       (self._nextPosition(), event['order']))
+        elif kind == "prepared":
+            db.execute("UPDATE orders SET state = 'finished', position = ?, preparedAt = ? WHERE id = ?",
+                       (self._nextPosition(), event.get('at'), event['order']))
+        elif kind == "cancel":
+            # the stock held by the order goes back
+            rows = db.execute("SELECT kind, name, quantity, size, ingredients FROM order_lines WHERE order_id = ?",
+                              (event['order'],)).fetchall()
+            for lineKind, name, quantity, size, ingredients in rows:
+                if lineKind == "main":
+                    for name, quantity in json.loads(ingredients).items():
+                        self._changeStock(db, name, quantity)
+                else:
+                    self._changeStock(db, name, self._units(db, name, quantity, size))
+            db.execute("DELETE FROM order_lines WHERE order_id = ?", (event['order'],))
+            db.execute("DELETE FROM orders WHERE id = ?", (event['order'],))
+        elif kind == "archive":
+            # the orders now live in the archive file
+            for ID in event['orders']:
+                db.execute("DELETE FROM order_lines WHERE order_id = ?", (ID,))
+                db.execute("DELETE FROM orders WHERE id = ?", (ID,))
+        elif kind == "stock":
+            for name, quantity in event['ingredients'].items():
+                self._changeStock(db, name, quantity)
+        elif kind == "ingredient":
+            db.execute("INSERT INTO ingredients (name, price, quantity, iType, servingSizes, unit) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", (event['name'].lower(), event['price'], event['quantity'],
+                       event['iType'], json.dumps(event['servingSizes']), event['unit']))
+        else:
+            raise SystemError("Unknown storage event " + str(kind))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,14 +1,78 @@
 from backend.order import Order
-from backend.inventory import Inventory
-from backend.errors import SystemError
-import pickle
+from backend.inventory import Inventory, IngredientType
+from backend.errors import SystemError, InventoryError, OrderError, BasketError
+from backend.storage import JournalStorage
+from backend.tracing import traced
+import logging
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SNAPSHOT_FILE = 'system.dat'
+JOURNAL_FILE = 'system.journal'
+
+logger = logging.getLogger(__name__)
+
 class RestaurantSystem:
     def __init__(self):
         self._inventory = Inventory()
         self._orderIDCounter = 1
-        self._pendingOrders = []
-        self._activeOrders = []
-        self._finishedOrders = []
+        # registry of every live order keyed by ID, plus one index per order state;
+        # dicts keep insertion order so the state views list orders oldest first
+        self._orders = {}
+        self._pendingOrders = {}
+        self._activeOrders = {}
+        self._finishedOrders = {}
+        # sequence number of the last recorded domain event
+        self._seq = 0
+        self._initTransient()
+
+    def _initTransient(self):
+        # state that is never pickled into the snapshot
+        self._events = []
+        # guards the event buffer and sequence numbers
+        self._eventLock = threading.Lock()
+        # guards the order registry, the state indexes and the ID counter
+        self._stateLock = threading.Lock()
+        # one saveData at a time, so batches reach storage in sequence order
+        self._saveLock = threading.Lock()
+        self._storage = None
+        # finished orders moved out of memory, and when to move them
+        self._archive = None
+        self._archivePolicy = None
+        # IDs of orders added, moved or removed since trackChanges; None when not tracking
+        self._changedOrders = None
+        self._replaying = False
+        # events recorded by this process since it started, by kind; replays are not counted
+        self._eventCounts = {}
+        self._inventory._listener = self._record
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ['_events', '_eventLock', '_stateLock', '_saveLock', '_storage', '_archive', '_archivePolicy',
+                     '_changedOrders', '_replaying', '_eventCounts']:
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # system.dat files written before the registry keep each state as a list
+        if '_orders' not in state:
+            self._orders = {}
+            for attr in ['_pendingOrders', '_activeOrders', '_finishedOrders']:
+                orders = {order.ID: order for order in state[attr]}
+                self._orders.update(orders)
+                setattr(self, attr, orders)
+        if '_seq' not in state:
+            self._seq = 0
+        self._initTransient()
+        for order in self._orders.values():
+            order._listener = self._record
+            # orders saved before line prices were captured are priced once here
+            order.calculateTotalPrice(self._inventory)
 
     @property
     def inventory(self):
@@ -16,39 +80,103 @@ class RestaurantSystem:
 
     @property
     def activeOrders(self):
-        return self._activeOrders
+        with self._stateLock:
+            return list(self._activeOrders.values())
 
     @property
     def pendingOrders(self):
-        return self._pendingOrders
+        with self._stateLock:
+            return list(self._pendingOrders.values())
 
     @property
     def finishedOrders(self):
-        return self._finishedOrders
+        with self._stateLock:
+            return list(self._finishedOrders.values())
 
     @property
     def orderIDCounter(self):
         return self._orderIDCounter
 
+    @property
+    def eventCounts(self):
+        # {event kind: count} for orders created, checked out, prepared and so on
+        with self._eventLock:
+            return dict(self._eventCounts)
+
     def createOrder(self):
-        order = Order(self._orderIDCounter)
-        self._orderIDCounter += 1
-        self._pendingOrders.append(order)
+        # IDs are allocated and journalled under one lock so concurrent orders never share an ID
+        with self._stateLock:
+            order = Order(self._orderIDCounter)
+            self._orderIDCounter += 1
+            order._listener = self._record
+            self._orders[order.ID] = order
+            self._pendingOrders[order.ID] = order
+            self._record("create", order=order.ID)
         return order
 
+    @traced("system.getOrderFromID")
     def getOrderFromID(self, ID):
-        for orderList in [self._pendingOrders, self._activeOrders, self._finishedOrders]:
-            for order in orderList:
-                if order.ID == ID:
-                    return order
-        raise SystemError("Incorrect order ID entered.")
+        try:
+            return self._orders[ID]
+        except KeyError:
+            order = self._archived(ID)
+            if order is None:
+                raise SystemError("Incorrect order ID entered.")
+            return order
 
     def getPaidOrderFromID(self, ID):
-        for orderList in [self._activeOrders, self._finishedOrders]:
-            for order in orderList:
-                if order.ID == ID:
-                    return order
-        raise SystemError("Incorrect order ID entered.")
+        order = self._activeOrders.get(ID) or self._finishedOrders.get(ID) or self._archived(ID)
+        if order is None:
+            raise SystemError("Incorrect order ID entered.")
+        return order
+
+    def _archived(self, ID):
+        if self._archive is None:
+            return None
+        return self._archive.get(ID, self._inventory)
+
+    def attachArchive(self, archive, policy):
+        self._archive = archive
+        self._archivePolicy = policy
+
+    def archiveFinished(self, now=None):
+        # move the finished orders the policy no longer wants in memory to the archive
+        if self._archive is None:
+            return 0
+        now = time.time() if now is None else now
+        with self._stateLock:
+            IDs = list(self._finishedOrders)
+        orders = ((ID, self._finishedOrders[ID]) for ID in IDs)
+        archived = self._archivePolicy.select(len(IDs), orders, now)
+        if not archived:
+            return 0
+        # finished orders never change, so they can be written out without holding the lock
+        self._archive.append(archived)
+        self._dropArchived([order.ID for order in archived])
+        self._record("archive", orders=[order.ID for order in archived])
+        return len(archived)
+
+    def _dropArchived(self, IDs):
+        with self._stateLock:
+            self._changed(IDs)
+            for ID in IDs:
+                if ID in self._finishedOrders:
+                    del self._finishedOrders[ID]
+                    self._orders.pop(ID, None)
+
+    def archiveStats(self):
+        with self._stateLock:
+            stats = {"pendingOrders": len(self._pendingOrders), "activeOrders": len(self._activeOrders),
+                     "finishedOrders": len(self._finishedOrders)}
+        history = self._finishedOrders
+        # finished orders actually held as objects, rather than still encoded in the snapshot
+        stats["finishedInMemory"] = history.resident if hasattr(history, "resident") else len(history)
+        stats["archivedOrders"] = self._archive.count if self._archive is not None else 0
+        stats["archiveBytes"] = self._archive.size if self._archive is not None else 0
+        if resource is not None:
+            # peak resident set size of the process, in KiB on Linux
+            stats["maxRSS"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return stats
 
     def seeOrderStatusFromID(self, ID):
         # returns boolean value for if order is prepared
@@ -61,34 +189,65 @@ class RestaurantSystem:
             else:
                 return "Your order is being prepared."
 
-    def orderPrepared(self, ID):
+    # State transitions hold the order's lock, so checkout, cancel and prepared
+    # for the same order are serialised and each sees the state the last one left.
+    def orderPrepared(self, ID, at=None):
         order = self.getOrderFromID(ID)
-        if order not in self._activeOrders:
-            raise SystemError("Order is not active.")
-        else:
-            order.updatePrepared()
-            self._activeOrders.remove(order)
-            self._finishedOrders.append(order)
+        with order.lock:
+            if ID not in self._activeOrders:
+                raise SystemError("Order is not active.")
+            else:
+                order.updatePrepared(at)
+                with self._stateLock:
+                    del self._activeOrders[ID]
+                    self._finishedOrders[ID] = order
+                self._record("prepared", order=ID, at=order.preparedAt)
 
+    @traced("system.checkout")
     def checkout(self, ID):
         #calls external payment system
         #returns bool to indicate whether payment was successful
         order = self.getOrderFromID(ID)
-        if order not in self._pendingOrders:
-            raise SystemError("Order is not pending.")
-        else:
-            payStatus = True
-            order.submitAndPay(payStatus)
-            self._pendingOrders.remove(order)
-            self._activeOrders.append(order)
+        with order.lock:
+            if ID not in self._pendingOrders:
+                raise SystemError("Order is not pending.")
+            else:
+                payStatus = True
+                order.submitAndPay(payStatus)
+                order.commitStock(self._inventory)
+                with self._stateLock:
+                    del self._pendingOrders[ID]
+                    self._activeOrders[ID] = order
+                self._record("checkout", order=ID)
+
+    def submitBasket(self, basket):
+        # Create, fill and check out an order in one step. Every line is checked
+        # first and all of the stock is taken in one reservation, so either the
+        # whole basket is ordered or none of it is.
+        lines, units = basket.resolve(self._inventory)
+        try:
+            token = self._inventory.reserveResolved(units)
+        except InventoryError as ie:
+            # another order took the stock since the check
+            raise BasketError([{"section": "stock", "index": None, "msg": ie.msg}])
+        order = self.createOrder()
+        order.addLines(lines, token)
+        self.checkout(order.ID)
+        return order
 
     def cancelOrder(self, ID):
         order = self.getOrderFromID(ID)
-        if order not in self._pendingOrders:
-            raise SystemError("Order is not pending.")
-        else:
-            order.cancel(self._inventory)
-            self._pendingOrders.remove(order)
+        with order.lock:
+            if ID not in self._pendingOrders:
+                raise SystemError("Order is not pending.")
+            else:
+                # journalled before the stock is returned, so any order that goes on
+                # to use the returned stock is always replayed after this cancel
+                self._record("cancel", order=ID)
+                order.cancel(self._inventory)
+                with self._stateLock:
+                    del self._pendingOrders[ID]
+                    del self._orders[ID]
 
     def displayActiveOrders(self):
         parts = []
@@ -98,15 +257,154 @@ class RestaurantSystem:
         final = "\n".join(parts)
         return final
     
-    @classmethod
-    def loadData(cls):
+    def _changed(self, IDs):
+        if self._changedOrders is not None:
+            self._changedOrders.update(IDs)
+
+    def trackChanges(self):
+        # From here on remember what changes, so storage can write just those
+        # records. Ingredients and orders flag themselves dirty; the system keeps
+        # the IDs of orders that changed state or were removed.
+        for ingredient in self._inventory.ingredients:
+            ingredient.markClean()
+        with self._stateLock:
+            for order in list(self._pendingOrders.values()) + list(self._activeOrders.values()):
+                order.markClean()
+            self._changedOrders = set()
+
+    def takeChanges(self):
+        # (ingredients, [(order, state)], removed IDs) changed since the last call, marked clean again
+        ingredients = [ingredient for ingredient in self._inventory.ingredients if ingredient.dirty]
+        for ingredient in ingredients:
+            ingredient.markClean()
+        orders = []
+        removed = []
+        with self._stateLock:
+            for ID in sorted(self._changedOrders):
+                if ID in self._pendingOrders:
+                    orders.append((self._pendingOrders[ID], "pending"))
+                elif ID in self._activeOrders:
+                    orders.append((self._activeOrders[ID], "active"))
+                elif ID in self._finishedOrders:
+                    orders.append((self._finishedOrders[ID], "finished"))
+                else:
+                    removed.append(ID)
+            self._changedOrders = set()
+        for order, state in orders:
+            order.markClean()
+        return ingredients, orders, removed
+
+    def _record(self, event, **data):
+        # buffer a domain event until the next saveData appends it to the journal
+        if 'order' in data:
+            self._changed([data['order']])
+        if self._replaying:
+            return
+        with self._eventLock:
+            self._seq += 1
+            data['seq'] = self._seq
+            data['event'] = event
+            self._events.append(data)
+            self._eventCounts[event] = self._eventCounts.get(event, 0) + 1
+
+    def _apply(self, event):
+        # re-run a journalled event through the normal domain methods
+        kind = event['event']
+        if kind == "create":
+            self._orderIDCounter = event['order']
+            self.createOrder()
+        elif kind == "main":
+            order = self.getOrderFromID(event['order'])
+            if event['main'] == "burger":
+                order.addBurgerMain(self._inventory, event['ingredients'])
+            else:
+                order.addWrapMain(self._inventory, event['ingredients'])
+        elif kind == "side":
+            order = self.getOrderFromID(event['order'])
+            order.addSide(self._inventory, event['name'], event['quantity'], event['size'])
+        elif kind == "drink":
+            order = self.getOrderFromID(event['order'])
+            order.addDrink(self._inventory, event['name'], event['quantity'], event['size'])
+        elif kind == "checkout":
+            self.checkout(event['order'])
+        elif kind == "prepared":
+            self.orderPrepared(event['order'], event.get('at'))
+        elif kind == "cancel":
+            self.cancelOrder(event['order'])
+        elif kind == "archive":
+            self._dropArchived(event['orders'])
+        elif kind == "stock":
+            self._inventory.updateInventory(event['ingredients'])
+        elif kind == "ingredient":
+            self._inventory.addIngredient(event['name'], event['price'], event['quantity'],
+                IngredientType(event['iType']), event['servingSizes'], event['unit'])
+        else:
+            raise SystemError("Unknown journal event " + str(kind))
+        self._seq = event['seq']
+
+    def _replay(self, events):
+        # An order event the state cannot take, such as a line for an order that
+        # no longer exists, refuses the rest of that order's events too, so the
+        # order stays as it was rather than being paid for without the line. Any
+        # other event that cannot be replayed stops the load.
+        refused = {}
+        self._replaying = True
         try:
-            with open('system.dat', 'rb') as file:
-                system = pickle.load(file)
-        except IOError:
-            system = RestaurantSystem()
+            for event in events:
+                # events up to self._seq are already contained in the stored state
+                if event['seq'] <= self._seq:
+                    continue
+                ID = event.get('order')
+                if ID in refused:
+                    refused[ID] += 1
+                    self._seq = event['seq']
+                    continue
+                try:
+                    self._apply(event)
+                except (SystemError, OrderError, InventoryError) as e:
+                    if ID is None:
+                        raise
+                    logger.error("Journal event %s (%s) for order %s cannot be replayed: %s", event['seq'],
+                                 event['event'], ID, e.msg)
+                    refused[ID] = 1
+                    self._seq = event['seq']
+        finally:
+            self._replaying = False
+        if refused:
+            logger.error("Refused %d journal events for orders %s", sum(refused.values()), sorted(refused))
+
+    @property
+    def storage(self):
+        return self._storage
+
+    @classmethod
+    def loadData(cls, path=SNAPSHOT_FILE, journalPath=JOURNAL_FILE, storage=None):
+        # startup: rebuild the system from storage, by default the pickle snapshot and journal
+        if storage is None:
+            storage = JournalStorage(path, journalPath)
+        system = storage.load(cls)
+        system._storage = storage
         return system
-    
+
+    @traced("system.saveData", root=True)
     def saveData(self):
-        with open('system.dat', 'wb') as file:
-            pickle.dump(self, file)
+        # hand the events recorded since the last save to storage; cost depends on the change, not the history
+        # every worker's writer and the coordinator save the same system, so archiving,
+        # taking the batch and storing it are one step; otherwise a later batch can land first
+        with self._saveLock:
+            self.archiveFinished()
+            with self._eventLock:
+                events, self._events = self._events, []
+            if self._storage is None:
+                # not loaded from disk (e.g. a freshly bootstrapped system), so whatever is
+                # stored there belongs to another system; start over from a full copy
+                self._storage = JournalStorage(SNAPSHOT_FILE, JOURNAL_FILE)
+                self._storage.write(self)
+                return
+            try:
+                self._storage.append(events)
+            except Exception:
+                # keep the events buffered so the next save retries them
+                with self._eventLock:
+                    self._events = events + self._events
+                raise
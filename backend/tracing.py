@@ -0,0 +1,157 @@
+from functools import wraps
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+# Sampled traces of where a request spends its time. A trace is a tree of
+# spans: the request at the root, then form parsing, order lookups, stock
+# checks, pricing, rendering and so on beneath it. Finished traces are
+# appended to a JSONL file, one trace per line; traces.py prints the slowest.
+#
+# Tracing is off unless RESTAURANT_TRACE names the file to write, with
+# RESTAURANT_TRACE_SAMPLE the share of requests traced (default 0.01). While it
+# is off, traced() leaves functions undecorated and span() returns a shared
+# do-nothing span, so instrumented code runs as if it were not instrumented.
+
+DEFAULT_SAMPLE = 0.01
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+NO_SPAN = _NoSpan()
+
+class Span:
+    __slots__ = ["_tracer", "name", "attrs", "start", "ms", "children"]
+
+    def __init__(self, tracer, name, attrs):
+        self._tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.ms = None
+        self.children = []
+
+    def set(self, **attrs):
+        # attributes only known part way through, such as a response status
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._tracer._push(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.ms = 1000 * (time.perf_counter() - self.start)
+        if exc[0] is not None:
+            self.attrs["error"] = exc[0].__name__
+        self._tracer._pop(self)
+        return False
+
+    def record(self, origin):
+        record = {"name": self.name, "offset": round(1000 * (self.start - origin), 3), "ms": round(self.ms, 3)}
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if self.children:
+            record["spans"] = [child.record(origin) for child in self.children]
+        return record
+
+class Tracer:
+    def __init__(self, path, sample=DEFAULT_SAMPLE):
+        self._path = path
+        self._sample = sample
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._written = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def written(self):
+        return self._written
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def trace(self, name, **attrs):
+        # a span that starts a trace, if this one is sampled; inside a trace it is just a span
+        if not self._stack() and random.random() >= self._sample:
+            return NO_SPAN
+        return Span(self, name, attrs)
+
+    def span(self, name, **attrs):
+        # a span in the current trace; nothing when the thread is not tracing
+        if not self._stack():
+            return NO_SPAN
+        return Span(self, name, attrs)
+
+    def _push(self, span):
+        self._stack().append(span)
+
+    def _pop(self, span):
+        stack = self._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children.append(span)
+        else:
+            self._write(span)
+
+    def _write(self, root):
+        record = {"trace": next(self._ids), "at": time.time()}
+        record.update(root.record(root.start))
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            with open(self._path, "a") as file:
+                file.write(line)
+            self._written += 1
+
+# the process wide tracer; None while tracing is off
+tracer = None
+
+def configure(path, sample=DEFAULT_SAMPLE):
+    # turn tracing on; only functions decorated after this are traced
+    global tracer
+    tracer = Tracer(path, sample) if path else None
+    return tracer
+
+def trace(name, **attrs):
+    if tracer is None:
+        return NO_SPAN
+    return tracer.trace(name, **attrs)
+
+def span(name, **attrs):
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, **attrs)
+
+def traced(name, root=False):
+    # decorator for a span around every call; root calls start their own trace
+    # when made outside one, such as saves on the persistence thread
+    def decorate(function):
+        if tracer is None:
+            return function
+        start = tracer.trace if root else tracer.span
+        @wraps(function)
+        def traced(*args, **kwargs):
+            with start(name):
+                return function(*args, **kwargs)
+        return traced
+    return decorate
+
+if os.environ.get("RESTAURANT_TRACE"):
+    configure(os.environ["RESTAURANT_TRACE"], float(os.environ.get("RESTAURANT_TRACE_SAMPLE", DEFAULT_SAMPLE)))
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class PersistenceWriter:
+    # Background worker that group-commits persistence. Request handlers call
+    # markDirty() and return straight away; the worker calls save() at most once
+    # per interval, or as soon as maxPending changes have built up.
+    def __init__(self, save, interval=1.0, maxPending=50):
+        self._save = save
+        self._interval = interval
+        self._maxPending = maxPending
+        self._pending = 0
+        self._flushes = 0
+        self._lastFlush = time.monotonic()
+        self._running = False
+        self._thread = None
+        self._cond = threading.Condition()
+        # serialises save() between the worker and synchronous flush() calls
+        self._saveLock = threading.Lock()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @property
+    def flushes(self):
+        return self._flushes
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+        self._thread.start()
+
+    def markDirty(self):
+        with self._cond:
+            self._pending += 1
+            if self._pending == 1 or self._pending >= self._maxPending:
+                self._cond.notify()
+
+    def flush(self):
+        # synchronous save of everything marked dirty so far, for shutdown and tests
+        with self._saveLock:
+            with self._cond:
+                pending, self._pending = self._pending, 0
+                self._lastFlush = time.monotonic()
+            if pending == 0:
+                return
+            try:
+                self._save()
+            except Exception:
+                # leave the changes marked dirty so the worker retries them
+                with self._cond:
+                    self._pending += max(pending, 1)
+                raise
+            self._flushes += 1
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    if self._pending >= self._maxPending:
+                        break
+                    if self._pending > 0:
+                        remaining = self._lastFlush + self._interval - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # keep the worker alive; the changes are retried after the next interval
+                logger.exception("Persistence flush failed")
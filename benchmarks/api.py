@@ -0,0 +1,91 @@
+# Cost per request of the JSON API against the HTML routes for the same order.
+#
+# Each order goes through the same steps both ways: create, add a standard
+# burger, add fries and a drink, review, checkout and check the status. The
+# app runs in-process through Flask's test client, against a fresh system in a
+# temporary directory, so the numbers are the server side cost of each request.
+#
+#   python -m benchmarks.api [orders]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.inventory import IngredientType
+
+STOCK = 10 ** 9
+
+def stock(system):
+    inv = system.inventory
+    regularSize = {"regular": 1}
+    for name in ["tomato", "cheddar cheese", "lettuce"]:
+        inv.addIngredient(name, 1, STOCK, IngredientType.FILLING, regularSize)
+    inv.addIngredient("sesame bun", 1, STOCK, IngredientType.BURGERBUN, regularSize)
+    for name in ["chicken", "beef"]:
+        inv.addIngredient(name, 4, STOCK, IngredientType.PATTY, regularSize)
+    inv.addIngredient("flatbread", 1, STOCK, IngredientType.WRAP, regularSize)
+    inv.addIngredient("fries", 0.01, STOCK, IngredientType.SIDE, {"small": 100, "medium": 150, "large": 200}, "g")
+    inv.addIngredient("can coke", 3, STOCK, IngredientType.DRINK, regularSize)
+
+def htmlOrder(client):
+    # the responses of one order placed through the HTML routes
+    created = client.get('/main/create')
+    orderID = created.headers["Location"].rstrip("/").rsplit("/", 1)[1]
+    return [created,
+            client.post('/main/' + orderID, data={"recipe": "standard burger"}),
+            client.post('/sidedrink/' + orderID, data={"fries": "1", "fries_size": "medium",
+                                                       "can coke": "1", "can coke_size": "regular"}),
+            client.get('/' + orderID + '/review'),
+            client.get('/' + orderID + '/checkout'),
+            client.get('/' + orderID + '/status')]
+
+def apiOrder(client):
+    # the same order through the JSON API
+    created = client.post('/api/orders')
+    orderID = str(created.get_json()["id"])
+    return [created,
+            client.post('/api/orders/' + orderID + '/mains', json={"recipe": "standard burger"}),
+            client.post('/api/orders/' + orderID + '/sides', json={"name": "fries", "quantity": 1, "size": "medium"}),
+            client.post('/api/orders/' + orderID + '/drinks',
+                        json={"name": "can coke", "quantity": 1, "size": "regular"}),
+            client.get('/api/orders/' + orderID),
+            client.post('/api/orders/' + orderID + '/checkout'),
+            client.get('/api/orders/' + orderID + '/status')]
+
+def measure(client, placeOrder, orders):
+    requests = 0
+    began = time.perf_counter()
+    for i in range(orders):
+        requests += len(placeOrder(client))
+    return requests, time.perf_counter() - began
+
+def main():
+    orders = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # the app loads and saves its state in the working directory
+    os.chdir(tempfile.mkdtemp())
+    from run import app
+    from server import system, writer
+    stock(system)
+    client = app.test_client()
+    # warm up templates and compiled recipes
+    htmlOrder(client)
+    apiOrder(client)
+
+    print("{} orders each way".format(orders))
+    print("{:>6} {:>10} {:>12} {:>14}".format("", "seconds", "ms/request", "bytes/order"))
+    results = {}
+    sizes = {}
+    for name, placeOrder in [("html", htmlOrder), ("api", apiOrder)]:
+        requests, elapsed = measure(client, placeOrder, orders)
+        results[name] = elapsed / requests
+        sizes[name] = sum(len(response.data) for response in placeOrder(client))
+        print("{:>6} {:>10.2f} {:>12.3f} {:>14}".format(name, elapsed, 1000 * results[name], sizes[name]))
+    # the API mostly saves bytes on the wire; server time per request is close
+    print("api sends {:.1f}x fewer bytes per order, at {:.2f}x the time per request".format(
+        sizes["html"] / sizes["api"], results["api"] / results["html"]))
+    writer.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# Order throughput with N web worker processes sharing one coordinator.
+#
+# Each simulated request makes the same system calls as the routes for one
+# order (create, add a standard burger and fries, checkout) and then does a
+# fixed amount of worker-local work standing in for form parsing and template
+# rendering, which is the part that extra worker processes run in parallel.
+#
+# Every system call goes through the one coordinator, so the run is repeated
+# with no local work at all to show how far the shared state itself scales.
+# "ms/call" is the mean time a worker waits on each coordinator call and
+# "calls/sec" the calls the coordinator served per second across all workers.
+#
+#   python -m benchmarks.multiprocess [requests per worker] [max workers]
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.system import RestaurantSystem
+from backend.inventory import IngredientType
+from backend.shared import serve, connect
+
+AUTHKEY = b"benchmark"
+STOCK = 10 ** 9
+# rows of the simulated rendered page per request; each run is also repeated with none
+RENDER_ROWS = 2000
+
+def buildSystem():
+    system = RestaurantSystem()
+    inv = system.inventory
+    regularSize = {"regular": 1}
+    for name in ["tomato", "cheddar cheese", "lettuce"]:
+        inv.addIngredient(name, 1, STOCK, IngredientType.FILLING, regularSize)
+    inv.addIngredient("sesame bun", 1, STOCK, IngredientType.BURGERBUN, regularSize)
+    for name in ["chicken", "beef"]:
+        inv.addIngredient(name, 4, STOCK, IngredientType.PATTY, regularSize)
+    inv.addIngredient("flatbread", 1, STOCK, IngredientType.WRAP, regularSize)
+    inv.addIngredient("fries", 0.01, STOCK, IngredientType.SIDE, {"small": 100, "medium": 150, "large": 200}, "g")
+    return system
+
+def runCoordinator(ready):
+    serve(buildSystem(), ("127.0.0.1", 0), AUTHKEY, ready.put)
+
+def render(order, total, rows):
+    rows = ["<tr><td>{}</td><td>{}</td><td>${:0.1f}</td></tr>".format(order.ID, i, total) for i in range(rows)]
+    return "".join(rows)
+
+def runWorker(address, requests, rows, start, results):
+    system = connect(address, AUTHKEY)
+    IDs = []
+    # seconds spent waiting on the coordinator, over this many calls
+    waited = [0.0, 0]
+    def call(function, *args):
+        began = time.perf_counter()
+        result = function(*args)
+        waited[0] += time.perf_counter() - began
+        waited[1] += 1
+        return result
+    start.wait()
+    for i in range(requests):
+        order = call(system.createOrder)
+        call(order.addStandardBurger, system.inventory)
+        call(order.addSide, system.inventory, "fries", 1, "medium")
+        total = call(order.calculateTotalPrice)
+        if rows:
+            render(order, total, rows)
+        call(system.checkout, order.ID)
+        IDs.append(order.ID)
+    results.put((IDs, waited[0], waited[1]))
+
+def measure(address, workers, requests, rows):
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=runWorker, args=(address, requests, rows, start, results))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    began = time.perf_counter()
+    start.set()
+    IDs = []
+    waited = calls = 0
+    for process in processes:
+        workerIDs, workerWaited, workerCalls = results.get()
+        IDs += workerIDs
+        waited += workerWaited
+        calls += workerCalls
+    elapsed = time.perf_counter() - began
+    for process in processes:
+        process.join()
+    return IDs, elapsed, waited / calls, calls / elapsed
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    maxWorkers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    ready = multiprocessing.Queue()
+    coordinator = multiprocessing.Process(target=runCoordinator, args=(ready,), daemon=True)
+    coordinator.start()
+    address = ready.get()
+    system = connect(address, AUTHKEY)
+
+    print("{} CPUs, {} requests per worker".format(os.cpu_count(), requests))
+    allIDs = []
+    for rows in [RENDER_ROWS, 0]:
+        print()
+        print("{} rendered rows per request".format(rows))
+        print("{:>8} {:>10} {:>12} {:>8} {:>9} {:>10}".format("workers", "seconds", "orders/sec", "scaling", "ms/call",
+                                                             "calls/sec"))
+        baseline = None
+        workers = 1
+        while workers <= maxWorkers:
+            IDs, elapsed, latency, callRate = measure(address, workers, requests, rows)
+            allIDs += IDs
+            throughput = len(IDs) / elapsed
+            if baseline is None:
+                baseline = throughput
+            print("{:>8} {:>10.2f} {:>12.1f} {:>7.2f}x {:>9.3f} {:>10.0f}".format(workers, elapsed, throughput,
+                  throughput / baseline, 1000 * latency, callRate))
+            workers *= 2
+
+    # every order got its own ID and took exactly its stock
+    assert len(set(allIDs)) == len(allIDs)
+    assert system.inventory.getIngredient("beef").quantity == STOCK - len(allIDs)
+    assert system.inventory.getIngredient("fries").quantity == STOCK - 150 * len(allIDs)
+    print("{} orders, IDs unique and stock consistent".format(len(allIDs)))
+    coordinator.terminate()
+
+if __name__ == "__main__":
+    main()
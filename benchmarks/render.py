@@ -0,0 +1,116 @@
+# Menu page render time as the inventory grows: the burger and side/drink pages
+# with their menu rows cached per inventory version, rendered fresh on every
+# request, and with the per-section scan the templates used to do.
+#
+# Every column requests the same two pages through Flask's test client, so each
+# includes routing and the rest of the page; only the menu rows differ. "scan"
+# renders them as the templates did before the menu existed: every section loops
+# over every ingredient and looks each one up again by name. "fresh" renders the
+# rows from the menu on each request, and "cached" reuses them until the
+# inventory version moves.
+#
+#   python -m benchmarks.render [ingredient counts...]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.inventory import IngredientType
+from markupsafe import Markup
+
+STOCK = 10 ** 6
+REQUESTS = 200
+
+# the menu rows of one section as the templates rendered them before they were cached
+SCAN = {
+    'fragments/mainrows.html': '''
+{% for item in system.inventory.ingredients %}
+    {% if item.iType == it %}
+        {% if item.quantity > 0 %}
+            <tr><td>{{item.name | title}}</td>
+            <td><input type="number" name="{{item.name}}" min="0"
+                max="{{system.inventory.getIngredient(item.name).quantity}}" step="1" placeholder="0"/></td></tr>
+        {% endif %}
+    {% endif %}
+{% endfor %}
+''',
+    'fragments/sidedrinkrows.html': '''
+{% for ingredient in system.inventory.ingredients %}
+    {% if ingredient.iType == it %}
+        {% if system.inventory.getIngredient(ingredient.name).quantity > ingredient.servingSizes[ingredient.servingSizes|first] %}
+            <tr><td>{{ingredient.name | title}}</td><td><select name="{{ingredient.name}}_size">
+            {% for size in ingredient.servingSizes %}
+                {% if system.inventory.getIngredient(ingredient.name).quantity >= ingredient.servingSizes[size] %}
+                    <option value="{{size}}">{{size|capitalize}}</option>
+                {% endif %}
+            {% endfor %}
+            </select></td>
+            <td><input type="number" name="{{ingredient.name}}" min="0"
+                max="{{system.inventory.getIngredient(ingredient.name).quantity}}" step="1" placeholder="0"/></td></tr>
+        {% endif %}
+    {% endif %}
+{% endfor %}
+''',
+}
+
+class ScanRows:
+    # stands in for the fragment cache, rendering every section with its old scan
+    def __init__(self, env, system):
+        self._system = system
+        self._templates = {name: env.from_string(source) for name, source in SCAN.items()}
+
+    def render(self, menu, template, iType, **context):
+        return Markup(self._templates[template].render(system=self._system, it=iType))
+
+def stock(system, count):
+    # add ingredients spread over the menu sections until there are count of them
+    inv = system.inventory
+    regularSize = {"regular": 1}
+    sections = [(IngredientType.BURGERBUN, regularSize), (IngredientType.PATTY, regularSize),
+                (IngredientType.FILLING, regularSize), (IngredientType.SIDE, {"small": 100, "medium": 150, "large": 200}),
+                (IngredientType.DRINK, regularSize)]
+    for i in range(len(inv.ingredients), count):
+        iType, sizes = sections[i % len(sections)]
+        inv.addIngredient("{} {}".format(iType.name.lower(), i), 1, STOCK, iType, sizes)
+
+def timed(function, requests):
+    began = time.perf_counter()
+    for i in range(requests):
+        function()
+    return 1000 * (time.perf_counter() - began) / requests
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [50, 500, 5000]
+    # the app loads and saves its state in the working directory
+    os.chdir(tempfile.mkdtemp())
+    from run import app
+    from server import system, writer
+    from routes import fragments
+    client = app.test_client()
+    scan = ScanRows(app.jinja_env, system)
+
+    print("{:>12} {:>10} {:>10} {:>10}".format("ingredients", "scan ms", "fresh ms", "cached ms"))
+    for count in counts:
+        stock(system, count)
+        orderID = str(system.createOrder().ID)
+        def pages():
+            client.get('/burger/' + orderID)
+            client.get('/sidedrink/' + orderID)
+        def fresh():
+            fragments.clear()
+            pages()
+        requests = max(10, REQUESTS * 50 // count)
+        app.jinja_env.globals["fragments"] = scan
+        pages()
+        scanTime = timed(pages, requests)
+        app.jinja_env.globals["fragments"] = fragments
+        freshTime = timed(fresh, requests)
+        pages()
+        cachedTime = timed(pages, requests)
+        print("{:>12} {:>10.2f} {:>10.2f} {:>10.2f}".format(count, scanTime, freshTime, cachedTime))
+    writer.stop()
+
+if __name__ == "__main__":
+    main()
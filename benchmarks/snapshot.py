@@ -0,0 +1,99 @@
+# Snapshot save and load time and file size: the binary snapshot with each
+# section codec against pickling the whole system, as system.dat used to be.
+#
+# Most orders are finished, as in a long running restaurant; the rest are
+# pending or active. "load" is what startup pays, which for the snapshot leaves
+# finished orders encoded in the file; "load all" also decodes every order.
+#
+#   python -m benchmarks.snapshot [order counts...]
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.system import RestaurantSystem
+from backend.inventory import IngredientType
+from backend.snapshot import writeSnapshot, loadSnapshot, RAW, ZLIB, LZMA, lzma
+
+STOCK = 10 ** 9
+
+def buildSystem(orders):
+    system = RestaurantSystem()
+    inv = system.inventory
+    regularSize = {"regular": 1}
+    for name in ["tomato", "cheddar cheese", "lettuce"]:
+        inv.addIngredient(name, 1, STOCK, IngredientType.FILLING, regularSize)
+    inv.addIngredient("sesame bun", 1, STOCK, IngredientType.BURGERBUN, regularSize)
+    for name in ["chicken", "beef"]:
+        inv.addIngredient(name, 4, STOCK, IngredientType.PATTY, regularSize)
+    inv.addIngredient("flatbread", 1, STOCK, IngredientType.WRAP, regularSize)
+    inv.addIngredient("fries", 0.01, STOCK, IngredientType.SIDE, {"small": 100, "medium": 150, "large": 200}, "g")
+    inv.addIngredient("can coke", 3, STOCK, IngredientType.DRINK, regularSize)
+    for i in range(orders):
+        order = system.createOrder()
+        order.addStandardBurger(inv)
+        order.addSide(inv, "fries", 1, "medium")
+        order.addDrink(inv, "can coke", 1, "regular")
+        # one order in twenty is still pending, one in twenty active
+        if i % 20 != 0:
+            system.checkout(order.ID)
+            if i % 20 != 1:
+                system.orderPrepared(order.ID)
+    return system
+
+def timed(function):
+    began = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - began
+
+def decodeAll(system):
+    for order in system.finishedOrders:
+        order.calculateTotalPrice()
+    return system
+
+def measurePickle(system, path):
+    def save():
+        with open(path, 'wb') as file:
+            pickle.dump(system, file)
+    def load():
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    ignored, saveTime = timed(save)
+    ignored, loadTime = timed(load)
+    return saveTime, loadTime, loadTime, os.path.getsize(path)
+
+def measureSnapshot(system, path, codec):
+    def save():
+        with open(path, 'wb') as file:
+            writeSnapshot(system, file, codec)
+    ignored, saveTime = timed(save)
+    ignored, loadTime = timed(lambda: loadSnapshot(path, RestaurantSystem))
+    ignored, loadAllTime = timed(lambda: decodeAll(loadSnapshot(path, RestaurantSystem)))
+    return saveTime, loadTime, loadAllTime, os.path.getsize(path)
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    formats = [("pickle", None), ("raw", RAW), ("zlib", ZLIB)]
+    if lzma is not None:
+        formats.append(("lzma", LZMA))
+    directory = tempfile.mkdtemp()
+    print("{:>9} {:>7} {:>9} {:>9} {:>9} {:>10}".format("orders", "format", "save s", "load s", "load all", "MiB"))
+    for count in counts:
+        system = buildSystem(count)
+        for name, codec in formats:
+            path = os.path.join(directory, "system." + name)
+            if codec is None:
+                result = measurePickle(system, path)
+            else:
+                result = measureSnapshot(system, path, codec)
+            saveTime, loadTime, loadAllTime, size = result
+            print("{:>9} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>10.2f}".format(count, name, saveTime, loadTime,
+                                                                           loadAllTime, size / 2 ** 20))
+            os.remove(path)
+    os.rmdir(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from backend.system import RestaurantSystem, SNAPSHOT_FILE
+from backend.storage import SQLiteStorage
+from backend.shared import serve
+from backend.recipes import recipes
+from backend.archive import OrderArchive, ArchivePolicy
+import os
+
+# Storage backend: "pickle" keeps system.dat and its journal, "sqlite" keeps system.db
+STORAGE = os.environ.get("RESTAURANT_STORAGE", "pickle")
+SQLITE_FILE = 'system.db'
+
+# Finished orders move out of memory into the archive file once more than
+# ARCHIVE_MAX_FINISHED are held, or ARCHIVE_MAX_AGE seconds after they were prepared
+ARCHIVE_FILE = 'system.archive'
+ARCHIVE_MAX_FINISHED = 1000
+ARCHIVE_MAX_AGE = 24 * 60 * 60
+
+# Multi-process mode: the coordinator owns the system and web workers connect to
+# it at this host:port with this shared key
+COORDINATOR_ADDRESS = os.environ.get("RESTAURANT_COORDINATOR", "127.0.0.1:50000")
+COORDINATOR_KEY = os.environ.get("RESTAURANT_COORDINATOR_KEY")
+
+def loadSystem():
+    if STORAGE == "sqlite":
+        storage = SQLiteStorage(SQLITE_FILE)
+        if storage.empty and os.path.exists(SNAPSHOT_FILE):
+            # first run on SQLite: carry the pickled system over
+            storage.write(RestaurantSystem.loadData())
+        system = RestaurantSystem.loadData(storage=storage)
+    else:
+        system = RestaurantSystem.loadData()
+    system.attachArchive(OrderArchive(ARCHIVE_FILE), ArchivePolicy(ARCHIVE_MAX_FINISHED, ARCHIVE_MAX_AGE))
+    # compile the standard menu up front rather than on the first order
+    recipes.compile(system.inventory)
+    return system
+
+def coordinatorAddress():
+    host, port = COORDINATOR_ADDRESS.rsplit(":", 1)
+    return (host, int(port))
+
+def coordinatorKey():
+    if not COORDINATOR_KEY:
+        raise SystemExit("Set RESTAURANT_COORDINATOR_KEY to the key shared with the web workers")
+    return COORDINATOR_KEY.encode()
+
+if __name__ == "__main__":
+    system = loadSystem()
+    print("Coordinator listening on " + COORDINATOR_ADDRESS)
+    try:
+        serve(system, coordinatorAddress(), coordinatorKey())
+    finally:
+        system.saveData()
@@ -3,6 +3,9 @@ from server import system
 from backend.system import RestaurantSystem
 from backend.errors import OrderError, InventoryError
 from backend.inventory import IngredientType
+from monitoring import validationSeconds
+from backend.tracing import span
+import time
 
 '''
 ERRORS
@@ -15,38 +18,186 @@ class ParseError(Exception):
 
 
 
+'''
+FIELDS
+'''
+class Pipeline():
+    '''
+    How every field of one form class is parsed: the input is converted to an
+    integer once, then checked by each validator in turn. Compiled once per
+    form class and shared by all of its fields.
+    '''
+    def __init__(self, integerError, validators):
+        self._integerError = integerError
+        self._validators = tuple(validators)
+
+    def convert(self, name, raw_data):
+        try:
+            return int(raw_data)
+        except (TypeError, ValueError):
+            raise ParseError(self._integerError.format(name))
+
+    def validate(self, name, value, form, stock):
+        for v in self._validators:
+            v.validate(name, value, form, stock)
+
+class Field():
+    def __init__(self, name, pipeline):
+        self._name = name
+        self._pipeline = pipeline
+        self._error     = None
+        self._raw_data  = None
+        self._data      = None
+
+    def parse(self, raw_data, form, stock):
+        '''
+        raw_data: user input for the field
+        form: the whole form input, for validators that read other inputs
+        stock: the request's StockView
+        '''
+        self._raw_data = raw_data
+        try:
+            # transform raw_data (of type string) into an integer, then validate it
+            self._data = self._pipeline.convert(self._name, raw_data)
+            self._pipeline.validate(self._name, self._data, form, stock)
+        except ParseError as pe:
+            self._error = str(pe)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def data(self):
+        # the input as an integer, or None if it is not one
+        return self._data
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def raw_data(self):
+        return self._raw_data
+    
+    @property
+    def is_valid(self):
+        return self._error is None
+
+
+
+'''
+FORM VALIDATORS
+'''
+class Validator(ABC):
+    # Validators hold no per-request state: one instance is declared on a form
+    # class and checks the fields of every form of that class
+
+    def __init__(self, error_msg=''):
+        self._error_msg = error_msg
+
+    @abstractmethod
+    def validate(self, name, value, form, stock):
+        pass
+
+
+class PositiveInput(Validator):
+
+    def __init__(self):
+        return super().__init__(' cannot be negative')
+
+    def validate(self, name, value, form, stock):
+        if value < 0:
+            raise ParseError(name.capitalize() + self._error_msg)
+
+class SufficientStock(Validator):
+
+    def __init__(self, sized=False):
+        # sized fields have their serving size chosen in the "<name>_size" input
+        super().__init__('Insufficient stock for ')
+        self._sized = sized
+    
+    def validate(self, name, value, form, stock):
+        try:
+            ingredient = stock.getIngredient(name)
+        except InventoryError as ie:
+            raise ParseError(ie.msg)
+        size = form.get(name + "_size") if self._sized else "regular"
+        if size == None:
+            raise ParseError("Please select size for " + name)
+        elif size not in ingredient.servingSizes:
+            raise ParseError("Please select valid size for " + name)
+        if stock.checkSufficientStock(name, value, size) == False:
+            raise ParseError(self._error_msg + name.capitalize())
+
+class MaintainStock(Validator):
+    def __init__(self, error_msg='This ingredient has insufficient stock'):
+        super().__init__(error_msg)
+    
+    def validate(self, name, value, form, stock):
+        try:
+            quantity = stock.quantity(name)
+        except InventoryError as ie:
+            raise ParseError(ie.msg)
+        if value + quantity < 0:
+            raise ParseError(self._error_msg)
+
+
+
 '''
 FORMS
 '''
-class Form(ABC):
+# main rules already reported against the individual field by its validators
+FIELD_RULES = ["missing", "negative"]
 
-    def __init__(self, form):
-        # Fields of the form
-        # Pass in validators which is a list of validator
-        self._fields = []
+class Form(ABC):
+    # Declared by each form class: the validators its fields run and the error
+    # for input that is not a whole number, compiled into one Pipeline per class
+    validators = ()
+    integerError = "Please enter integer input for {}"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._pipeline = Pipeline(cls.integerError, cls.validators)
+
+    def __init__(self, form, stock=None):
+        # The request's view of the stock, which the order should then be added through
+        self._stock = stock if stock is not None else system.inventory.view()
+        # Fields of the form by name
+        self._fields = {}
         # Errors not specific to a single field
         self._other_errors = {}
         for name, quantity in form.items():
-            if quantity != '' and quantity != '0':
-                tmp = Field(name, [PositiveInput(name), SufficientStock(name)])
-                self._fields.append(tmp)
-        self._parse(form)
+            if self._isField(name, quantity):
+                self._fields[name] = Field(name, self._pipeline)
+        began = time.perf_counter()
+        with span("form.parse", form=type(self).__name__):
+            self._parse(form)
+        validationSeconds.observe(time.perf_counter() - began, type(self).__name__)
+
+    def _isField(self, name, raw_data):
+        # inputs left empty or at zero are not part of the order
+        return raw_data != '' and raw_data != '0'
+
+    @property
+    def stock(self):
+        return self._stock
 
     @property
     def fields(self):
-        return self._fields
+        return self._fields.values()
 
     @property
     def otherErrors(self):
         return self._other_errors
 
-    @abstractmethod
     def _parse(self, form):
         '''
         Interprets form input from user and records any errors in the input
             - This may also perform operations such as converting a string into a date object
         '''
-        pass
+        for field in self._fields.values():
+            field.parse(form.get(field.name), form, self._stock)
 
     def get_raw_data(self, field_name):
         '''
@@ -71,14 +222,21 @@ class Form(ABC):
         return field.error or ''
 
     def has_error(self, field_name):
-        return self.get_error(field_name) is not ''
+        return self.get_error(field_name) != ''
+
+    def add_error(self, name, msg):
+        '''
+        records an error found after the form was parsed, such as stock
+        running out before the order could take it
+        '''
+        self._other_errors[name] = msg
 
     def _field(self, field_name):
         '''
         find and return the field object matching with the specified field name,
         if no matching field was found, then return None
         '''
-        return next((field for field in self._fields if field.name == field_name), None)
+        return self._fields.get(field_name)
 
     @property
     def is_valid(self):
@@ -88,104 +246,70 @@ class Form(ABC):
         if len(self._other_errors) > 0:
             return False
 
-        return all(field.is_valid for field in self._fields)
+        return all(field.is_valid for field in self._fields.values())
 
-# Form for burger order
-class BurgerForm(Form):
-    def __init__(self, form):
-        return super(BurgerForm, self).__init__(form)
+# Base form for burger and wrap orders
+class MainForm(Form):
+    validators = (PositiveInput(), SufficientStock())
+
+    def _classify(self):
+        # classify the ingredients once; the order reuses this check when adding the main
+        self._ingredients = {}
+        for field in self._fields.values():
+            if field.data is not None:
+                self._ingredients[field.name] = field.data
+        self._check = self._stock.classifyMain(self._ingredients)
+
+    @property
+    def ingredients(self):
+        return self._ingredients
+
+    @property
+    def check(self):
+        return self._check
 
+# Form for burger order
+class BurgerForm(MainForm):
     def _parse(self, form):
-        ingredients = {}
-        for field in self._fields:
-            field.parse(form.get(field.name))
+        super(BurgerForm, self)._parse(form)
 
         # Extra validation rules
         # Burger is valid with correct number of burger buns
-
-        ingredients = {}
-        for field in self._fields:
-            quantity = form.get(field.name)
-            try:
-                ingredients[field.name] = int(quantity)
-            except ValueError:
-                pass
-        try:
-            system.inventory.checkBunNumber(ingredients)
-        except OrderError as oe:
-            self._other_errors['bun'] = oe.msg
-        
-        try:
-            system.inventory.checkOnlyBurgerOrWrap(ingredients)
-        except OrderError as oe:
-            self._other_errors['onlyOne'] = oe.msg
+        self._classify()
+        for error in self._check.burgerErrors():
+            if error.rule not in FIELD_RULES:
+                self._other_errors[error.rule] = error.msg
         
 # Form for wrap order
-class WrapForm(Form):
-    def __init__(self, form):
-        super(WrapForm, self).__init__(form)
-
+class WrapForm(MainForm):
     def _parse(self, form):
+        super(WrapForm, self)._parse(form)
 
-        for field in self._fields:
-            field.parse(form.get(field.name))
-
-        ingredients = {}
-        for field in self._fields:
-            quantity = form.get(field.name)
-            if quantity != None:
-                try:
-                    ingredients[field.name] = int(quantity)
-                except ValueError:
-                    pass
-    # Extra validation rules
-    # Wrap is valid with only one wrap
-    
-        try:
-            system.inventory.checkOnlyOneWrap(ingredients)
-        except OrderError as oe:
-            self._other_errors['oneWrap'] = oe.msg
-        
-        try:
-            system.inventory.checkOnlyBurgerOrWrap(ingredients)
-        except OrderError as oe:
-            self._other_errors['onlyOne'] = oe.msg
+        # Extra validation rules
+        # Wrap is valid with only one wrap
+        self._classify()
+        for error in self._check.wrapErrors():
+            if error.rule not in FIELD_RULES:
+                self._other_errors[error.rule] = error.msg
         
 
 # Form for updating inventory stock for ingredients
 class InventoryForm(Form):
-    def __init__(self, form):
-        self._fields = []
-        # Errors not specific to a single field
-        self._other_errors = {}
-        for name, quantity in form.items():
-            if quantity != '' and quantity != '0':
-                try:
-                    val = int(quantity)                    
-                except ValueError:
-                    self._other_errors['quantity'] = 'Can not enter non-integer quantity'
-                else:
-                    if val < 0:
-                        tmp = Field(name, [MaintainStock(name, 'Insufficient stock for ')])
-                        self._fields.append(tmp)
-
-        self._parse(form)
-    
-    def _parse(self, form):
-        for field in self._fields:
-            field.parse(form.get(field.name))
+    validators = (MaintainStock('Insufficient stock for '),)
+    # the inventory page puts the ingredient name after each field's error
+    integerError = 'Can not enter non-integer quantity for'
 
 
 # Form for adding new ingredient
 class IngredientForm(Form):
     
-    def __init__(self, form):
-        self._fields = []
-        # Errors not specific to a single field
-        self._other_errors = {}
+    def __init__(self, form, stock=None):
         self._outputs = {}
-        self._parse(form)
-        
+        super(IngredientForm, self).__init__(form, stock)
+
+    def _isField(self, name, raw_data):
+        # the inputs are checked together in _parse rather than as fields
+        return False
 
     def _parse(self, form):
         # process ingredient name:
@@ -203,7 +327,7 @@ class IngredientForm(Form):
                     break
         if validName == True:
             try:
-                ingredient = system.inventory.getIngredient(name)
+                ingredient = self._stock.getIngredient(name)
             except InventoryError:
                 self._outputs['name'] = name.lower()
             else:
@@ -320,150 +444,20 @@ class IngredientForm(Form):
         return self._outputs
 
 class SideDrinkForm(Form):
+    validators = (PositiveInput(), SufficientStock(sized=True))
+    integerError = "Please enter integer quantity for {}"
 
-    def __init__(self, form):
-        self._fields = []
-        # Errors not specific to a single field
-        self._other_errors = {}
-        self._outputs = {}
-        for name, quantity in form.items():
-             if name.find("_size") == -1:
-                if quantity != '' and quantity != '0':
-                    tmp = Field(name, [PositiveInput(name), 
-                            SufficientStock(name, form.get(str(name)+"_size", None))])
-                    try:
-                        self._outputs[name] = [form.get(str(name)+"_size"), int(quantity)]
-                    except ValueError:
-                        self._other_errors[name] = "Please enter integer quantity for " + str(name)
-                    else:
-                        self._fields.append(tmp)
-        self._parse(form)
+    def _isField(self, name, raw_data):
+        return name.find("_size") == -1 and super(SideDrinkForm, self)._isField(name, raw_data)
 
     @property
     def outputs(self):
         return self._outputs
 
     def _parse(self, form):
-        ingredients = {}
-        for field in self._fields:
-            field.parse(form.get(field.name))
-
-
-'''
-FIELDS
-'''
-class Field():
-    def __init__(self, name, validators = None):
-        self._name = name
-        self._validators = validators or []
-        self._error     = None
-        self._raw_data  = None
-        self._data      = None
-
-    def parse(self, raw_data):
-        '''
-        raw_data: user input for the field
-        '''
-        self._raw_data = raw_data
-        try:
-            # validate form 
-            for v in self._validators:  
-                v.validate(raw_data)
-            
-            # transform raw_data (of type string) into the desired data type or format
-            self._transform(raw_data)   
-
-        except ParseError as pe:
-            self._error = str(pe)
-
-
-
-    def _transform(self, raw_data):
-        self._data = raw_data # apply no transform for basic fields
-
-    @property
-    def name(self):
-        return self._name
-
-    @property
-    def data(self):
-        return self._data
-
-    @property
-    def error(self):
-        return self._error
-
-    @property
-    def raw_data(self):
-        return self._raw_data
-    
-    @property
-    def is_valid(self):
-        return self._error is None
-
-
-
-'''
-FORM VALIDATORS
-'''
-class Validator(ABC):
-
-    def __init__(self, name, error_msg=''):
-        self._name = name
-        self._error_msg = error_msg
-
-    @abstractmethod
-    def validate(self, raw_data):
-        pass
-
-
-class PositiveInput(Validator):
-
-    def __init__(self, name):
-        return super().__init__(name, name.capitalize() + ' cannot be negative')
-
-    def validate(self, raw_data):
-        try:
-            if int(raw_data) < 0:
-                raise ParseError(self._error_msg)
-        except ValueError:
-            raise ParseError("Please enter integer input for " + self._name)
-
-class SufficientStock(Validator):
-
-    def __init__(self, name, size="regular"):
-        self._error_msg = 'Insufficient stock for ' + name.capitalize()
-        self._name = name
-        self._size = size
-    
-    def validate(self, raw_data):
-        try:
-            val = int(raw_data)
-        except ValueError:
-            raise ParseError("Please enter integer quantity for " + self._name)
-        else:
-            try:
-                ingredient = system.inventory.getIngredient(self._name)
-            except InventoryError as ie:
-                raise ParseError(ie.msg)
-            if self._size == None:
-                raise ParseError("Please select size for " + name)
-            elif self._size not in ingredient.servingSizes:
-                raise ParseError("Please select valid size for " + name)
-            if system.inventory.checkSufficientStock(self._name, val, self._size) == False:
-                raise ParseError(self._error_msg)
-
-class MaintainStock(Validator):
-    def __init__(self, name, error_msg='This ingredient has insufficient stock'):
-        self._error_msg = error_msg
-        self._name = name
-    
-    def validate(self, raw_data):
-        try:
-            val = int(raw_data)
-        except ValueError:
-            raise ParseError("Please enter integer input for " + self._name)
-        else:
-            ingredient = system.inventory.getIngredient(self._name)
-            if val + ingredient.quantity < 0:
-                raise ParseError(self._error_msg)
\ No newline at end of file
+        super(SideDrinkForm, self)._parse(form)
+        # [size, quantity] for each side and drink ordered
+        self._outputs = {}
+        for field in self._fields.values():
+            if field.data is not None:
+                self._outputs[field.name] = [form.get(field.name + "_size"), field.data]
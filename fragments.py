@@ -0,0 +1,81 @@
+import threading
+
+'''
+Rendered menu sections
+
+The rows of each menu section depend only on what is on the menu, so they are
+rendered once per inventory version and reused by every page that shows them.
+Pages render their own per-request parts (the order, form errors, messages)
+around the cached rows, and the stock levels in them are filled in each time.
+'''
+
+# stands in for an ingredient's stock in the cached rows; stock moves without the
+# menu version moving, so the rows are filled in with the current quantities each time
+STOCK_MARK = "\x00"
+
+class FragmentCache:
+    # render(template, items=..., stock=..., **context) returns the rendered rows,
+    # where stock(ingredient) stands in for its quantity; safe(html) marks the
+    # filled in rows safe to insert into a page
+    def __init__(self, render, safe=str):
+        self._render = render
+        self._safe = safe
+        # (inventory version, {key: (html split at each stock mark, ingredient names,
+        # rows listed)}); replaced whole when the version moves on
+        self._fragments = (None, {})
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def render(self, menu, template, iType, **context):
+        # the rows of template for the ingredients of iType on menu
+        key = (template, iType) + tuple(sorted(context.items()))
+        items = menu.items(iType)
+        # Stock is taken before the version moves on, so a menu built in between
+        # has the cached version but may list other rows than the cached ones
+        listed = tuple((ingredient.name, tuple(sizes)) for ingredient, sizes in items)
+        with self._lock:
+            version, fragments = self._fragments
+            if version is None or menu.version > version:
+                version, fragments = self._fragments = (menu.version, {})
+            rows = fragments.get(key) if version == menu.version else None
+            keep = rows is None
+            if rows is not None and rows[2] != listed:
+                rows = None
+            if rows is not None:
+                self._hits += 1
+            else:
+                self._misses += 1
+        if rows is None:
+            names = []
+            def stock(ingredient):
+                names.append(ingredient.name)
+                return STOCK_MARK
+            html = self._render(template, items=items, stock=stock, **context)
+            rows = (html.split(STOCK_MARK), names, listed)
+            # a menu older than the cached version, or differing from the rows
+            # kept for it, is rendered but not kept
+            with self._lock:
+                if keep and self._fragments[0] == menu.version:
+                    self._fragments[1][key] = rows
+        return self._fill(rows, items)
+
+    def _fill(self, rows, items):
+        # quantities come from this request's menu, which with a coordinator is a
+        # fresh copy rather than the one the rows were rendered from
+        parts, names, listed = rows
+        quantities = {ingredient.name: ingredient.quantity for ingredient, sizes in items}
+        html = [parts[0]]
+        for name, part in zip(names, parts[1:]):
+            html.append(str(quantities[name]))
+            html.append(part)
+        return self._safe("".join(html))
+
+    def clear(self):
+        with self._lock:
+            self._fragments = (None, {})
+
+    def stats(self):
+        with self._lock:
+            return {"version": self._fragments[0], "fragments": len(self._fragments[1]),
+                    "hits": self._hits, "misses": self._misses}
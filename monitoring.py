@@ -0,0 +1,103 @@
+from flask import request, g, Response
+from backend.metrics import registry, LATENCY_BUCKETS
+from backend import tracing
+import time
+
+'''
+Metrics for Prometheus, served as text at /metrics, and request tracing
+
+Request latency per endpoint, template rendering, form validation and saves are
+timed as they happen; order counts and stock levels are read from the system
+when /metrics is scraped. Each web worker process keeps its own timings.
+
+When backend.tracing is on, a sampled request is traced from before_request to
+teardown_request, with the spans of everything it calls nested inside.
+'''
+
+requestSeconds = registry.histogram("restaurant_request_seconds", "Time to handle a request, by endpoint",
+                                    ["endpoint"])
+responses = registry.counter("restaurant_responses_total", "Responses sent, by endpoint and status",
+                             ["endpoint", "status"])
+renderSeconds = registry.histogram("restaurant_render_seconds", "Time to render a template", ["template"])
+validationSeconds = registry.histogram("restaurant_form_seconds", "Time to parse and validate a form", ["form"])
+saveSeconds = registry.histogram("restaurant_save_seconds", "Time to save the system",
+                                 buckets=LATENCY_BUCKETS + (30.0, 60.0))
+ordersExpired = registry.counter("restaurant_orders_expired_total", "Pending orders cancelled by the time limit")
+
+# order events counted by the system, by the label they are reported under
+ORDER_EVENTS = {"create": "created", "checkout": "checked_out", "prepared": "prepared", "cancel": "cancelled"}
+
+def endpoint():
+    return request.endpoint or "unmatched"
+
+def instrument(app, system):
+    registry.counterFunction("restaurant_orders_total", "Orders created, checked out, prepared and cancelled",
+                             lambda: orderEvents(system), ["event"])
+    registry.gauge("restaurant_orders", "Orders by state", lambda: orderStates(system), ["state"])
+    registry.gauge("restaurant_stock", "Stock held of each ingredient, in its unit", lambda: stockLevels(system),
+                   ["ingredient", "unit"])
+
+    @app.before_request
+    def startTimer():
+        g.metricsStart = time.perf_counter()
+
+    @app.after_request
+    def countResponse(response):
+        responses.inc(endpoint(), str(response.status_code))
+        return response
+
+    # also runs when the view raised, so slow failures are timed too
+    @app.teardown_request
+    def stopTimer(exception=None):
+        began = g.pop("metricsStart", None)
+        if began is not None:
+            requestSeconds.observe(time.perf_counter() - began, endpoint())
+
+    class TimedTemplate(app.jinja_env.template_class):
+        def render(self, *args, **kwargs):
+            began = time.perf_counter()
+            try:
+                with tracing.span("render", template=self.name):
+                    return super(TimedTemplate, self).render(*args, **kwargs)
+            finally:
+                renderSeconds.observe(time.perf_counter() - began, self.name or "string")
+
+    # templates are compiled on first use, so every template rendered is timed
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+    if tracing.tracer is not None:
+        traceRequests(app)
+
+def traceRequests(app):
+    @app.before_request
+    def startTrace():
+        g.trace = tracing.trace(request.method + " " + (request.url_rule.rule if request.url_rule else request.path))
+        g.trace.__enter__()
+
+    @app.after_request
+    def traceStatus(response):
+        if "trace" in g:
+            g.trace.set(status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def endTrace(exception=None):
+        trace = g.pop("trace", None)
+        if trace is not None:
+            trace.__exit__(type(exception) if exception else None, exception, None)
+
+def orderEvents(system):
+    counts = system.eventCounts
+    return {(label,): counts.get(event, 0) for event, label in ORDER_EVENTS.items()}
+
+def orderStates(system):
+    stats = system.archiveStats()
+    return {("pending",): stats["pendingOrders"], ("active",): stats["activeOrders"],
+            ("finished",): stats["finishedOrders"], ("archived",): stats["archivedOrders"]}
+
+def stockLevels(system):
+    return {(ingredient.name, ingredient.unit): ingredient.quantity for ingredient in system.inventory.ingredients}
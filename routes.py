@@ -1,11 +1,20 @@
-from flask import render_template, request, redirect, url_for, abort
-from server import app, system
+from flask import render_template, request, redirect, url_for, abort, jsonify
+from server import app, system, writer
 from backend.system import RestaurantSystem
 from backend.inventory import IngredientType
 from backend.order import Order
+from backend.recipes import recipes
 from backend.errors import SystemError, InventoryError, OrderError
 from form import Form, InventoryForm, WrapForm, BurgerForm, IngredientForm, SideDrinkForm
-from threading import Timer
+from backend.expiry import ExpiryScheduler
+from fragments import FragmentCache
+from monitoring import ordersExpired
+from markupsafe import Markup
+import atexit
+
+# If order do not checkout within 30 mins, order will expire and be cancelled
+ORDER_TIMEOUT = 1800
+
 '''
 Dedicated page for "page not found"
 '''
@@ -34,22 +43,49 @@ def index():
                 return redirect(url_for('orderStatus', system=system, orderID=order.ID))           
     return render_template('index.html', system=system)
 
-def orderTimeOut(order):
+def orderTimeOut(orderID):
+    try:
+        order = system.getOrderFromID(orderID)
+    except SystemError:
+        print("Order already cancelled by customer.")
+        return
     if order.paid == False:
         try:
             system.cancelOrder(order.ID)
         except SystemError:
             print("Order already cancelled by customer.")
         else:
+            writer.markDirty()   # persistence
+            ordersExpired.inc()
             print("Order " + str(order.ID) + " canceled due to timeout")
     else:
         print("Order already paid within time limit")
 
+# one scheduler thread services every order deadline
+expiry = ExpiryScheduler(orderTimeOut)
+# orders still pending from before a restart get a fresh time limit
+for order in system.pendingOrders:
+    expiry.schedule(order.ID, ORDER_TIMEOUT)
+
+def startBackground():
+    # The persistence writer and the expiry thread. Only the process serving
+    # requests may run them: two processes expiring orders or saving against
+    # the same journal would each miss the other's events.
+    writer.start()
+    # flush anything still pending when the app shuts down
+    atexit.register(writer.stop)
+    expiry.start()
+    atexit.register(expiry.stop)
+
+# menu section rows, rendered once per inventory version for every page showing them
+fragments = FragmentCache(lambda template, **context: app.jinja_env.get_template(template).render(**context), Markup)
+app.jinja_env.globals["fragments"] = fragments
+
 @app.route('/main/create')
 def create():
     order = system.createOrder()
-    #If order do not checkout within 20 mins, order will expire and be cancelled
-    Timer(1800, orderTimeOut, [order]).start()
+    writer.markDirty()   # persistence
+    expiry.schedule(order.ID, ORDER_TIMEOUT)
     return redirect(url_for('main', orderID=order.ID))
 
 @app.route('/expired')
@@ -63,6 +99,8 @@ def ordercancel(orderID):
     except:
         if int(orderID) < system.orderIDCounter:
             return redirect(url_for("expired"))
+    expiry.cancel(int(orderID))
+    writer.markDirty()   # persistence
     return render_template("cancel.html")
 
 @app.route('/completed')
@@ -81,25 +119,19 @@ def main(orderID):
             return redirect(url_for("expired"))
         return redirect(url_for('page_not_found'))
     if request.method == "POST":
-        if "standardWrap" in request.form:
-            try:
-                order.addStandardWrap(system.inventory)
-            except InventoryError as ie:
-                # Insufficient inventory
-                return render_template('main.html', order=order, werror=ie)
-            else:
-                return render_template('main.html', order=order, wadded='Standard Wrap')
-        elif "standardBurger" in request.form:
+        if "recipe" in request.form:
+            name = request.form["recipe"]
             try:
-                order.addStandardBurger(system.inventory)
-            except InventoryError as ie:
-                # Insufficient inventory
-                return render_template('main.html', order=order, berror=ie)
+                order.addRecipe(system.inventory, name)
+            except (InventoryError, OrderError) as e:
+                # Insufficient inventory or not on the menu
+                return render_template('main.html', order=order, recipes=recipes.names, error=e)
             else:
-                return render_template('main.html', order=order, badded='Standard Burger')
+                writer.markDirty()   # persistence
+                return render_template('main.html', order=order, recipes=recipes.names, added=name.title())
     if order.paid == True:
         return redirect(url_for("completed"))
-    return render_template('main.html', order=order)
+    return render_template('main.html', order=order, recipes=recipes.names)
 
 
 # Add main wrap order
@@ -113,34 +145,28 @@ def wrap(orderID):
         return redirect(url_for('page_not_found'))
     if order.paid == True:
         return redirect(url_for("completed"))
-    hasWrap = False
-    hasPatty = False
-    hasFilling = False
-    for ingredient in system.inventory.ingredients:
-        if ingredient.iType == IngredientType.WRAP:
-            if ingredient.quantity > 0:
-                hasWrap = True
-        elif ingredient.iType == IngredientType.PATTY:
-            if ingredient.quantity > 0:
-                hasPatty = True
-        elif ingredient.iType == IngredientType.FILLING:
-            if ingredient.quantity > 0:
-                hasFilling = True
+    # cached by the inventory until stock puts something on or off the menu
+    menu = system.inventory.menu()
 
     if request.method == "POST":
-        form = WrapForm(request.form)
+        # validated and added against one view of the stock
+        form = WrapForm(request.form, system.inventory.view())
         if not form.is_valid:
             return render_template("wrap.html", order=order, form=form, system=system, iType=IngredientType,
-                                    hasWrap=hasWrap, hasPatty=hasPatty, hasFilling=hasFilling)
-        ingredients = {}
-        for name, quantity in request.form.items():
-            if quantity != '' and quantity != '0':
-                ingredients[name] = int(quantity)
-        order.addWrapMain(system.inventory, ingredients)
+                                    menu=menu)
+        try:
+            order.addWrapMain(form.stock, form.ingredients, form.check)
+        except (InventoryError, OrderError) as e:
+            # stock sold to another order since the form was checked
+            form.add_error("stock", e.msg)
+            return render_template("wrap.html", order=order, form=form, system=system, iType=IngredientType,
+                                    menu=system.inventory.menu())
+        writer.markDirty()   # persistence
+        menu = system.inventory.menu()
         return render_template("wrap.html", order=order, system=system, added=True, iType=IngredientType,
-                                hasWrap=hasWrap, hasPatty=hasPatty, hasFilling=hasFilling)
+                                menu=menu)
     return render_template('wrap.html', order=order, system=system, iType=IngredientType,
-                            hasWrap=hasWrap, hasPatty=hasPatty, hasFilling=hasFilling)
+                            menu=menu)
 
 # Add main burger order
 @app.route('/burger/<orderID>', methods=["GET", "POST"])
@@ -153,34 +179,27 @@ def burger(orderID):
         return redirect(url_for('page_not_found'))
     if order.paid == True:
         return redirect(url_for("completed"))
-    hasPatty = False
-    hasBun = False
-    hasFilling = False
-    for ingredient in system.inventory.ingredients:
-        if ingredient.iType == IngredientType.BURGERBUN:
-            if ingredient.quantity > 0:
-                hasBun = True
-        elif ingredient.iType == IngredientType.PATTY:
-            if ingredient.quantity > 0:
-                hasPatty = True
-        elif ingredient.iType == IngredientType.FILLING:
-            if ingredient.quantity > 0:
-                hasFilling = True
+    # cached by the inventory until stock puts something on or off the menu
+    menu = system.inventory.menu()
 
     if request.method == "POST":
-        form = BurgerForm(request.form)
+        # validated and added against one view of the stock
+        form = BurgerForm(request.form, system.inventory.view())
         if not form.is_valid:
             return render_template("burger.html", order=order, form=form, system=system, iType=IngredientType,
-                                    hasPatty=hasPatty, hasBun=hasBun, hasFilling=hasFilling)
-        ingredients = {}
-        for name, quantity in request.form.items():
-            if quantity != '' and quantity != '0':
-                ingredients[name] = int(quantity)
-        order.addBurgerMain(system.inventory, ingredients)
+                                    menu=menu)
+        try:
+            order.addBurgerMain(form.stock, form.ingredients, form.check)
+        except (InventoryError, OrderError) as e:
+            # stock sold to another order since the form was checked
+            form.add_error("stock", e.msg)
+            return render_template("burger.html", order=order, form=form, system=system, iType=IngredientType,
+                                    menu=system.inventory.menu())
+        writer.markDirty()   # persistence
+        menu = system.inventory.menu()
         return render_template("burger.html", order=order, system=system, added=True, iType=IngredientType,
-                                hasPatty=hasPatty, hasBun=hasBun, hasFilling=hasFilling)
-    return render_template('burger.html', order=order, system=system, iType=IngredientType, hasPatty=hasPatty, 
-                            hasBun=hasBun, hasFilling=hasFilling)
+                                menu=menu)
+    return render_template('burger.html', order=order, system=system, iType=IngredientType, menu=menu)
 
 '''
 Side and drink page
@@ -196,29 +215,37 @@ def sidedrink(orderID):
         return redirect(url_for('page_not_found'))
     if order.paid == True:
         return redirect(url_for("completed"))    
-    has = {IngredientType.DRINK:False, IngredientType.SIDE:False}
-    for ingredient in system.inventory.ingredients:
-        if ingredient.iType in has:
-            if 'regular' in ingredient.servingSizes and ingredient.quantity > 0:
-                has[ingredient.iType] = True
-            elif 'small' in ingredient.servingSizes and ingredient.quantity > ingredient.servingSizes['small']:
-                has[ingredient.iType] = True
+    # cached by the inventory until stock puts something on or off the menu
+    menu = system.inventory.menu()
 
     if request.method == "POST":
-        form = SideDrinkForm(request.form)
+        # validated and added against one view of the stock
+        form = SideDrinkForm(request.form, system.inventory.view())
         if not form.is_valid:
-            return render_template('sidedrink.html', order=order, has=has, form=form, system=system, iType=IngredientType)
+            return render_template('sidedrink.html', order=order, form=form, system=system, iType=IngredientType,
+                                   menu=menu)
         added = {}
         for name, values in form.outputs.items():
-            ingredient = system.inventory.getIngredient(name)
-            if ingredient.iType == IngredientType.DRINK:
-                added["drink"] = True
-                order.addDrink(system.inventory, name, values[1], values[0])
-            elif ingredient.iType == IngredientType.SIDE:
-                order.addSide(system.inventory, name, values[1], values[0])
-                added["side"] = True
-        return render_template('sidedrink.html', order=order, system=system, iType=IngredientType, has=has, added=added) 
-    return render_template('sidedrink.html', order=order, system=system, iType=IngredientType, has=has)
+            ingredient = form.stock.getIngredient(name)
+            try:
+                if ingredient.iType == IngredientType.DRINK:
+                    order.addDrink(form.stock, name, values[1], values[0])
+                    added["drink"] = True
+                elif ingredient.iType == IngredientType.SIDE:
+                    order.addSide(form.stock, name, values[1], values[0])
+                    added["side"] = True
+            except (InventoryError, OrderError) as e:
+                # stock sold to another order since the form was checked
+                form.add_error(name, e.msg)
+        if added:
+            writer.markDirty()   # persistence
+        menu = system.inventory.menu()
+        if not form.is_valid:
+            return render_template('sidedrink.html', order=order, form=form, system=system, iType=IngredientType,
+                                   added=added, menu=menu)
+        return render_template('sidedrink.html', order=order, system=system, iType=IngredientType, added=added,
+                               menu=menu)
+    return render_template('sidedrink.html', order=order, system=system, iType=IngredientType, menu=menu)
 
 '''
 Order pages
@@ -233,7 +260,7 @@ def reviewOrder(orderID):
         return redirect(url_for('page_not_found'))
     if order.paid == True:
         return redirect(url_for("completed"))
-    price = order.calculateTotalPrice(system.inventory)
+    price = order.calculateTotalPrice()
     return render_template('revieworder.html', system=system, order=order, price=round(price,2))
 
 # Check order status
@@ -260,7 +287,8 @@ def checkOut(orderID):
             system.checkout(int(orderID))
         except OrderError as oe:
             return render_template('revieworder.html', order=order, error=oe)
-        system.saveData()   # persistence
+        expiry.cancel(order.ID)
+        writer.markDirty()   # persistence
     #order is already paid
     return render_template('orderstatus.html', system=system, order=order)
 
@@ -275,11 +303,21 @@ def staff():
     if request.method == "POST":
         orderID = int(request.form.get("prepared"))
         system.orderPrepared(orderID)
-        system.saveData()   # persistence
+        writer.markDirty()   # persistence
         orders = system.activeOrders
         return render_template('staff.html', orders=orders, staff=True)
     return render_template('staff.html', orders=orders, staff=True)
 
+# Pending order expiry counts
+@app.route('/staff/expiry')
+def expiryStatus():
+    return jsonify(expiry.stats())
+
+# Orders held in memory and in the archive
+@app.route('/staff/archive')
+def archiveStatus():
+    return jsonify(system.archiveStats())
+
 # Service order
 @app.route('/staff/<orderID>', methods=["GET", "POST"])
 def serviceOrder(orderID):
@@ -290,7 +328,7 @@ def serviceOrder(orderID):
     if request.method == "POST":
         if order.prepared == False:
             system.orderPrepared(order.ID)
-            system.saveData() # persistence
+            writer.markDirty() # persistence
             return redirect(url_for('staff'))
         else:
            return render_template('staffserviceorder.html', inventory=system.inventory, order=order, staff=True) 
@@ -314,7 +352,7 @@ def inventory():
             if quantity != '' and quantity != '0':
                 ingredients[name] = int(quantity)
         system.inventory.updateInventory(ingredients)
-        system.saveData() # persistence
+        writer.markDirty() # persistence
         return render_template('inventory.html', iType=IngredientType, has=has, system=system, staff=True, success=True)
     if len(system.inventory.ingredients) == 0:
         return render_template('inventory.html', iType=IngredientType, has=has, system=system, staff=True, noIngredients=True)
@@ -341,6 +379,6 @@ def addIngredient():
             servingSizes['medium'] = form.outputs['mQty']
             servingSizes['large'] = form.outputs['lQty']
         system.inventory.addIngredient(name, price, quantity, ingType, servingSizes, unit)
-        system.saveData() # persistence
+        writer.markDirty() # persistence
         return render_template('addingredient.html', success=name, IngredientType=IngredientType, staff=True)
     return render_template('addingredient.html', IngredientType=IngredientType, staff=True)
\ No newline at end of file
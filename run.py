@@ -1,4 +1,15 @@
-from routes import app
+from routes import app, startBackground
+# JSON API for kiosks and kitchen screens
+import api
+# profiling and memory snapshots for admins
+import admin
+import os
+
+# app.run(debug=True) serves from a child process it starts with WERKZEUG_RUN_MAIN
+# set and restarts on code changes; this first process only watches the files.
+# Servers importing run:app, such as gunicorn, serve from the importing process.
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    startBackground()
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True, threaded=True)
\ No newline at end of file
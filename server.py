@@ -1,13 +1,32 @@
 from flask import Flask
 # from init import bootstrap_system
-from backend.system import RestaurantSystem
+from backend.writer import PersistenceWriter
+from backend.shared import connect
+from coordinator import loadSystem, coordinatorAddress, coordinatorKey
+from monitoring import instrument, saveSeconds
+import os
+
+# Persistence is group-committed in the background: at most one save per
+# interval (seconds), or sooner once this many changes are waiting
+PERSIST_INTERVAL = 1.0
+PERSIST_MAX_PENDING = 50
 
 app = Flask(__name__)
 
-# Using persistence:
-system = RestaurantSystem.loadData()
+if "RESTAURANT_COORDINATOR" in os.environ:
+    # one of several web worker processes; the system lives in coordinator.py
+    system = connect(coordinatorAddress(), coordinatorKey())
+else:
+    # Using persistence:
+    system = loadSystem()
 
 # Not using persistence
 # system = bootstrap_system()
 # to refresh system.dat to original test system
-# system.saveData()
\ No newline at end of file
+# system.saveData()
+
+# request timings and order and stock gauges, served at /metrics
+instrument(app, system)
+
+# started by routes.startBackground in the process that serves requests
+writer = PersistenceWriter(saveSeconds.time(system.saveData), PERSIST_INTERVAL, PERSIST_MAX_PENDING)
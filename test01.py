@@ -4,6 +4,7 @@ from backend.order import Order
 from backend.main import Main
 from backend.side import SideDrink
 from backend.inventory import Inventory, Ingredient, IngredientType
+from backend.recipes import RecipeBook
 
 import pytest
 
@@ -544,6 +545,20 @@ def test_fail_add_sundae_negative_quantity(system_fixture):
     assert ingredient.quantity == 10000
     assert order.calculateTotalPrice(system_fixture.inventory) == 0
 
+def test_line_prices_captured_when_added(system_fixture):
+    order = system_fixture.createOrder()
+    order.addSide(system_fixture.inventory, "chicken nugget", 2, "small")
+    order.addStandardBurger(system_fixture.inventory)
+    assert order.calculateTotalPrice() == 15
+    # a later price change does not reprice lines already on the order
+    system_fixture.inventory.getIngredient("chicken nugget")._price = 2
+    system_fixture.inventory.getIngredient("beef")._price = 10
+    assert order.calculateTotalPrice() == 15
+    assert [side.calculateCost() for side in order.sidesAndDrinks] == [6]
+    assert [main.calculateCost() for main in order.mainOrders] == [9]
+    order.addSide(system_fixture.inventory, "chicken nugget", 1, "small")
+    assert order.calculateTotalPrice() == 21
+
 ### User Story 1.3 - Order Drinks ###
 def test_success_add_drink_orange_juice(system_fixture):
     order = system_fixture.createOrder()
@@ -743,6 +758,49 @@ def test_fail_standard_wrap_already_paid(system_fixture):
     assert len(order.mainOrders) == 1
     assert len(order.sidesAndDrinks) == 0
 
+def test_standard_recipe_compiled_once(system_fixture):
+    book = RecipeBook({"standard wrap": {"main": "wrap",
+        "ingredients": {"flatbread":1, "chicken":1, "lettuce":1, "cheddar cheese":1}}})
+    recipe = book.get("standard wrap", system_fixture.inventory)
+    assert recipe.price == 8
+    assert book.get("Standard Wrap", system_fixture.inventory) is recipe
+    order = system_fixture.createOrder()
+    order.addRecipe(system_fixture.inventory, "standard wrap", book)
+    order.addRecipe(system_fixture.inventory, "standard wrap", book)
+    assert order.calculateTotalPrice(system_fixture.inventory) == 16
+    assert system_fixture.inventory.getIngredient("flatbread").quantity == 98
+    # a catalog change recompiles the recipe
+    system_fixture.inventory.addIngredient("pita", 1, 100, IngredientType.WRAP, {"regular": 1})
+    assert book.get("standard wrap", system_fixture.inventory) is not recipe
+
+def test_recipe_from_config_validated_when_compiled(system_fixture, tmp_path):
+    path = tmp_path / "recipes.json"
+    path.write_text('{"double wrap": {"main": "wrap", "ingredients": {"flatbread": 2, "chicken": 1}},'
+                    ' "veggie burger": {"main": "burger", "ingredients": {"muffin bun": 2, "tofu": 1}}}')
+    book = RecipeBook.load(str(path))
+    assert book.names == ["double wrap", "veggie burger"]
+    order = system_fixture.createOrder()
+    try:
+        order.addRecipe(system_fixture.inventory, "double wrap", book)
+    except OrderError as oe:
+        assert oe.msg == "Must select one wrap bread"
+    else:
+        assert False
+    try:
+        order.addRecipe(system_fixture.inventory, "veggie burger", book)
+    except InventoryError as ie:
+        assert ie.msg == "Tofu does not exist"
+    else:
+        assert False
+    try:
+        order.addRecipe(system_fixture.inventory, "fish burger", book)
+    except OrderError as oe:
+        assert oe.msg == "Fish burger is not on the menu"
+    else:
+        assert False
+    assert len(order.mainOrders) == 0
+    assert system_fixture.inventory.getIngredient("flatbread").quantity == 100
+
 
 
 #Unit Tests for Inventory
@@ -841,4 +899,35 @@ def test_side_negative_order(system_fixture):
     assert side.quantity == -1
     assert side.servingSize == "large"
     assert side.calculateCost(inventory) == 0
-    assert str(side) == ""
\ No newline at end of file
+    assert str(side) == ""
+
+# Unit Tests for main validation
+def test_main_check_tallies_and_errors(system_fixture):
+    inventory = system_fixture.inventory
+    check = inventory.classifyMain({"Sesame Bun":4, "muffin bun":1, "beef":2, "tomato":3, "flatbread":1})
+    assert check.count(IngredientType.BURGERBUN) == 5
+    assert check.count(IngredientType.PATTY) == 2
+    assert check.count(IngredientType.FILLING) == 3
+    assert check.count(IngredientType.WRAP) == 1
+    assert [(e.rule, e.msg) for e in check.burgerErrors()] == [
+        ("onlyOne", "Cannot choose both burger and wrap"),
+        ("bun", "Number of buns must be between 2 and 3")]
+    assert [e.rule for e in check.wrapErrors()] == ["onlyOne"]
+    check = inventory.classifyMain({"potato":1, "beef":-1, "sesame bun":2})
+    assert [(e.rule, e.msg) for e in check.burgerErrors()] == [("missing", "Potato does not exist")]
+    check = inventory.classifyMain({"beef":-1, "potato":1, "sesame bun":2})
+    assert [(e.rule, e.msg) for e in check.burgerErrors()] == [("negative", "Cannot enter negative quantity")]
+    assert inventory.classifyMain({"sesame bun":2, "beef":1}).burgerErrors() == []
+
+def test_add_main_with_precomputed_check(system_fixture):
+    inventory = system_fixture.inventory
+    order = system_fixture.createOrder()
+    ingredients = {"flatbread":1, "chicken":1, "lettuce":2}
+    check = inventory.classifyMain(ingredients)
+    assert check.wrapErrors() == []
+    assert order.addWrapMain(inventory, ingredients, check) == "Main added to order"
+    assert inventory.getIngredient("lettuce").quantity == 98
+    ingredients = {"flatbread":2, "chicken":1}
+    with pytest.raises(OrderError):
+        order.addWrapMain(inventory, ingredients, inventory.classifyMain(ingredients))
+    assert len(order.mainOrders) == 1
@@ -1,9 +1,13 @@
 from backend.system import RestaurantSystem
-from backend.errors import SystemError, OrderError, InventoryError
+from backend.errors import SystemError, OrderError, InventoryError, BasketError
 from backend.order import Order
 from backend.inventory import Inventory, Ingredient, IngredientType
+from backend.expiry import ExpiryScheduler
+from backend.basket import Basket
 
 import pytest
+import threading
+import time
 
 @pytest.fixture()
 def system_fixture():
@@ -395,4 +399,116 @@ def test_cancelOrder_fail_active(system_fixture):
     except SystemError as se:
         assert se.msg == "Order is not pending."
     else:
-        assert False
\ No newline at end of file
+        assert False
+
+### Order expiry ###
+def test_expiry_cancels_unpaid_order(system_fixture):
+    expired = threading.Event()
+    def timeOut(orderID):
+        system_fixture.cancelOrder(orderID)
+        expired.set()
+    scheduler = ExpiryScheduler(timeOut)
+    scheduler.start()
+    order = system_fixture.createOrder()
+    order.addDrink(system_fixture.inventory, "Can Fanta", 1, "regular")
+    scheduler.schedule(order.ID, 0.05)
+    assert scheduler.pending == 1
+    assert expired.wait(2)
+    scheduler.stop()
+    assert scheduler.pending == 0
+    assert scheduler.stats()["expired"] == 1
+    assert len(system_fixture.pendingOrders) == 0
+    assert system_fixture.inventory.getIngredient("Can Fanta").quantity == 100
+
+def test_expiry_cancelled_on_checkout(system_fixture):
+    fired = []
+    scheduler = ExpiryScheduler(fired.append)
+    scheduler.start()
+    for i in range(3):
+        order = system_fixture.createOrder()
+        order.addDrink(system_fixture.inventory, "Can Fanta", 1, "regular")
+        scheduler.schedule(order.ID, 0.1 * (i + 1))
+    system_fixture.checkout(1)
+    assert scheduler.cancel(1) == True
+    assert scheduler.cancel(1) == False
+    assert scheduler.pending == 2
+    time.sleep(0.5)
+    scheduler.stop()
+    assert fired == [2, 3]
+    assert scheduler.stats() == {"pending": 0, "heap": 0, "expired": 2, "cancelled": 1, "nextExpiry": None}
+
+### Basket - whole order submitted at once ###
+def test_basket_ordered_and_paid(system_fixture):
+    basket = Basket(mains=[{"recipe": "standard burger"},
+                           {"type": "wrap", "ingredients": {"flatbread": 1, "chicken": 2, "tomato": 1}}],
+                    sides=[{"name": "Chicken Nugget", "quantity": 1, "size": "medium"}],
+                    drinks=[{"name": "Can Coke", "quantity": 2}])
+    order = system_fixture.submitBasket(basket)
+    assert order.paid == True
+    assert [o.ID for o in system_fixture.activeOrders] == [order.ID]
+    assert len(order.mainOrders) == 2
+    assert order.calculateTotalPrice() == 9 + 12 + 6 + 10
+    assert system_fixture.inventory.getIngredient("chicken").quantity == 98
+    assert system_fixture.inventory.getIngredient("chicken nugget").quantity == 994
+    assert system_fixture.inventory.getReserved("chicken") == 0
+
+def test_basket_reports_every_failure(system_fixture):
+    basket = Basket(mains=[{"type": "burger", "ingredients": {"sesame bun": 1, "beef": 1}},
+                           {"recipe": "standard burger"},
+                           {"recipe": "pizza"}],
+                    sides=[{"name": "Chicken Nugget", "quantity": 1, "size": "huge"}],
+                    drinks=[{"name": "Can Coke", "quantity": 101}])
+    try:
+        system_fixture.submitBasket(basket)
+    except BasketError as be:
+        assert [(f["section"], f["index"]) for f in be.failures] == \
+            [("mains", 0), ("mains", 2), ("sides", 0), ("stock", None)]
+        assert be.failures[-1]["msg"] == "Insufficient stock for can coke"
+    else:
+        assert False
+    # nothing was ordered and no stock was taken
+    assert system_fixture.orderIDCounter == 1
+    assert system_fixture.inventory.getIngredient("can coke").quantity == 100
+    assert system_fixture.inventory.getIngredient("beef").quantity == 100
+
+def test_basket_rejects_bool_and_zero_quantities(system_fixture):
+    basket = Basket(mains=[{"type": "burger", "ingredients": {"sesame bun": 2, "beef": True}}],
+                    sides=[{"name": "Chicken Nugget", "quantity": 0, "size": "small"}],
+                    drinks=[{"name": "Can Coke", "quantity": True}])
+    with pytest.raises(BasketError) as e:
+        system_fixture.submitBasket(basket)
+    assert [(f["section"], f["index"]) for f in e.value.failures] == [("mains", 0), ("sides", 0), ("drinks", 0)]
+    assert e.value.failures[1]["msg"] == "Quantity must be a whole number of at least 1"
+    assert system_fixture.orderIDCounter == 1
+
+def test_basket_stock_checked_across_lines(system_fixture):
+    # each line fits on its own but not together
+    basket = Basket(drinks=[{"name": "Can Fanta", "quantity": 60}, {"name": "Can Fanta", "quantity": 60}])
+    with pytest.raises(BasketError):
+        system_fixture.submitBasket(basket)
+    with pytest.raises(BasketError):
+        system_fixture.submitBasket(Basket())
+    assert system_fixture.inventory.getIngredient("can fanta").quantity == 100
+
+def test_stale_order_rejects_lines_after_cancel(system_fixture):
+    inventory = system_fixture.inventory
+    order = system_fixture.createOrder()
+    order.addDrink(inventory, "Can Coke", 2, "regular")
+    # another thread, e.g. expiry, cancels the order this request still holds
+    system_fixture.cancelOrder(order.ID)
+    for add in [lambda: order.addDrink(inventory, "Can Coke", 3, "regular"),
+                lambda: order.addSide(inventory, "chicken nugget", 1, "small"),
+                lambda: order.addStandardBurger(inventory),
+                lambda: order.addBurgerMain(inventory, {"sesame bun": 2, "beef": 1}),
+                lambda: order.addWrapMain(inventory, {"flatBread": 1, "chicken": 1}),
+                lambda: order.submitAndPay(True)]:
+        with pytest.raises(OrderError) as e:
+            add()
+        assert e.value.msg == "Order has been cancelled, please start new order."
+    with pytest.raises(OrderError):
+        order.addLines([], None)
+    # no stock is left held and no line was recorded for the cancelled order
+    assert inventory.getIngredient("can coke").quantity == 100
+    assert inventory.getReserved("can coke") == 0
+    assert inventory._reservations == {}
+    assert system_fixture.eventCounts.get("drink") == 1
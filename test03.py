@@ -4,6 +4,7 @@ from backend.order import Order
 from backend.inventory import Inventory, Ingredient, IngredientType
 
 import pytest
+import pickle
 
 @pytest.fixture()
 def system_fixture():
@@ -98,4 +99,37 @@ def test_orderPrepared_pendingID(system_fixture):
     except SystemError as se:
         assert se.msg == "Order is not active."
     else:
-        assert False
\ No newline at end of file
+        assert False
+
+def test_load_legacy_order_lists(system_fixture):
+    # system.dat files written before the order registry keep each state as a list
+    for i in range(3):
+        system_fixture.createOrder().addDrink(system_fixture.inventory, "Can Fanta", 1, "regular")
+    system_fixture.checkout(2)
+    system_fixture.checkout(3)
+    system_fixture.orderPrepared(3)
+    state = dict(system_fixture.__dict__)
+    del state['_orders']
+    for attr in ['_pendingOrders', '_activeOrders', '_finishedOrders']:
+        state[attr] = list(state[attr].values())
+    legacy = RestaurantSystem.__new__(RestaurantSystem)
+    legacy.__dict__.update(state)
+    loaded = pickle.loads(pickle.dumps(legacy))
+    assert [order.ID for order in loaded.pendingOrders] == [1]
+    assert [order.ID for order in loaded.activeOrders] == [2]
+    assert [order.ID for order in loaded.finishedOrders] == [3]
+    assert loaded.getOrderFromID(1).ID == 1
+    assert loaded.getPaidOrderFromID(3).prepared == True
+    loaded.orderPrepared(2)
+    assert [order.ID for order in loaded.finishedOrders] == [3, 2]
+
+def test_load_orders_without_line_prices(system_fixture):
+    # orders saved before line prices were captured are priced from the inventory on load
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    order.addDrink(system_fixture.inventory, "Can Fanta", 2, "regular")
+    del order.__dict__['_total']
+    for line in order.mainOrders + order.sidesAndDrinks:
+        del line.__dict__['_price']
+    loaded = pickle.loads(pickle.dumps(system_fixture))
+    assert loaded.getOrderFromID(1).calculateTotalPrice() == 9 + 2 * 5
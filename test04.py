@@ -1,9 +1,11 @@
 from backend.system import RestaurantSystem
 from backend.errors import SystemError, OrderError, InventoryError
 from backend.order import Order
-from backend.inventory import Inventory, Ingredient, IngredientType
+from backend.inventory import Inventory, Ingredient, IngredientType, Menu
+from fragments import FragmentCache
 
 import pytest
+import pickle
 
 @pytest.fixture()
 def system_fixture():
@@ -219,4 +221,197 @@ def test_fail_add_ingredient_invalid_unit(system_fixture):
     except InventoryError as ie:
         assert ie.msg == "Please enter valid unit"
     with pytest.raises(InventoryError):
-        ingredient = inventory.getIngredient(name)
\ No newline at end of file
+        ingredient = inventory.getIngredient(name)
+
+def test_get_ingredients_by_type_and_unit(system_fixture):
+    inventory = system_fixture.inventory
+    buns = inventory.getIngredientsByType(IngredientType.BURGERBUN)
+    assert [bun.name for bun in buns] == ["sesame bun", "muffin bun"]
+    assert [i.name for i in inventory.getIngredientsByUnit("ml")] == ["orange juice"]
+    inventory.addIngredient("Brioche Bun", 2, 10, IngredientType.BURGERBUN, {"regular":1})
+    buns = inventory.getIngredientsByType(IngredientType.BURGERBUN)
+    assert [bun.name for bun in buns] == ["sesame bun", "muffin bun", "brioche bun"]
+    assert inventory.ingredients[-1].name == "brioche bun"
+
+def test_load_legacy_ingredient_list(system_fixture):
+    # system.dat files written before the catalog keep ingredients in a list
+    inventory = system_fixture.inventory
+    legacy = Inventory.__new__(Inventory)
+    legacy.__dict__['_ingredients'] = inventory.ingredients
+    loaded = pickle.loads(pickle.dumps(legacy))
+    assert [i.name for i in loaded.ingredients] == [i.name for i in inventory.ingredients]
+    assert loaded.getIngredient("TOMATO").quantity == 100
+    assert len(loaded.getIngredientsByType(IngredientType.DRINK)) == 7
+
+### Stock reservations ###
+def test_reserve_commit_and_release(system_fixture):
+    inventory = system_fixture.inventory
+    token = inventory.reserve({"tomato": 2, "sesame bun": 2})
+    token = inventory.reserve([("chicken nugget", 1, "medium"), ("tomato", 1, "regular")], token)
+    assert inventory.getIngredient("tomato").quantity == 97
+    assert inventory.getIngredient("chicken nugget").quantity == 994
+    assert inventory.getReserved("Tomato") == 3
+    inventory.release(token)
+    assert inventory.getIngredient("tomato").quantity == 100
+    assert inventory.getIngredient("chicken nugget").quantity == 1000
+    assert inventory.getReserved("tomato") == 0
+    token = inventory.reserve({"tomato": 5})
+    inventory.commit(token)
+    assert inventory.getIngredient("tomato").quantity == 95
+    assert inventory.getReserved("tomato") == 0
+    with pytest.raises(InventoryError):
+        inventory.release(token)
+
+def test_reserve_is_all_or_nothing(system_fixture):
+    inventory = system_fixture.inventory
+    for items in [{"tomato": 1, "beef": 101}, [("tomato", 1, "regular"), ("orange juice", 1, "regular")],
+                  {"tomato": 1, "potato": 1}, {"tomato": 60, "Tomato": 41}]:
+        with pytest.raises(InventoryError):
+            inventory.reserve(items)
+        assert inventory.getIngredient("tomato").quantity == 100
+        assert inventory.getIngredient("beef").quantity == 100
+    try:
+        inventory.reserve({"tomato": 1, "beef": 101})
+    except InventoryError as ie:
+        assert ie.msg == "Insufficient stock for beef"
+
+def test_cancel_releases_reservation_and_checkout_commits(system_fixture):
+    inventory = system_fixture.inventory
+    order = system_fixture.createOrder()
+    order.addStandardBurger(inventory)
+    order.addSide(inventory, "chicken nugget", 1, "large")
+    assert inventory.getReserved("beef") == 1
+    assert inventory.getReserved("chicken nugget") == 9
+    system_fixture.cancelOrder(order.ID)
+    assert inventory.getIngredient("beef").quantity == 100
+    assert inventory.getIngredient("chicken nugget").quantity == 1000
+    order = system_fixture.createOrder()
+    order.addStandardBurger(inventory)
+    system_fixture.checkout(order.ID)
+    assert inventory.getReserved("beef") == 0
+    assert inventory.getIngredient("beef").quantity == 99
+
+### Menu availability cache ###
+def test_menu_cached_until_availability_changes(system_fixture):
+    inventory = system_fixture.inventory
+    menu = inventory.menu()
+    version = inventory.version
+    assert menu.has(IngredientType.PATTY)
+    order = system_fixture.createOrder()
+    order.addDrink(inventory, "Can Coke", 5, "regular")
+    # stock moved but nothing went on or off the menu
+    assert inventory.version == version
+    assert inventory.menu() is menu
+    inventory.updateInventory({"can coke": -95})
+    assert inventory.version > version
+    menu = inventory.menu()
+    assert "can coke" not in [i.name for i, sizes in menu.items(IngredientType.DRINK)]
+    system_fixture.cancelOrder(order.ID)
+    assert "can coke" in [i.name for i, sizes in inventory.menu().items(IngredientType.DRINK)]
+
+def test_menu_drops_sizes_stock_cannot_fill(system_fixture):
+    inventory = system_fixture.inventory
+    inventory.updateInventory({"chicken nugget": -995})
+    sizes = dict((i.name, s) for i, s in inventory.menu().items(IngredientType.SIDE))
+    assert sizes["chicken nugget"] == ["small"]
+    version = inventory.version
+    inventory.updateInventory({"chicken nugget": -1})
+    assert inventory.version == version
+    inventory.updateInventory({"chicken nugget": -2})
+    sizes = dict((i.name, s) for i, s in inventory.menu().items(IngredientType.SIDE))
+    assert sizes["chicken nugget"] == []
+    inventory.addIngredient("Fries", 0.01, 0, IngredientType.SIDE, {"small": 100}, "g")
+    assert inventory.version > version
+    # out of stock ingredients are left off the menu
+    assert "fries" not in [i.name for i, sizes in inventory.menu().items(IngredientType.SIDE)]
+
+def test_menu_fragments_rendered_once_per_version(system_fixture):
+    inventory = system_fixture.inventory
+    rendered = []
+    def render(template, items, **context):
+        rendered.append(template)
+        return ",".join(item.name for item, sizes in items)
+    fragments = FragmentCache(render)
+    html = fragments.render(inventory.menu(), "rows", IngredientType.PATTY, empty="patty")
+    assert html == "chicken,beef"
+    order = system_fixture.createOrder()
+    order.addBurgerMain(inventory, {"sesame bun": 2, "beef": 1})
+    assert fragments.render(inventory.menu(), "rows", IngredientType.PATTY, empty="patty") == html
+    assert len(rendered) == 1
+    # the same rows with different context are a different fragment
+    fragments.render(inventory.menu(), "rows", IngredientType.PATTY, empty="none")
+    assert len(rendered) == 2
+    inventory.updateInventory({"chicken": -100})
+    assert fragments.render(inventory.menu(), "rows", IngredientType.PATTY, empty="patty") == "beef"
+    assert fragments.stats() == {"version": inventory.version, "fragments": 1, "hits": 1, "misses": 3}
+
+def test_menu_fragments_fill_in_current_stock(system_fixture):
+    inventory = system_fixture.inventory
+    rendered = []
+    def render(template, items, stock, **context):
+        rendered.append(template)
+        return ",".join("{}<{}".format(item.name, stock(item)) for item, sizes in items)
+    fragments = FragmentCache(render)
+    assert fragments.render(inventory.menu(), "rows", IngredientType.PATTY) == "chicken<100,beef<100"
+    order = system_fixture.createOrder()
+    order.addBurgerMain(inventory, {"sesame bun": 2, "beef": 1})
+    # the cached rows show the stock left, without being rendered again
+    assert fragments.render(inventory.menu(), "rows", IngredientType.PATTY) == "chicken<100,beef<99"
+    assert len(rendered) == 1
+
+def test_menu_fragments_rerendered_for_menu_built_mid_reserve(system_fixture):
+    inventory = system_fixture.inventory
+    def render(template, items, stock, **context):
+        return ",".join("{}<{}".format(item.name, stock(item)) for item, sizes in items)
+    fragments = FragmentCache(render)
+    assert fragments.render(inventory.menu(), "rows", IngredientType.PATTY) == "chicken<100,beef<100"
+    # a reserve took the last beef but has not moved the version on yet, and
+    # another request built the menu in between
+    beef = inventory.getIngredient("beef")
+    beef._quantity = 0
+    menu = Menu(inventory.version, inventory.ingredients)
+    assert menu.version == fragments.stats()["version"]
+    assert fragments.render(menu, "rows", IngredientType.PATTY) == "chicken<100"
+    # the rows kept for the version are left alone
+    beef._quantity = 100
+    assert fragments.render(inventory.menu(), "rows", IngredientType.PATTY) == "chicken<100,beef<100"
+    assert fragments.stats()["hits"] == 1
+
+### Request scoped stock view ###
+def test_stock_view_looks_each_ingredient_up_once(system_fixture, monkeypatch):
+    inventory = system_fixture.inventory
+    lookups = []
+    getIngredient = Inventory.getIngredient
+    def counted(self, name):
+        lookups.append(name.lower())
+        return getIngredient(self, name)
+    monkeypatch.setattr(Inventory, "getIngredient", counted)
+    stock = inventory.view()
+    ingredients = {"sesame bun": 2, "beef": 1, "tomato": 1}
+    check = stock.classifyMain(ingredients)
+    for name, quantity in ingredients.items():
+        assert stock.checkSufficientStock(name, quantity)
+    order = system_fixture.createOrder()
+    order.addBurgerMain(stock, ingredients, check)
+    assert stock.checkSufficientStock("chicken nugget", 5, "large")
+    order.addSide(stock, "Chicken Nugget", 5, "large")
+    assert sorted(lookups) == ["beef", "chicken nugget", "sesame bun", "tomato"]
+    assert inventory.getIngredient("chicken nugget").quantity == 1000 - 45
+    with pytest.raises(InventoryError):
+        stock.getIngredient("kale")
+    with pytest.raises(InventoryError):
+        stock.quantity("kale")
+    assert lookups.count("kale") == 1
+
+def test_stock_view_never_oversells(system_fixture):
+    inventory = system_fixture.inventory
+    stock = inventory.view()
+    # the view saw enough beef, but another order takes it before this one does
+    assert stock.checkSufficientStock("beef", 60)
+    assert stock.quantity("beef") == 100
+    system_fixture.createOrder().addBurgerMain(inventory, {"sesame bun": 2, "beef": 50})
+    order = system_fixture.createOrder()
+    with pytest.raises(InventoryError):
+        order.addBurgerMain(stock, {"sesame bun": 2, "beef": 60})
+    assert inventory.getIngredient("beef").quantity == 50
+    assert order.mainOrders == []
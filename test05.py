@@ -0,0 +1,557 @@
+from backend.system import RestaurantSystem
+from backend.errors import SystemError, OrderError, InventoryError
+from backend.inventory import Inventory, Ingredient, IngredientType
+from backend.writer import PersistenceWriter
+from backend.storage import SQLiteStorage
+from backend.snapshot import isSnapshot, OrderHistory, DeltaReader, SnapshotReader, migrations
+import backend.snapshot as snapshot
+from backend.archive import OrderArchive, ArchivePolicy
+from backend.basket import Basket
+from backend.journal import Journal
+import backend.storage
+
+import pytest
+import json
+import pickle
+import threading
+import time
+
+@pytest.fixture()
+def system_fixture(tmp_path):
+    return stock(RestaurantSystem.loadData(str(tmp_path / "system.dat"), str(tmp_path / "system.journal")))
+
+@pytest.fixture()
+def sqlite_fixture(tmp_path):
+    sys = stock(RestaurantSystem.loadData(storage=SQLiteStorage(str(tmp_path / "system.db"))))
+    yield sys
+    sys.storage.close()
+
+def stock(sys):
+    inv = sys.inventory
+    regularSize = {"regular" : 1}
+    nuggetSize = {"small":3,"medium":6, "large": 9}
+    drinkSize = {"small": 250, "medium":450, "large": 600}
+
+    for name in ["tomato", "cheddar cheese", "lettuce", "swiss cheese"]:
+        inv.addIngredient(name, 1, 100, IngredientType.FILLING, regularSize)
+    for name in ["sesame bun", "muffin bun"]:
+        inv.addIngredient(name, 1, 100, IngredientType.BURGERBUN, regularSize)
+    for name in ["chicken", "beef"]:
+        inv.addIngredient(name, 5, 100, IngredientType.PATTY, regularSize)
+    for name in ["flatBread", "wholeWheat"]:
+        inv.addIngredient(name, 1, 100, IngredientType.WRAP, regularSize)
+    for name in ["Can Coke", "Can Fanta", "Can Sprite"]:
+        inv.addIngredient(name, 5, 100, IngredientType.DRINK, regularSize)
+    inv.addIngredient("Orange Juice", 0.02, 10000, IngredientType.DRINK, drinkSize, "ml")
+    inv.addIngredient("Chicken Nugget", 1, 1000, IngredientType.SIDE, nuggetSize, "g")
+    sys.saveData()
+    return sys
+
+def reload(tmp_path):
+    return RestaurantSystem.loadData(str(tmp_path / "system.dat"), str(tmp_path / "system.journal"))
+
+'''
+test05: Persistence - journal and snapshot recovery
+'''
+def test_reload_replays_journal(system_fixture, tmp_path):
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    order.addDrink(system_fixture.inventory, "Orange Juice", 1, "small")
+    system_fixture.checkout(order.ID)
+    order = system_fixture.createOrder()
+    order.addWrapMain(system_fixture.inventory, {"flatbread":1, "chicken":2})
+    order.addSide(system_fixture.inventory, "Chicken Nugget", 1, "medium")
+    order = system_fixture.createOrder()
+    order.addStandardWrap(system_fixture.inventory)
+    system_fixture.cancelOrder(order.ID)
+    system_fixture.orderPrepared(1)
+    system_fixture.inventory.updateInventory({"tomato": 20, "lettuce": -5})
+    system_fixture.inventory.addIngredient("Fries", 0.01, 1000, IngredientType.SIDE, {"small":100, "medium":150, "large":200}, "g")
+    system_fixture.saveData()
+
+    loaded = reload(tmp_path)
+    assert loaded.orderIDCounter == 4
+    assert [o.ID for o in loaded.finishedOrders] == [1]
+    assert [o.ID for o in loaded.pendingOrders] == [2]
+    assert loaded.activeOrders == []
+    with pytest.raises(SystemError):
+        loaded.getOrderFromID(3)
+    assert loaded.getOrderFromID(2).mainOrders[0].ingredients == {"flatbread":1, "chicken":2}
+    for ingredient in system_fixture.inventory.ingredients:
+        assert loaded.inventory.getIngredient(ingredient.name).quantity == ingredient.quantity
+    assert loaded.inventory.getIngredient("fries").unit == "g"
+
+def test_basket_replayed_from_journal(system_fixture, tmp_path):
+    basket = Basket(mains=[{"recipe": "standard wrap"}], drinks=[{"name": "Can Coke", "quantity": 3}])
+    order = system_fixture.submitBasket(basket)
+    system_fixture.saveData()
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [order.ID]
+    assert loaded.getOrderFromID(order.ID).calculateTotalPrice() == order.calculateTotalPrice()
+    assert loaded.inventory.getIngredient("can coke").quantity == 97
+
+def test_unsaved_events_are_not_persisted(system_fixture, tmp_path):
+    system_fixture.createOrder()
+    system_fixture.saveData()
+    system_fixture.createOrder()
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.pendingOrders] == [1]
+    assert loaded.orderIDCounter == 2
+
+def test_torn_journal_line_is_ignored(system_fixture, tmp_path):
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    system_fixture.saveData()
+    with open(str(tmp_path / "system.journal"), "a") as file:
+        file.write('{"seq":99,"event":"chec')
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.pendingOrders] == [1]
+    # new events after recovery are appended on a clean line
+    loaded.checkout(1)
+    loaded.saveData()
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [1]
+
+def journalEvents(tmp_path, *events):
+    with open(str(tmp_path / "system.journal"), "a") as file:
+        for event in events:
+            file.write(json.dumps(event) + "\n")
+
+def test_order_events_refused_after_one_fails_replay(system_fixture, tmp_path, caplog):
+    order = system_fixture.createOrder()
+    order.addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+    system_fixture.cancelOrder(order.ID)
+    order = system_fixture.createOrder()
+    order.addDrink(system_fixture.inventory, "Can Fanta", 1, "regular")
+    system_fixture.saveData()
+    seq = system_fixture._seq
+    # a line for the cancelled order, then a burger that cannot be made followed
+    # by a checkout for the pending one
+    journalEvents(tmp_path,
+        {"order": 1, "name": "Can Coke", "quantity": 3, "size": "regular", "price": 15, "seq": seq + 1, "event": "drink"},
+        {"order": 2, "main": "burger", "ingredients": {"pizza": 1}, "price": 5, "seq": seq + 2, "event": "main"},
+        {"order": 2, "seq": seq + 3, "event": "checkout"},
+        {"order": 3, "seq": seq + 4, "event": "create"})
+    loaded = reload(tmp_path)
+    assert loaded._seq == seq + 4
+    assert "Refused 3 journal events for orders [1, 2]" in caplog.text
+    # the order is left as it was before its first refused event, not paid for without the burger
+    assert [o.ID for o in loaded.pendingOrders] == [2, 3]
+    assert len(loaded.getOrderFromID(2).sidesAndDrinks) == 1
+    assert loaded.getOrderFromID(2).mainOrders == []
+    assert loaded.inventory.getIngredient("can coke").quantity == 100
+    assert loaded.inventory.getReserved("can coke") == 0
+    loaded.saveData()
+    assert [o.ID for o in reload(tmp_path).pendingOrders] == [2, 3]
+
+def test_unreplayable_stock_event_fails_load(system_fixture, tmp_path):
+    journalEvents(tmp_path, {"ingredients": {"pizza": 1}, "seq": system_fixture._seq + 1, "event": "stock"})
+    with pytest.raises(InventoryError):
+        reload(tmp_path)
+
+def test_journal_compacted_into_snapshot(system_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(backend.storage, "SNAPSHOT_INTERVAL", 5)
+    for i in range(6):
+        system_fixture.createOrder().addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+        system_fixture.saveData()
+    # the journal is truncated whenever it reaches the interval
+    with open(str(tmp_path / "system.journal")) as file:
+        assert len(file.readlines()) < 5
+    loaded = reload(tmp_path)
+    assert len(loaded.pendingOrders) == 6
+    assert loaded.inventory.getIngredient("can coke").quantity == 94
+
+def test_interrupted_compaction_recovered_on_load(system_fixture, tmp_path):
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    system_fixture.saveData()
+    # crash after the journal was rotated but before the snapshot was rewritten
+    system_fixture.storage.journal.rotate(str(tmp_path / "system.journal.old"))
+    system_fixture.checkout(order.ID)
+    system_fixture.saveData()
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [1]
+    assert not (tmp_path / "system.journal.old").exists()
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [1]
+    assert loaded.inventory.getIngredient("beef").quantity == 99
+
+def test_failed_compaction_folded_into_next(system_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(backend.storage, "SNAPSHOT_INTERVAL", 5)
+    writeDelta = backend.storage.writeDelta
+    def failingWriteDelta(base, changes, file):
+        raise IOError("disk full")
+    monkeypatch.setattr(backend.storage, "writeDelta", failingWriteDelta)
+    for i in range(5):
+        system_fixture.createOrder().addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+        # the events reached the journal, so the save succeeds and nothing is buffered again
+        system_fixture.saveData()
+    assert system_fixture._events == []
+    assert (tmp_path / "system.journal.old").exists()
+    monkeypatch.setattr(backend.storage, "writeDelta", writeDelta)
+    for i in range(5):
+        system_fixture.createOrder().addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+        system_fixture.saveData()
+    # the next compaction took in the events the failed one left behind
+    assert not (tmp_path / "system.journal.old").exists()
+    assert system_fixture.storage.segments
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.pendingOrders] == list(range(1, 11))
+    assert loaded.inventory.getIngredient("can coke").quantity == 90
+
+def test_snapshot_is_compressed_and_versioned(system_fixture, tmp_path):
+    system_fixture.inventory.updateInventory({"can coke": 1000})
+    for i in range(600):
+        order = system_fixture.createOrder()
+        order.addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+        system_fixture.checkout(order.ID)
+        system_fixture.orderPrepared(order.ID)
+    system_fixture.storage.write(system_fixture)
+    reader = SnapshotReader(str(tmp_path / "system.dat"))
+    assert reader.version == snapshot.VERSION
+    assert reader.schema == snapshot.SCHEMA_VERSION
+    with open(str(tmp_path / "raw.dat"), "wb") as file:
+        snapshot.writeSnapshot(system_fixture, file, snapshot.RAW)
+    assert (tmp_path / "system.dat").stat().st_size * 4 < (tmp_path / "raw.dat").stat().st_size
+    loaded = reload(tmp_path)
+    assert len(loaded.finishedOrders) == 600
+    assert loaded.getOrderFromID(300).calculateTotalPrice() == 5
+
+@pytest.mark.skipif(snapshot.lzma is None, reason="lzma not available")
+def test_lzma_snapshot_loads(system_fixture, tmp_path):
+    order = system_fixture.createOrder()
+    order.addStandardWrap(system_fixture.inventory)
+    system_fixture.checkout(order.ID)
+    system_fixture.orderPrepared(order.ID)
+    with open(str(tmp_path / "system.dat"), "wb") as file:
+        snapshot.writeSnapshot(system_fixture, file, snapshot.LZMA)
+    loaded = snapshot.loadSnapshot(str(tmp_path / "system.dat"), RestaurantSystem)
+    assert loaded.getOrderFromID(1).mainOrders[0].ingredients == order.mainOrders[0].ingredients
+
+def test_version_1_snapshot_upgraded(tmp_path):
+    # uncompressed layout, with an order payload from before prepared times were kept
+    name = b"can coke"
+    sizes = b'{"regular":1}'
+    payload = b'{"prepared":true,"paid":true,"total":10,"mains":[],"sides":[["Can Coke",2,"regular",10]]}'
+    blob = name + sizes + payload
+    data = snapshot.HEADER_V1.pack(snapshot.MAGIC, 1, 0, 8, 40, 1, 0, 1)
+    data += snapshot.INGREDIENT.pack(0, len(name), 5, 90, IngredientType.DRINK.value, 2, snapshot.PRICE_IS_INT,
+                                     len(name), len(sizes))
+    data += snapshot.ORDER.pack(7, 2, len(name) + len(sizes), len(payload))
+    data += snapshot.FINISHED_ID.pack(7, 0)
+    (tmp_path / "system.dat").write_bytes(data + blob)
+
+    loaded = reload(tmp_path)
+    assert loaded.orderIDCounter == 8
+    assert loaded.inventory.getIngredient("can coke").quantity == 90
+    order = loaded.getOrderFromID(7)
+    assert order.preparedAt is None
+    assert order.calculateTotalPrice() == 10
+    # rewritten in the current format under the current schema
+    loaded.storage.write(loaded)
+    assert SnapshotReader(str(tmp_path / "system.dat")).schema == snapshot.SCHEMA_VERSION
+    assert reload(tmp_path).getOrderFromID(7).sidesAndDrinks[0].quantity == 2
+
+def test_missing_migration_refuses_to_load():
+    try:
+        migrations.upgrade("order", {}, 0)
+    except ValueError:
+        pass
+    else:
+        assert False
+
+### Delta segments ###
+def test_take_changes_returns_dirty_records(system_fixture):
+    for i in range(3):
+        system_fixture.createOrder().addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+    system_fixture.trackChanges()
+    system_fixture.checkout(1)
+    system_fixture.cancelOrder(2)
+    ingredients, orders, removed = system_fixture.takeChanges()
+    assert [i.name for i in ingredients] == ["can coke"]
+    assert [(o.ID, state) for o, state in orders] == [(1, "active")]
+    assert removed == [2]
+    assert not system_fixture.getOrderFromID(1).dirty
+    assert system_fixture.takeChanges() == ([], [], [])
+
+def test_compaction_writes_only_changed_records(system_fixture, tmp_path, monkeypatch):
+    for i in range(10):
+        order = system_fixture.createOrder()
+        order.addStandardBurger(system_fixture.inventory)
+        system_fixture.checkout(order.ID)
+    system_fixture.storage.write(system_fixture)
+    monkeypatch.setattr(backend.storage, "SNAPSHOT_INTERVAL", 4)
+    system_fixture.orderPrepared(3)
+    order = system_fixture.createOrder()
+    order.addDrink(system_fixture.inventory, "Can Sprite", 2, "regular")
+    system_fixture.cancelOrder(order.ID)
+    system_fixture.saveData()
+    assert system_fixture.storage.segments == [str(tmp_path / "system.dat.delta.1")]
+    segment = DeltaReader(str(tmp_path / "system.dat.delta.1"))
+    assert segment.ingredientCount == 1
+    assert [ID for ID, state, data in segment.orders()] == [3]
+    assert list(segment.removed()) == [11]
+
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.finishedOrders] == [3]
+    assert len(loaded.activeOrders) == 9
+    assert loaded.orderIDCounter == 12
+    with pytest.raises(SystemError):
+        loaded.getOrderFromID(11)
+    assert loaded.inventory.getIngredient("can sprite").quantity == 100
+
+def test_segments_merged_into_snapshot(system_fixture, tmp_path, monkeypatch):
+    monkeypatch.setattr(backend.storage, "SNAPSHOT_INTERVAL", 2)
+    monkeypatch.setattr(backend.storage, "MERGE_SEGMENTS", 3)
+    for i in range(3):
+        order = system_fixture.createOrder()
+        order.addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+        system_fixture.saveData()
+    # close waits for the background merge
+    system_fixture.storage.close()
+    assert system_fixture.storage.segments == []
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.pendingOrders] == [1, 2, 3]
+    assert loaded.inventory.getIngredient("can coke").quantity == 97
+
+### Binary snapshot ###
+def test_snapshot_decodes_history_lazily(system_fixture, tmp_path):
+    for i in range(4):
+        order = system_fixture.createOrder()
+        order.addStandardBurger(system_fixture.inventory)
+        system_fixture.checkout(order.ID)
+    system_fixture.orderPrepared(2)
+    system_fixture.orderPrepared(1)
+    system_fixture.createOrder().addDrink(system_fixture.inventory, "Can Coke", 2, "regular")
+    system_fixture.storage.write(system_fixture)
+    assert isSnapshot(str(tmp_path / "system.dat"))
+
+    loaded = reload(tmp_path)
+    history = loaded._finishedOrders
+    assert isinstance(history, OrderHistory)
+    assert len(history) == 2
+    assert history._decoded == {}
+    assert [o.ID for o in loaded.activeOrders] == [3, 4]
+    assert loaded.getOrderFromID(1).calculateTotalPrice() == 9
+    assert list(history._decoded) == [1]
+    assert [o.ID for o in loaded.finishedOrders] == [2, 1]
+    assert loaded.seeOrderStatusFromID(2) == "Your order is ready to be collected."
+    with pytest.raises(SystemError):
+        loaded.getOrderFromID(9)
+    # the pending order still holds its stock
+    loaded.cancelOrder(5)
+    assert loaded.inventory.getIngredient("can coke").quantity == 100
+
+    # history from the old snapshot is carried over into the next one undecoded
+    loaded.orderPrepared(3)
+    loaded.storage.write(loaded)
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.finishedOrders] == [2, 1, 3]
+    assert loaded.getOrderFromID(3).mainOrders[0].ingredients == {"sesame bun":2, "beef":1, "tomato":1, "cheddar cheese":1}
+    assert loaded.inventory.getIngredient("beef").quantity == 96
+    assert loaded.inventory.getIngredient("beef").price == 5
+
+def test_pickle_snapshot_still_loads(system_fixture, tmp_path):
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    system_fixture.checkout(order.ID)
+    with open(str(tmp_path / "system.dat"), "wb") as file:
+        pickle.dump(system_fixture, file)
+    (tmp_path / "system.journal").write_text("")
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [1]
+    assert loaded.inventory.getIngredient("beef").quantity == 99
+
+### SQLite storage ###
+def reloadSQLite(tmp_path):
+    return RestaurantSystem.loadData(storage=SQLiteStorage(str(tmp_path / "system.db")))
+
+def test_sqlite_reload_applies_saved_events(sqlite_fixture, tmp_path):
+    order = sqlite_fixture.createOrder()
+    order.addStandardBurger(sqlite_fixture.inventory)
+    order.addDrink(sqlite_fixture.inventory, "Orange Juice", 1, "small")
+    sqlite_fixture.checkout(order.ID)
+    order = sqlite_fixture.createOrder()
+    order.addWrapMain(sqlite_fixture.inventory, {"flatbread":1, "chicken":2})
+    order.addSide(sqlite_fixture.inventory, "Chicken Nugget", 1, "medium")
+    order = sqlite_fixture.createOrder()
+    order.addStandardWrap(sqlite_fixture.inventory)
+    sqlite_fixture.cancelOrder(order.ID)
+    sqlite_fixture.orderPrepared(1)
+    sqlite_fixture.inventory.updateInventory({"tomato": 20, "lettuce": -5})
+    sqlite_fixture.saveData()
+
+    loaded = reloadSQLite(tmp_path)
+    assert loaded.orderIDCounter == 4
+    assert [o.ID for o in loaded.finishedOrders] == [1]
+    assert [o.ID for o in loaded.pendingOrders] == [2]
+    with pytest.raises(SystemError):
+        loaded.getOrderFromID(3)
+    assert loaded.getOrderFromID(2).mainOrders[0].ingredients == {"flatbread":1, "chicken":2}
+    assert loaded.getOrderFromID(2).calculateTotalPrice() == sqlite_fixture.getOrderFromID(2).calculateTotalPrice()
+    for ingredient in sqlite_fixture.inventory.ingredients:
+        assert loaded.inventory.getIngredient(ingredient.name).quantity == ingredient.quantity
+    # the pending order still holds its stock, and gives it back when cancelled
+    loaded.cancelOrder(2)
+    assert loaded.inventory.getIngredient("chicken").quantity == 100
+    assert loaded.inventory.getIngredient("chicken nugget").quantity == 1000
+    loaded.saveData()
+    loaded.storage.close()
+    assert reloadSQLite(tmp_path).inventory.getIngredient("chicken").quantity == 100
+
+def test_sqlite_batch_is_one_transaction(sqlite_fixture, tmp_path):
+    sqlite_fixture.createOrder().addStandardBurger(sqlite_fixture.inventory)
+    sqlite_fixture._record("bogus")
+    with pytest.raises(SystemError):
+        sqlite_fixture.saveData()
+    # nothing from the failed batch was applied, and it stays buffered
+    assert reloadSQLite(tmp_path).orderIDCounter == 1
+    assert len(sqlite_fixture._events) == 3
+
+def test_pickle_system_written_to_sqlite(system_fixture, tmp_path):
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    system_fixture.checkout(order.ID)
+    system_fixture.createOrder().addSide(system_fixture.inventory, "Chicken Nugget", 2, "large")
+    storage = SQLiteStorage(str(tmp_path / "system.db"))
+    storage.write(system_fixture)
+    storage.close()
+    loaded = reloadSQLite(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [1]
+    assert [o.ID for o in loaded.pendingOrders] == [2]
+    assert loaded.getOrderFromID(2).calculateTotalPrice() == 18
+    assert loaded.inventory.getIngredient("chicken nugget").quantity == 1000 - 18
+
+### Archive of finished orders ###
+def finishOrders(sys, count):
+    for i in range(count):
+        order = sys.createOrder()
+        order.addDrink(sys.inventory, "Can Coke", 1, "regular")
+        sys.checkout(order.ID)
+        sys.orderPrepared(order.ID, at=1000 + i)
+
+def test_archive_keeps_newest_finished_in_memory(system_fixture, tmp_path):
+    system_fixture.attachArchive(OrderArchive(str(tmp_path / "system.archive")), ArchivePolicy(maxFinished=2))
+    finishOrders(system_fixture, 5)
+    system_fixture.saveData()
+    assert [o.ID for o in system_fixture.finishedOrders] == [4, 5]
+    stats = system_fixture.archiveStats()
+    assert stats["archivedOrders"] == 3
+    assert stats["finishedOrders"] == 2
+    assert stats["archiveBytes"] > 0
+    # archived orders are still found by ID
+    assert system_fixture.getOrderFromID(1).calculateTotalPrice() == 5
+    assert system_fixture.seeOrderStatusFromID(2) == "Your order is ready to be collected."
+    try:
+        system_fixture.getOrderFromID(9)
+    except SystemError:
+        pass
+    else:
+        assert False
+
+def test_archived_orders_stay_out_of_memory_after_reload(system_fixture, tmp_path):
+    system_fixture.attachArchive(OrderArchive(str(tmp_path / "system.archive")), ArchivePolicy(maxFinished=1))
+    finishOrders(system_fixture, 3)
+    system_fixture.saveData()
+    system_fixture.storage.write(system_fixture)
+    finishOrders(system_fixture, 1)
+    system_fixture.saveData()
+    loaded = reload(tmp_path)
+    loaded.attachArchive(OrderArchive(str(tmp_path / "system.archive")), ArchivePolicy(maxFinished=1))
+    assert [o.ID for o in loaded.finishedOrders] == [4]
+    assert loaded.getOrderFromID(3).preparedAt == 1002
+    assert loaded.getPaidOrderFromID(1).paid
+
+def test_archive_by_age(system_fixture, tmp_path):
+    system_fixture.attachArchive(OrderArchive(str(tmp_path / "system.archive")), ArchivePolicy(maxAge=60))
+    finishOrders(system_fixture, 3)
+    assert system_fixture.archiveFinished(now=1061.5) == 2
+    assert [o.ID for o in system_fixture.finishedOrders] == [3]
+    assert system_fixture.archiveFinished(now=1061.5) == 0
+
+def test_torn_archive_record_is_dropped(system_fixture, tmp_path):
+    path = str(tmp_path / "system.archive")
+    archive = OrderArchive(path)
+    system_fixture.attachArchive(archive, ArchivePolicy(maxFinished=0))
+    finishOrders(system_fixture, 2)
+    system_fixture.saveData()
+    size = archive.size
+    archive.close()
+    with open(path, "ab") as file:
+        file.write(b"\x03\x00\x00\x00\xff")
+    archive = OrderArchive(path)
+    assert archive.count == 2
+    assert archive.size == size
+    assert archive.get(2, system_fixture.inventory).ID == 2
+    assert archive.get(3, system_fixture.inventory) is None
+
+### Background persistence writer ###
+class SaveCounter:
+    def __init__(self):
+        self.saves = 0
+        self.saved = threading.Event()
+
+    def __call__(self):
+        self.saves += 1
+        self.saved.set()
+
+def test_writer_coalesces_changes_within_interval():
+    counter = SaveCounter()
+    writer = PersistenceWriter(counter, interval=0.2, maxPending=1000)
+    writer.start()
+    for i in range(20):
+        writer.markDirty()
+    assert counter.saved.wait(2)
+    writer.stop()
+    assert counter.saves == 1
+    assert writer.pending == 0
+
+def test_writer_flushes_after_max_pending():
+    counter = SaveCounter()
+    writer = PersistenceWriter(counter, interval=60, maxPending=5)
+    writer.start()
+    for i in range(5):
+        writer.markDirty()
+    assert counter.saved.wait(2)
+    writer.stop()
+    assert counter.saves >= 1
+
+def test_writer_flush_persists_system(system_fixture, tmp_path):
+    writer = PersistenceWriter(system_fixture.saveData, interval=60, maxPending=1000)
+    writer.start()
+    order = system_fixture.createOrder()
+    order.addStandardBurger(system_fixture.inventory)
+    writer.markDirty()
+    writer.flush()
+    loaded = reload(tmp_path)
+    assert len(loaded.getOrderFromID(1).mainOrders) == 1
+    system_fixture.checkout(1)
+    writer.markDirty()
+    writer.stop()
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.activeOrders] == [1]
+
+def test_concurrent_saves_keep_journal_in_order(system_fixture, tmp_path, monkeypatch):
+    # two workers' writers saving the shared system at once
+    journal = system_fixture.storage.journal
+    append = journal.append
+    def slowAppend(events):
+        time.sleep(0.001)
+        append(events)
+    monkeypatch.setattr(journal, "append", slowAppend)
+    def saver():
+        for i in range(20):
+            order = system_fixture.createOrder()
+            order.addDrink(system_fixture.inventory, "Can Coke", 1, "regular")
+            system_fixture.saveData()
+    threads = [threading.Thread(target=saver) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seqs = [event["seq"] for event in Journal(str(tmp_path / "system.journal")).replay()]
+    assert seqs == sorted(seqs)
+    loaded = reload(tmp_path)
+    assert [o.ID for o in loaded.pendingOrders] == [o.ID for o in system_fixture.pendingOrders]
+    assert len(loaded.pendingOrders) == 40
+    assert loaded.inventory.getIngredient("can coke").quantity == 60
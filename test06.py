@@ -0,0 +1,186 @@
+from backend.system import RestaurantSystem
+from backend.errors import SystemError, OrderError, InventoryError
+from backend.inventory import Inventory, Ingredient, IngredientType
+
+from backend.shared import serve, connect
+import backend.system
+
+import pytest
+import multiprocessing
+import threading
+import time
+
+@pytest.fixture()
+def system_fixture():
+    sys = RestaurantSystem()
+    inv = sys.inventory
+    regularSize = {"regular" : 1}
+    nuggetSize = {"small":3,"medium":6, "large": 9}
+
+    for name in ["tomato", "cheddar cheese", "lettuce"]:
+        inv.addIngredient(name, 1, 1000, IngredientType.FILLING, regularSize)
+    inv.addIngredient("sesame bun", 1, 1000, IngredientType.BURGERBUN, regularSize)
+    # the scarce ingredients every thread competes for
+    inv.addIngredient("beef", 5, 50, IngredientType.PATTY, regularSize)
+    inv.addIngredient("Chicken Nugget", 1, 90, IngredientType.SIDE, nuggetSize, "g")
+    return sys
+
+@pytest.fixture(autouse=True)
+def race_windows(monkeypatch):
+    # yield to other threads in the middle of each read-modify-write, so a
+    # missing lock shows up as oversold stock or duplicate IDs
+    def slowDecreaseStock(self, size, quantity):
+        q = quantity if size == "regular" else quantity * self._servingSizes[size]
+        available = self._quantity
+        time.sleep(0.0001)
+        if q > available:
+            raise InventoryError("Insufficient stock for " + self._name.lower())
+        self._quantity = available - q
+    monkeypatch.setattr(Ingredient, "decreaseStock", slowDecreaseStock)
+
+    class SlowOrder(backend.system.Order):
+        def __init__(self, ID):
+            time.sleep(0.0001)
+            super().__init__(ID)
+    monkeypatch.setattr(backend.system, "Order", SlowOrder)
+
+def run_threads(count, target):
+    errors = []
+    def wrapper(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=wrapper, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+'''
+test06: Concurrency - stock, order IDs and order state under many threads
+'''
+def test_concurrent_orders_never_oversell(system_fixture):
+    inventory = system_fixture.inventory
+    sold = {"beef": 0, "nuggets": 0}
+    soldLock = threading.Lock()
+    def customer(i):
+        for j in range(10):
+            order = system_fixture.createOrder()
+            try:
+                order.addBurgerMain(inventory, {"sesame bun":2, "beef":1, "tomato":1})
+                with soldLock:
+                    sold["beef"] += 1
+            except InventoryError:
+                pass
+            try:
+                order.addSide(inventory, "chicken nugget", 1, "small")
+                with soldLock:
+                    sold["nuggets"] += 3
+            except InventoryError:
+                pass
+    run_threads(16, customer)
+    assert sold["beef"] == 50
+    assert sold["nuggets"] == 90
+    assert inventory.getIngredient("beef").quantity == 0
+    assert inventory.getIngredient("chicken nugget").quantity == 0
+    assert inventory.getIngredient("sesame bun").quantity == 1000 - 2 * sold["beef"]
+    assert inventory.getIngredient("tomato").quantity == 1000 - sold["beef"]
+
+def test_concurrent_order_ids_are_unique(system_fixture):
+    ids = []
+    def customer(i):
+        for j in range(50):
+            ids.append(system_fixture.createOrder().ID)
+    run_threads(8, customer)
+    assert sorted(ids) == list(range(1, 401))
+    assert system_fixture.orderIDCounter == 401
+    assert len(system_fixture.pendingOrders) == 400
+
+def test_concurrent_checkout_and_cancel_serialise_per_order(system_fixture):
+    inventory = system_fixture.inventory
+    orders = []
+    for i in range(40):
+        order = system_fixture.createOrder()
+        order.addBurgerMain(inventory, {"sesame bun":2, "beef":1})
+        orders.append(order)
+    outcomes = {}
+    def staff(i):
+        for order in orders:
+            try:
+                if i % 2 == 0:
+                    system_fixture.checkout(order.ID)
+                    outcomes.setdefault(order.ID, []).append("checkout")
+                else:
+                    system_fixture.cancelOrder(order.ID)
+                    outcomes.setdefault(order.ID, []).append("cancel")
+            except SystemError:
+                pass
+    run_threads(8, staff)
+    # exactly one transition wins for every order
+    assert all(len(outcome) == 1 for outcome in outcomes.values())
+    assert len(outcomes) == 40
+    cancelled = [ID for ID, outcome in outcomes.items() if outcome == ["cancel"]]
+    assert len(system_fixture.activeOrders) == 40 - len(cancelled)
+    assert system_fixture.pendingOrders == []
+    assert inventory.getIngredient("beef").quantity == 50 - 40 + len(cancelled)
+
+### Multi-process serving ###
+def order_burgers(address, results):
+    # a web worker process: order burgers until the beef runs out
+    system = connect(address, b"test")
+    IDs = []
+    while True:
+        order = system.createOrder()
+        try:
+            order.addStandardBurger(system.inventory)
+        except InventoryError:
+            system.cancelOrder(order.ID)
+            break
+        IDs.append(order.ID)
+    results.put(IDs)
+
+def test_worker_processes_share_one_system(system_fixture):
+    ready = multiprocessing.Queue()
+    coordinator = multiprocessing.Process(target=serve, args=(system_fixture, ("127.0.0.1", 0), b"test", ready.put),
+                                          daemon=True)
+    coordinator.start()
+    try:
+        address = ready.get(timeout=10)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=order_burgers, args=(address, results)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        IDs = []
+        for worker in workers:
+            IDs += results.get(timeout=30)
+        for worker in workers:
+            worker.join()
+        # every process drew from the same ID counter and the same stock
+        assert len(IDs) == 50
+        assert len(set(IDs)) == 50
+        system = connect(address, b"test")
+        assert system.inventory.getIngredient("beef").quantity == 0
+        # each worker also created and cancelled one order when the beef ran out
+        assert system.orderIDCounter == 50 + 3 + 1
+        assert system.getOrderFromID(IDs[0]).calculateTotalPrice() == 9
+    finally:
+        coordinator.terminate()
+
+def test_worker_stock_view_takes_coordinator_stock(system_fixture):
+    ready = multiprocessing.Queue()
+    coordinator = multiprocessing.Process(target=serve, args=(system_fixture, ("127.0.0.1", 0), b"test", ready.put),
+                                          daemon=True)
+    coordinator.start()
+    try:
+        system = connect(ready.get(timeout=10), b"test")
+        stock = system.inventory.view()
+        assert stock.checkSufficientStock("chicken nugget", 2, "medium")
+        order = system.createOrder()
+        # the view's ingredients are copies; the order takes the coordinator's stock
+        order.addSide(stock, "chicken nugget", 2, "medium")
+        assert system.inventory.getIngredient("chicken nugget").quantity == 90 - 12
+        assert stock.quantity("chicken nugget") == 90
+    finally:
+        coordinator.terminate()
@@ -0,0 +1,206 @@
+from backend.system import RestaurantSystem
+from backend.errors import SystemError, OrderError, InventoryError
+from backend.inventory import Inventory, Ingredient, IngredientType
+from backend.metrics import Registry
+from backend import tracing
+import traces
+from backend.profiling import sampleStacks, RequestProfiler, memorySnapshot, startMemoryTracing, stopMemoryTracing
+
+import json
+import pytest
+import threading
+import tracemalloc
+
+@pytest.fixture()
+def system_fixture(tmp_path):
+    sys = RestaurantSystem.loadData(str(tmp_path / "system.dat"), str(tmp_path / "system.journal"))
+    inv = sys.inventory
+    regularSize = {"regular" : 1}
+    nuggetSize = {"small":3,"medium":6, "large": 9}
+
+    for name in ["tomato", "cheddar cheese", "lettuce"]:
+        inv.addIngredient(name, 1, 100, IngredientType.FILLING, regularSize)
+    inv.addIngredient("sesame bun", 1, 100, IngredientType.BURGERBUN, regularSize)
+    inv.addIngredient("beef", 5, 100, IngredientType.PATTY, regularSize)
+    inv.addIngredient("Chicken Nugget", 1, 1000, IngredientType.SIDE, nuggetSize, "g")
+    sys.saveData()
+    return sys
+
+'''
+test07: Operations - metrics, tracing and profiling
+'''
+def test_metrics_rendered_in_prometheus_text_format():
+    registry = Registry()
+    served = registry.counter("served_total", "Requests served", ["endpoint", "status"])
+    served.inc("index", "200")
+    served.inc("index", "200")
+    served.inc("staff", "500")
+    registry.gauge("stock", "Stock held", lambda: {("can \"coke\"",): 5}, ["ingredient"])
+    latency = registry.histogram("latency_seconds", "Latency", ["endpoint"], buckets=(0.1, 1.0))
+    latency.observe(0.05, "index")
+    latency.observe(0.5, "index")
+    latency.observe(5, "index")
+    text = registry.render()
+    assert "# TYPE served_total counter" in text
+    assert 'served_total{endpoint="index",status="200"} 2' in text
+    assert 'served_total{endpoint="staff",status="500"} 1' in text
+    assert 'stock{ingredient="can \\"coke\\""} 5' in text
+    assert "# TYPE latency_seconds histogram" in text
+    assert 'latency_seconds_bucket{endpoint="index",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{endpoint="index",le="1"} 2' in text
+    assert 'latency_seconds_bucket{endpoint="index",le="+Inf"} 3' in text
+    assert 'latency_seconds_sum{endpoint="index"} 5.55' in text
+    assert 'latency_seconds_count{endpoint="index"} 3' in text
+    assert 'latency_seconds_quantile{endpoint="index",quantile="0.5"}' in text
+    with pytest.raises(ValueError):
+        registry.counter("served_total", "Again")
+
+def test_histogram_quantiles_estimated_from_buckets():
+    latency = Registry().histogram("latency_seconds", "Latency", buckets=(0.01, 0.1, 1.0))
+    assert latency.quantile(0.5) is None
+    for i in range(90):
+        latency.observe(0.005)
+    for i in range(10):
+        latency.observe(0.5)
+    assert latency.quantile(0.5) == pytest.approx(0.01 * 50 / 90)
+    # p95 falls half way through the observations in the (0.1, 1] bucket
+    assert latency.quantile(0.95) == pytest.approx(0.1 + 0.9 * 5 / 10)
+    assert latency.quantile(0.99) <= 1.0
+    timed = latency.time(lambda x: x * 2)
+    assert timed(4) == 8
+    assert latency.count() == 101
+
+def test_order_events_counted_but_not_on_replay(system_fixture, tmp_path):
+    first = system_fixture.createOrder()
+    first.addSide(system_fixture.inventory, "chicken nugget", 1, "small")
+    system_fixture.checkout(first.ID)
+    system_fixture.orderPrepared(first.ID)
+    second = system_fixture.createOrder()
+    system_fixture.cancelOrder(second.ID)
+    counts = system_fixture.eventCounts
+    assert [counts["create"], counts["checkout"], counts["prepared"], counts["cancel"]] == [2, 1, 1, 1]
+    system_fixture.saveData()
+    reloaded = RestaurantSystem.loadData(str(tmp_path / "system.dat"), str(tmp_path / "system.journal"))
+    assert reloaded.eventCounts == {}
+    assert len(reloaded.finishedOrders) == 1
+
+def test_spans_nest_into_one_trace_per_line(system_fixture, tmp_path, monkeypatch):
+    path = str(tmp_path / "traces.jsonl")
+    monkeypatch.setattr(tracing, "tracer", None)
+    tracing.configure(path, sample=1.0)
+    @tracing.traced("lookup")
+    def lookup(ID):
+        return system_fixture.getOrderFromID(ID)
+    order = system_fixture.createOrder()
+    with tracing.trace("GET /review", order=order.ID) as root:
+        assert lookup(order.ID) is order
+        with tracing.span("render", template="revieworder.html"):
+            order.calculateTotalPrice()
+        root.set(status=200)
+    with pytest.raises(SystemError):
+        with tracing.trace("GET /missing"):
+            lookup(999)
+    # spans outside a trace are not recorded
+    with tracing.span("stray"):
+        pass
+    with open(path) as file:
+        records = [json.loads(line) for line in file]
+    assert [record["name"] for record in records] == ["GET /review", "GET /missing"]
+    review = records[0]
+    assert review["attrs"] == {"order": order.ID, "status": 200}
+    assert [span["name"] for span in review["spans"]] == ["lookup", "render"]
+    assert review["spans"][1]["attrs"] == {"template": "revieworder.html"}
+    assert all(0 <= span["ms"] <= review["ms"] for span in review["spans"])
+    assert records[1]["attrs"]["error"] == "SystemError"
+    assert records[1]["spans"][0]["attrs"]["error"] == "SystemError"
+    slowest = traces.slowest(traces.readTraces(path), 1)
+    assert len(slowest) == 1
+    lines = traces.formatSpan(records[0])
+    assert len(lines) == 3
+    assert lines[1].endswith("  lookup")
+
+def test_tracing_off_leaves_functions_undecorated(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, "tracer", None)
+    def lookup():
+        return 1
+    assert tracing.traced("lookup")(lookup) is lookup
+    assert tracing.trace("GET /") is tracing.NO_SPAN
+    assert tracing.span("render") is tracing.NO_SPAN
+    # sampled out requests write nothing and make no spans
+    tracer = tracing.configure(str(tmp_path / "traces.jsonl"), sample=0.0)
+    with tracing.trace("GET /"):
+        assert tracing.span("render") is tracing.NO_SPAN
+    assert tracer.written == 0
+
+def busyOrders(system, stop):
+    while not stop.is_set():
+        order = system.createOrder()
+        order.calculateTotalPrice()
+        system.cancelOrder(order.ID)
+
+def test_sampled_profile_finds_busy_thread(system_fixture):
+    stop = threading.Event()
+    worker = threading.Thread(target=busyOrders, args=(system_fixture, stop))
+    worker.start()
+    try:
+        result = sampleStacks(0.3, interval=0.002)
+    finally:
+        stop.set()
+        worker.join()
+    assert result["samples"] > 0
+    selfCounts = [entry["self"] for entry in result["functions"]]
+    assert selfCounts == sorted(selfCounts, reverse=True)
+    # the busy thread was caught inside the backend
+    assert any("backend" in entry["file"] for entry in result["functions"])
+    assert all(entry["total"] >= entry["self"] for entry in result["functions"])
+
+def test_request_profiler_merges_requests_in_capture(system_fixture):
+    profiler = RequestProfiler()
+    assert profiler.begin() is None
+    results = []
+    capture = threading.Thread(target=lambda: results.append(profiler.capture(0.3, top=50)))
+    capture.start()
+    assert profiler.waitForCapture(timeout=5)
+    def request():
+        profile = profiler.begin()
+        if profile is None:
+            return
+        try:
+            order = system_fixture.createOrder()
+            order.addSide(system_fixture.inventory, "chicken nugget", 1, "small")
+        finally:
+            profiler.end(profile)
+    for i in range(3):
+        request()
+    capture.join()
+    result = results[0]
+    assert result["requests"] + result["skipped"] == 3
+    # the stats of every profiled request are merged into one report
+    assert result["requests"] >= 1
+    assert "addSide" in [entry["function"] for entry in result["functions"]]
+    calls = {entry["function"]: entry["calls"] for entry in result["functions"]}
+    assert calls["addSide"] == result["requests"]
+
+def test_memory_snapshot_groups_backend_modules_and_types(system_fixture):
+    wasTracing = tracemalloc.is_tracing()
+    startMemoryTracing()
+    try:
+        orders = []
+        for i in range(200):
+            order = system_fixture.createOrder()
+            order.addSide(system_fixture.inventory, "chicken nugget", 1, "small")
+            orders.append(order)
+        snapshot = memorySnapshot(top=20)
+    finally:
+        if not wasTracing:
+            stopMemoryTracing()
+    assert snapshot["tracing"]
+    assert snapshot["tracedBytes"] > 0
+    assert all(module.startswith("backend.") for module in snapshot["modules"])
+    assert "backend.order" in snapshot["modules"]
+    assert snapshot["types"]["Order"]["objects"] >= 200
+    assert snapshot["types"]["SideDrink"]["objects"] >= 200
+    assert snapshot["types"]["Ingredient"]["objects"] >= 6
+    assert snapshot["types"]["Order"]["bytes"] > 0
+    if not wasTracing:
+        assert memorySnapshot()["tracing"] is False
@@ -0,0 +1,53 @@
+# Prints the slowest traces written by backend.tracing, each as a tree of
+# nested timings:
+#
+#   RESTAURANT_TRACE=traces.jsonl RESTAURANT_TRACE_SAMPLE=0.05 python3 run.py
+#   python3 traces.py [traces.jsonl] [-n count] [--name prefix]
+import argparse
+import json
+import sys
+
+def readTraces(path):
+    traces = []
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                traces.append(json.loads(line))
+            except ValueError:
+                # the last line may still be being written
+                continue
+    return traces
+
+def slowest(traces, count, name=None):
+    if name is not None:
+        traces = [trace for trace in traces if trace["name"].startswith(name)]
+    return sorted(traces, key=lambda trace: trace["ms"], reverse=True)[:count]
+
+def formatSpan(span, depth=0):
+    # one line per span: its time, and the share of it not spent in the spans below
+    own = span["ms"] - sum(child["ms"] for child in span.get("spans", []))
+    attrs = " ".join("{}={}".format(key, value) for key, value in sorted(span.get("attrs", {}).items()))
+    lines = ["{:>10.3f} ms {:>10.3f} ms  {}{} {}".format(span["ms"], own, "  " * depth, span["name"], attrs).rstrip()]
+    for child in span.get("spans", []):
+        lines += formatSpan(child, depth + 1)
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the slowest traces as nested timings")
+    parser.add_argument("path", nargs="?", default="traces.jsonl")
+    parser.add_argument("-n", type=int, default=10, help="number of traces to print")
+    parser.add_argument("--name", help="only traces whose root span starts with this, e.g. 'GET /<orderID>/checkout'")
+    args = parser.parse_args(argv)
+    traces = readTraces(args.path)
+    print("{} traces in {}".format(len(traces), args.path))
+    for trace in slowest(traces, args.n, args.name):
+        print()
+        print("trace {}".format(trace["trace"]))
+        print("{:>13} {:>13}  {}".format("total", "self", "span"))
+        print("\n".join(formatSpan(trace)))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])